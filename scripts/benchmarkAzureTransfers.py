@@ -0,0 +1,104 @@
+#!/usr/bin/env python2.7
+"""
+benchmarkAzureTransfers.py: time block-parallel uploads and downloads through
+AzureIOStore against a local mock blob service.
+
+Each request to the mock service takes a configurable amount of time, to stand
+in for the round trip to Azure. Reports throughput for each thread count.
+
+"""
+
+import argparse, sys, os, os.path, random, subprocess, shutil, itertools, glob
+import doctest, re, json, collections, time, timeit
+import tempfile
+
+from toillib import *
+from mockazure import MockBlockBlobService
+
+def parse_args(args):
+    """
+    Takes in the command-line arguments list (args), and returns a nice argparse
+    result with fields for all the options.
+
+    Borrows heavily from the argparse documentation examples:
+    <http://docs.python.org/library/argparse.html>
+    """
+
+    # Construct the parser (which is stored in parser)
+    # Module docstring lives in __doc__
+    # See http://python-forum.com/pythonforum/viewtopic.php?f=3&t=36847
+    # And a formatter class so our examples in the docstring look good. Isn't it
+    # convenient how we already wrapped it to 80 characters?
+    # See http://docs.python.org/library/argparse.html#formatter-class
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # General options
+    parser.add_argument("--size", type=int, default=64 * 1024 * 1024,
+        help="size of the file to move, in bytes")
+    parser.add_argument("--block_size", type=int, default=AZURE_BLOCK_SIZE,
+        help="block size to move the file in, in bytes")
+    parser.add_argument("--latency", type=float, default=0.05,
+        help="seconds each request to the mock service takes")
+    parser.add_argument("--threads", type=int, action="append", default=[],
+        help="thread counts to try")
+
+    # The command line arguments start with the program name, which we don't
+    # want to treat as an argument for argparse. So we remove it.
+    args = args[1:]
+
+    return parser.parse_args(args)
+
+def main(args):
+    """
+    Parses command line arguments and do the work of the program.
+    "args" specifies the program arguments, with args[0] being the executable
+    name. The return value should be used as the program's exit code.
+    """
+
+    if len(args) == 2 and args[1] == "--test":
+        # Run the tests
+        return doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+
+    options = parse_args(args) # This holds the nicely-parsed options object
+
+    if len(options.threads) == 0:
+        # Try a few by default
+        options.threads = [1, 4, 16]
+
+    work_dir = tempfile.mkdtemp()
+
+    try:
+        # Make a file to move around
+        source = os.path.join(work_dir, "source")
+        with open(source, "wb") as source_file:
+            source_file.write(os.urandom(options.size))
+
+        for threads in options.threads:
+            # Use a fresh service each time
+            store = AzureIOStore("account", "container",
+                blob_service=MockBlockBlobService(latency=options.latency),
+                transfer_threads=threads, block_size=options.block_size)
+
+            start_time = timeit.default_timer()
+            store.write_output_file(source, "blob")
+            upload_seconds = timeit.default_timer() - start_time
+
+            destination = os.path.join(work_dir, "destination")
+            start_time = timeit.default_timer()
+            store.read_input_file("blob", destination)
+            download_seconds = timeit.default_timer() - start_time
+
+            megabytes = options.size / float(1024 * 1024)
+            print("{} threads\tupload {:.2f} MB/s\tdownload {:.2f} MB/s".format(
+                threads, megabytes / upload_seconds,
+                megabytes / download_seconds))
+
+            os.unlink(destination)
+    finally:
+        shutil.rmtree(work_dir)
+
+    return 0
+
+if __name__ == "__main__" :
+    sys.exit(main(sys.argv))
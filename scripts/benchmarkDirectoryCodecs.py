@@ -0,0 +1,140 @@
+#!/usr/bin/env python2.7
+"""
+benchmarkDirectoryCodecs.py: compare the compression codecs that
+write_global_directory can use, on a real directory (like an extracted
+GCSA/XG index directory).
+
+Reports pack time, compressed size, and unpack time for each codec and thread
+count.
+
+"""
+
+import argparse, sys, os, os.path, random, subprocess, shutil, itertools, glob
+import doctest, re, json, collections, time, timeit, tempfile
+
+from toillib import *
+
+def parse_args(args):
+    """
+    Takes in the command-line arguments list (args), and returns a nice argparse
+    result with fields for all the options.
+
+    Borrows heavily from the argparse documentation examples:
+    <http://docs.python.org/library/argparse.html>
+    """
+
+    # Construct the parser (which is stored in parser)
+    # Module docstring lives in __doc__
+    # See http://python-forum.com/pythonforum/viewtopic.php?f=3&t=36847
+    # And a formatter class so our examples in the docstring look good. Isn't it
+    # convenient how we already wrapped it to 80 characters?
+    # See http://docs.python.org/library/argparse.html#formatter-class
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # General options
+    parser.add_argument("directory",
+        help="directory to pack and unpack")
+    parser.add_argument("--codec", action="append", default=[],
+        choices=sorted(DIRECTORY_CODECS.keys()),
+        help="only try the given codecs")
+    parser.add_argument("--threads", type=int, action="append", default=[],
+        help="try packing with this many threads")
+    parser.add_argument("--work_dir", default=None,
+        help="directory to put tarballs and unpacked copies in")
+
+    # The command line arguments start with the program name, which we don't
+    # want to treat as an argument for argparse. So we remove it.
+    args = args[1:]
+
+    return parser.parse_args(args)
+
+class LocalFileStore(object):
+    """
+    Stand-in for a Toil file store that just uses local files as file IDs, so
+    we can time the directory functions on their own.
+
+    """
+
+    def writeGlobalFile(self, path):
+        """
+        Use the file at the given path as its own ID.
+        """
+
+        return path
+
+    def readGlobalFileStream(self, path):
+        """
+        Open the file with the given ID.
+        """
+
+        return open(path)
+
+def directory_size(path):
+    """
+    Return the total size of the files under the given directory.
+
+    """
+
+    total = 0
+    for parent, _, file_names in os.walk(path):
+        for file_name in file_names:
+            total += os.path.getsize(os.path.join(parent, file_name))
+    return total
+
+def main(args):
+    """
+    Parses command line arguments and do the work of the program.
+    "args" specifies the program arguments, with args[0] being the executable
+    name. The return value should be used as the program's exit code.
+    """
+
+    if len(args) == 2 and args[1] == "--test":
+        # Run the tests
+        return doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+
+    options = parse_args(args) # This holds the nicely-parsed options object
+
+    if len(options.codec) == 0:
+        # Try everything by default
+        options.codec = sorted(DIRECTORY_CODECS.keys())
+    if len(options.threads) == 0:
+        options.threads = [1, 4, 16]
+
+    file_store = LocalFileStore()
+    work_dir = tempfile.mkdtemp(dir=options.work_dir)
+
+    try:
+        original_size = directory_size(options.directory)
+        print("original\t{} bytes".format(original_size))
+
+        for codec, threads in itertools.product(options.codec,
+            options.threads):
+
+            tarball = os.path.join(work_dir, "packed")
+            unpacked = os.path.join(work_dir, "unpacked")
+
+            start_time = timeit.default_timer()
+            write_global_directory(file_store, options.directory, tee=tarball,
+                codec=codec, threads=threads)
+            pack_time = timeit.default_timer() - start_time
+
+            packed_size = os.path.getsize(tarball)
+
+            start_time = timeit.default_timer()
+            read_global_directory(file_store, tarball, unpacked, cache=False)
+            unpack_time = timeit.default_timer() - start_time
+
+            print("{}\t{} threads\t{:.2f} s pack\t{:.2f} s unpack\t{} bytes\t"
+                "{:.3f} ratio".format(codec, threads, pack_time, unpack_time,
+                packed_size, packed_size / float(max(original_size, 1))))
+
+            os.unlink(tarball)
+            shutil.rmtree(unpacked)
+    finally:
+        shutil.rmtree(work_dir)
+
+    return 0
+
+if __name__ == "__main__" :
+    sys.exit(main(sys.argv))
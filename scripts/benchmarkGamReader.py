@@ -0,0 +1,102 @@
+#!/usr/bin/env python2.7
+"""
+benchmarkGamReader.py: compare the speed of decoding a GAM file directly with
+vglib against piping it through "vg view -aj" and parsing the JSON.
+
+Reports alignments per second for each method. Run it on a large (10M read)
+GAM to get representative numbers.
+
+"""
+
+import argparse, sys, os, os.path, random, subprocess, shutil, itertools, glob
+import doctest, re, json, collections, time, timeit
+
+from vglib import *
+
+def parse_args(args):
+    """
+    Takes in the command-line arguments list (args), and returns a nice argparse
+    result with fields for all the options.
+
+    Borrows heavily from the argparse documentation examples:
+    <http://docs.python.org/library/argparse.html>
+    """
+
+    # Construct the parser (which is stored in parser)
+    # Module docstring lives in __doc__
+    # See http://python-forum.com/pythonforum/viewtopic.php?f=3&t=36847
+    # And a formatter class so our examples in the docstring look good. Isn't it
+    # convenient how we already wrapped it to 80 characters?
+    # See http://docs.python.org/library/argparse.html#formatter-class
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # General options
+    parser.add_argument("gam",
+        help="GAM file to read")
+    parser.add_argument("--vg", default="vg",
+        help="vg binary to use for the JSON method")
+    parser.add_argument("--limit", type=int, default=None,
+        help="stop after this many alignments")
+    parser.add_argument("--method", action="append", default=[],
+        choices=["native", "json"],
+        help="only run the given methods")
+
+    # The command line arguments start with the program name, which we don't
+    # want to treat as an argument for argparse. So we remove it.
+    args = args[1:]
+
+    return parser.parse_args(args)
+
+def time_reader(alignments, limit=None):
+    """
+    Consume alignments from the given iterator, up to the given limit. Returns
+    the number of alignments read and the time taken in seconds.
+
+    """
+
+    count = 0
+    start_time = timeit.default_timer()
+    for alignment in alignments:
+        count += 1
+        if limit is not None and count >= limit:
+            break
+    end_time = timeit.default_timer()
+
+    return count, end_time - start_time
+
+def main(args):
+    """
+    Parses command line arguments and do the work of the program.
+    "args" specifies the program arguments, with args[0] being the executable
+    name. The return value should be used as the program's exit code.
+    """
+
+    if len(args) == 2 and args[1] == "--test":
+        # Run the tests
+        return doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+
+    options = parse_args(args) # This holds the nicely-parsed options object
+
+    if len(options.method) == 0:
+        # Run everything by default
+        options.method = ["native", "json"]
+
+    for method in options.method:
+        if method == "native":
+            # Decode the GAM directly
+            alignments = read_alignments(options.gam)
+        else:
+            # Do it the old way
+            alignments = read_alignments(options.gam, vg=options.vg,
+                native=False)
+
+        count, seconds = time_reader(alignments, options.limit)
+
+        print("{}\t{} alignments\t{:.2f} seconds\t{:.0f} alignments/sec".format(
+            method, count, seconds, count / seconds if seconds > 0 else 0))
+
+    return 0
+
+if __name__ == "__main__" :
+    sys.exit(main(sys.argv))
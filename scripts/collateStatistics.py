@@ -8,6 +8,7 @@ import argparse, sys, os, os.path, random, subprocess, shutil, itertools, glob
 import doctest, re, json, collections, time, timeit
 import tempfile
 import copy
+import multiprocessing.pool
 
 import numpy
 import tsv
@@ -15,6 +16,7 @@ import tsv
 from toil.job import Job
 
 from toillib import *
+from gamstats import *
 
 def parse_args(args):
     """
@@ -46,6 +48,8 @@ def parse_args(args):
         help="ignore the specified regions, graphs, or region:graph pairs")
     parser.add_argument("--overwrite", action="store_true",
         help="replace cached per-sample statistics with recalculated ones")
+    parser.add_argument("--collate_threads", type=int, default=10,
+        help="number of stats files to download and read at once per region")
     
     # The command line arguments start with the program name, which we don't
     # want to treat as an argument for argparse. So we remove it.
@@ -53,6 +57,235 @@ def parse_args(args):
         
     return parser.parse_args(args)
    
+def weighted_total(histogram):
+    """
+    Given a Histogram of a stat, return the total of the stat over everything
+    counted, as a float.
+    
+    >>> weighted_total(histogram_from_counter({"2": 3, "0.5": 2}))
+    7.0
+    
+    """
+    
+    return float(numpy.dot(histogram.values, histogram.counts))
+   
+def summarize_sample_stats(stats):
+    """
+    Given the stats dict for a sample, as loaded by load_stats_npz or
+    load_stats_json, compute the dict of summary stats by name that we plot
+    for the sample. Returns None if the sample has no reads.
+    
+    """
+    
+    # Each histogram stat is a values array and a counts array, so we can use
+    # masked sums.
+    primary_matches_per_column = stats["primary_matches_per_column"]
+    secondary_matches_per_column = stats["secondary_matches_per_column"]
+    primary_indels = stats["primary_indels"]
+    primary_substitutions = stats["primary_substitutions"]
+
+    # How many reads are mapped well enough?
+    total_mapped_well = int(primary_matches_per_column.counts[
+        primary_matches_per_column.values >= 0.95].sum())
+
+    # How many reads are multimapped well enough?
+    total_multimapped_well = int(
+        secondary_matches_per_column.counts[
+        secondary_matches_per_column.values >= 0.95].sum())
+    # How many reads multimapped at all?
+    total_multimapped_at_all = int(
+        secondary_matches_per_column.counts.sum())
+
+    # How many primary reads have MAPQs making them sufficiently
+    # unique?
+    total_unique = int(stats["primary_mapqs"].counts[
+        stats["primary_mapqs"].values >= 30].sum())
+
+    # How many reads are perfect?
+    total_perfect = int(primary_matches_per_column.counts[
+        primary_matches_per_column.values == 1.0].sum())
+
+    # How many reads have no indels?
+    total_no_indels = int(primary_indels.counts[
+        primary_indels.values == 0].sum())
+
+    # How many have any? TODO: this has always counted every read
+    # with a primary alignment, indels or not.
+    total_with_indels = int(primary_indels.counts.sum())
+
+    # How many have one? We'll guess these aren't terrible mappings.
+    total_one_indel = int(primary_indels.counts[
+        primary_indels.values == 1].sum())
+
+    # How many total substitution bases are there?
+    substitution_bases = weighted_total(primary_substitutions)
+
+    # How many total mismatches (substitutions + indels) are there?
+    mismatch_bases = weighted_total(stats["primary_mismatches"])
+
+    # How many total indels are there?
+    indel_instances = weighted_total(primary_indels)
+
+    # How many reads are mapped with no substitutions?
+    total_no_substitutions = int(primary_substitutions.counts[
+        primary_substitutions.values == 0].sum())
+
+    # What's the total matches per column for primary mappings
+    total_matches_per_column = weighted_total(
+        primary_matches_per_column)
+
+    # What's the total score?
+    total_score = weighted_total(stats["primary_scores"])
+
+    # How many reads are there overall for this sample?
+    total_reads = stats["total_reads"]
+
+    # If no reads got aligned, the sample is broken and we want to
+    # skip it (and make the user fix it).
+    if total_reads == 0:
+        return None
+
+    # How many reads are mapped at all for this sample (not just
+    # good enough)?
+    total_mapped_at_all = stats["total_mapped"]
+
+    # How many reads do we know are sufficiently unique?
+    observed_unique = stats.get("total_sufficiently_unique", 0)
+
+    # How many could we have seen if they were sufficiently unique?
+    observable = stats.get("total_secondary_visible", 0)
+
+    # What was the runtime?
+    runtime = stats.get("run_time", None)
+    if runtime is None:
+        # We need NaN floats if there's no runtime
+        runtime = float("nan")
+    else:
+        # Convert to time per read aligned
+        runtime /= total_reads
+
+    # Compute the stats we actually care about and save them
+
+    # Make the dict we want to put the computed stats in
+    sample_stats = {}
+
+    # How many reads are mapped well, single-mapped well, and
+    # existing at all? We need these for computing an overall
+    # perfect vs unique plot.
+    sample_stats["perfect"] = total_perfect
+    sample_stats["single_mapped_well"] = (total_mapped_well -
+        total_multimapped_well)
+    sample_stats["total_reads"] = total_reads
+
+    # What portion have one good mapping?
+    sample_stats["portion_single_mapped_well"] = \
+        ((total_mapped_well - total_multimapped_well) / 
+        float(total_reads))
+    # What portion only have one mapping at all?
+    sample_stats["portion_single_mapped_at_all"] = \
+        ((total_mapped_at_all - total_multimapped_at_all) / 
+        float(total_reads))
+    # What portion of reads have a mapping that thinks it's unique
+    # by MAPQ?
+    sample_stats["portion_unique"] = \
+        (observed_unique / float(observable))
+    # What portion are mapped well?
+    sample_stats["portion_mapped_well"] = (total_mapped_well /
+        float(total_reads))
+    # What portion are perfect?
+    sample_stats["portion_perfect"] = (total_perfect /
+        float(total_reads))
+    # What portion are mapped at all?
+    sample_stats["portion_mapped_at_all"] = (total_mapped_at_all / 
+        float(total_reads))
+    # What was the portion with no indels?
+    sample_stats["portion_no_indels"] = (total_no_indels / 
+        float(total_reads))
+    # And the potion mapped with indels (as opposed to unmapped)
+    # TODO: what part of this is horrible mappings with tiny scores
+    # overall?
+    sample_stats["portion_with_indels"] = (total_with_indels / 
+        float(total_reads))
+    # How many have one indel exactly?
+    sample_stats["portion_one_indel"] = (total_one_indel / 
+        float(total_reads))    
+    # And the portion with no substitutions
+    sample_stats["portion_no_substitutions"] = \
+        (total_no_substitutions / float(total_reads))
+
+    if total_mapped_at_all > 0:
+        # Some things we want to divide by the mapped reads
+
+        # What's the average matches per column for primary alignments
+        # for reads that actually aligned?
+        sample_stats["mean_matches_per_column"] = \
+            (total_matches_per_column / float(total_mapped_at_all))
+        # What's the average score for primary alignments of reads that
+        # actually aligned?
+        sample_stats["mean_score"] = \
+            (total_score / float(total_mapped_at_all))
+    else:
+        # If no reads actually mapped we can just put 0
+
+        sample_stats["mean_matches_per_column"] = 0
+        sample_stats["mean_score"] = 0
+
+    # What was the runtime?
+    sample_stats["runtime"] = runtime
+
+    try:
+        # See if we have access to these extra stats
+
+        # How many total bases of reads have primary alignments (to
+        # non-Ns)?
+        total_aligned = weighted_total(stats["aligned_lengths"])
+
+        # The aligned bases are the ones that aren't in indels or
+        # leading/trailing softclips.
+
+        # Calculate portion of aligned bases that are substitutions.
+        # Doesn't count indels at all.
+        sample_stats["substitution_rate"] = (substitution_bases /
+            float(total_aligned))
+
+        # Calculate indels per base
+        sample_stats["indel_rate"] = (indel_instances /
+            float(total_aligned))
+
+    except:
+        # Sometimes we just won't have these stats available
+        pass
+                
+    return sample_stats
+    
+def load_sample_stats(in_store, temp_dir, stats_key):
+    """
+    Download the given stats file (JSON or .npz) from the given IOStore, using
+    a new temporary file in the given directory, and summarize it. Safe to call
+    from multiple threads at once.
+    
+    Returns the summary dict from summarize_sample_stats, or None if the sample
+    has no reads.
+    
+    """
+    
+    # Get a file of our own to download to
+    handle, local_path = tempfile.mkstemp(dir=temp_dir,
+        suffix=os.path.splitext(stats_key)[1])
+    os.close(handle)
+    
+    try:
+        in_store.read_input_file(stats_key, local_path)
+        
+        if stats_key.endswith(".npz"):
+            stats = load_stats_npz(local_path)
+        else:
+            stats = load_stats_json(local_path)
+    finally:
+        os.unlink(local_path)
+        
+    return summarize_sample_stats(stats)
+    
 def collate_all(job, options):
     """
     Collate all the stats files
@@ -111,6 +344,71 @@ def collate_region(job, options, region):
     Collate all the stats files in a region. Returns a dict from graph and
     sample and stat name to stat value, which may be cached.
     
+    Only stats files that are new or have changed since the region's cache was
+    made are read again, unless --overwrite is set.
+    
+    >>> in_dir, out_dir, work_dir = [tempfile.mkdtemp() for _ in xrange(3)]
+    >>> def write_stats(name, content):
+    ...     path = os.path.join(in_dir, "stats", "brca1", "cactus", name)
+    ...     robust_makedirs(os.path.dirname(path))
+    ...     with open(path, "w") as stats_file:
+    ...         stats_file.write(content)
+    >>> for name in ["NA1.json", "NA1.npz", "NA2.json", "NA2.npz", "NA3.json"]:
+    ...     write_stats(name, "stats")
+    >>> class FakeFileStore(object):
+    ...     def getLocalTempDir(self):
+    ...         return tempfile.mkdtemp(dir=work_dir)
+    >>> class FakeJob(object):
+    ...     fileStore = FakeFileStore()
+    >>> options = argparse.Namespace(in_store=in_dir, out_store=out_dir,
+    ...     overwrite=False, blacklist=[], collate_threads=2)
+    
+    Instead of really reading the stats files, just remember which ones get
+    read.
+    
+    >>> module = sys.modules[collate_region.__module__]
+    >>> real_load_sample_stats = module.load_sample_stats
+    >>> loaded = []
+    >>> def fake_load_sample_stats(in_store, temp_dir, stats_key):
+    ...     loaded.append(stats_key)
+    ...     return {"portion_perfect": 0.9, "portion_unique": 0.8}
+    >>> module.load_sample_stats = fake_load_sample_stats
+    >>> def collate():
+    ...     del loaded[:]
+    ...     stats = collate_region(FakeJob(), options, "brca1")
+    ...     return sorted(stats["cactus"].keys()), sorted(loaded)
+    
+    The first time, everything is read, using the .npz files where there are
+    some.
+    
+    >>> collate()
+    (['NA1', 'NA2', 'NA3'], ['stats/brca1/cactus/NA1.npz',
+    'stats/brca1/cactus/NA2.npz', 'stats/brca1/cactus/NA3.json'])
+    
+    After that, the manifest lets unchanged files be skipped.
+    
+    >>> collate()
+    (['NA1', 'NA2', 'NA3'], [])
+    
+    Only samples whose .npz or JSON files change get read again.
+    
+    >>> write_stats("NA2.npz", "new stats")
+    >>> collate()
+    (['NA1', 'NA2', 'NA3'], ['stats/brca1/cactus/NA2.npz'])
+    >>> os.utime(os.path.join(in_dir, "stats", "brca1", "cactus", "NA3.json"),
+    ...     (0, 86400))
+    >>> collate()
+    (['NA1', 'NA2', 'NA3'], ['stats/brca1/cactus/NA3.json'])
+    >>> os.unlink(os.path.join(in_dir, "stats", "brca1", "cactus", "NA1.npz"))
+    >>> collate()
+    (['NA1', 'NA2', 'NA3'], ['stats/brca1/cactus/NA1.json'])
+    >>> collate()
+    (['NA1', 'NA2', 'NA3'], [])
+    
+    >>> module.load_sample_stats = real_load_sample_stats
+    >>> for path in [in_dir, out_dir, work_dir]:
+    ...     shutil.rmtree(path)
+    
     """
     
     # Set up the IO stores.
@@ -125,11 +423,23 @@ def collate_region(job, options, region):
     # <graph>\t<sample>\t<stat>\t<value> format
     cache_tsv_key = "plots/cache/{}.tsv".format(region)
     
-    # What name will it have locally for us?
+    # This is the manifest of the stats files that the cache was made from, in
+    # <graph>\t<sample>\t<file>\t<mtime>\t<size> format
+    manifest_tsv_key = "plots/cache/{}.files.tsv".format(region)
+    
+    # What names will they have locally for us?
     local_filename = os.path.join(job.fileStore.getLocalTempDir(), "temp.tsv")
+    local_manifest = os.path.join(job.fileStore.getLocalTempDir(),
+        "temp.files.tsv")
     
-    if out_store.exists(cache_tsv_key) and not options.overwrite:
-        # Just read in from that TSV
+    # This holds the (file name, mtime, size) of the stats file that each
+    # cached sample's stats came from, by (graph, sample) pair.
+    manifest = {}
+    
+    if (not options.overwrite and out_store.exists(cache_tsv_key) and
+        out_store.exists(manifest_tsv_key)):
+        # Start from the cached stats. Caches from before we kept a manifest
+        # can't be checked, so they get rebuilt.
         
         RealTimeLogger.get().info("Loading cached region {}".format(region))
         
@@ -142,253 +452,147 @@ def collate_region(job, options, region):
         for graph, sample, stat, value in reader:
             # Read in and place all the values
             stats_cache[graph][sample][stat] = float(value)
+            
+        # And grab the files they came from
+        out_store.read_input_file(manifest_tsv_key, local_manifest)
         
-    else:
+        reader = tsv.TsvReader(open(local_manifest))
+        
+        for graph, sample, filename, mtime, size in reader:
+            manifest[(graph, sample)] = (filename, mtime, size)
+            
+    # This will hold the manifest entries for everything in the new cache
+    new_manifest = {}
     
-        # We need to populate the stats cache ourselves.
-        for graph in in_store.list_input_directory("stats/{}".format(region)):
-            # For each graph
+    # This holds the graph, sample, and manifest entry for each stats file we
+    # need to read because it is new or changed.
+    to_read = []
         
-            if ("{}:{}".format(region, graph) in options.blacklist or 
-                region in options.blacklist or
-                graph in options.blacklist):
-                
-                # We don't want to process this region/graph pair.
-                RealTimeLogger.get().info("Skipping {} graph {}".format(region,
-                    graph))
-                continue
+    for graph in in_store.list_input_directory("stats/{}".format(region)):
+        # For each graph
+    
+        if ("{}:{}".format(region, graph) in options.blacklist or 
+            region in options.blacklist or
+            graph in options.blacklist):
             
-            RealTimeLogger.get().info("Processing {} graph {}".format(region,
+            # We don't want to process this region/graph pair.
+            RealTimeLogger.get().info("Skipping {} graph {}".format(region,
                 graph))
-            for result in in_store.list_input_directory("stats/{}/{}".format(
-                region, graph)):
+            continue
+        
+        RealTimeLogger.get().info("Processing {} graph {}".format(region,
+            graph))
             
-                # For every sample
-                
-                # Pull sample name from filename
-                sample_name = re.match("(.*)\.json$", result).group(1)
+        # Get all the stats files for the graph, with their sizes and
+        # modification times. Each sample has a JSON file, and may also have
+        # columnar histograms in an .npz file.
+        file_stats = in_store.stat_directory("stats/{}/{}".format(region,
+            graph))
             
-                # Grab file
-                json_filename = os.path.join(job.fileStore.getLocalTempDir(),
-                    "temp.json")
-                in_store.read_input_file("stats/{}/{}/{}".format(region, graph,
-                    result), json_filename)
-                # Read the JSON
-                stats = json.load(open(json_filename))
-                
-                # Compute the answers for this sample
-                
-                # How many reads are mapped well enough?
-                total_mapped_well = sum((
-                    stats["primary_matches_per_column"].get(x)
-                    for x in stats["primary_matches_per_column"].iterkeys()
-                    if float(x) >= 0.95))
-                    
-                # How many reads are multimapped well enough?
-                total_multimapped_well = sum((
-                    stats["secondary_matches_per_column"].get(x)
-                    for x in stats["secondary_matches_per_column"].iterkeys()
-                    if float(x) >= 0.95))
-                # How many reads multimapped at all?
-                total_multimapped_at_all = sum((
-                    stats["secondary_matches_per_column"].get(x)
-                    for x in stats["secondary_matches_per_column"].iterkeys()))
-                    
-                # How many primary reads have MAPQs making them sufficiently
-                # unique?
-                total_unique = sum((
-                    stats["primary_mapqs"].get(x)
-                    for x in stats["primary_mapqs"].iterkeys()
-                    if float(x) >= 30))
-                    
-                # How many reads are perfect?
-                total_perfect = sum((
-                    stats["primary_matches_per_column"].get(x)
-                    for x in stats["primary_matches_per_column"].iterkeys()
-                    if float(x) == 1.0))
-                    
-                # How many reads have no indels?
-                total_no_indels = sum((stats["primary_indels"].get(str(x), 0)
-                    for x in xrange(1)))
-                
-                # How many have any?    
-                total_with_indels = sum((count for indels, count in 
-                    stats["primary_indels"].iteritems() if count != "0"))
-                    
-                # How many have one? We'll guess these aren't terrible mappings.
-                total_one_indel = stats["primary_indels"].get("1", 0)
-                    
-                # How many total substitution bases are there?
-                substitution_bases = sum((count * float(weight)
-                    for weight, count in 
-                    stats["primary_substitutions"].iteritems()))
-                    
-                # How many total mismatches (substitutions + indels) are there?
-                mismatch_bases = sum((count * float(weight)
-                    for weight, count in 
-                    stats["primary_mismatches"].iteritems()))
-                    
-                # How many total indels are there?
-                indel_instances = sum((count * float(weight)
-                    for weight, count in 
-                    stats["primary_indels"].iteritems()))
-                    
-                # How many reads are mapped with no substitutions?
-                total_no_substitutions = sum(
-                    (stats["primary_substitutions"].get(str(x), 0)
-                    for x in xrange(1)))
-                    
-                # What's the total matches per column for primary mappings
-                total_matches_per_column = sum((count * float(weight)
-                    for weight, count in 
-                    stats["primary_matches_per_column"].iteritems()))
-                    
-                # What's the total score?
-                total_score = sum((count * float(weight)
-                    for weight, count in 
-                    stats["primary_scores"].iteritems()))
-                
-                # How many reads are there overall for this sample?
-                total_reads = stats["total_reads"]
+        for result in file_stats.iterkeys():
+            # For every sample
+            
+            # Pull sample name from filename
+            match = re.match("(.*)\.json$", result)
+            if match is None:
+                # This isn't a JSON file. We find the .npz files from the
+                # JSON ones.
+                continue
+            sample_name = match.group(1)
+            
+            # Use the columnar histograms if we have them, since they are
+            # much faster to load and crunch than the JSON.
+            histogram_name = "{}.npz".format(sample_name)
+            filename = (histogram_name if histogram_name in file_stats
+                else result)
+            
+            # Sizes and times go in the manifest as strings
+            size, mtime = file_stats[filename]
+            entry = (filename, mtime.isoformat() if mtime is not None else "",
+                str(size))
+            
+            if manifest.get((graph, sample_name)) == entry:
+                # We already have the stats from this exact file
+                new_manifest[(graph, sample_name)] = entry
+            else:
+                # We need to go read it
+                to_read.append((graph, sample_name, entry))
                 
+    for graph, stats_by_sample in stats_cache.items():
+        for sample in stats_by_sample.keys():
+            if not new_manifest.has_key((graph, sample)):
+                # Drop cached stats for samples that are gone, blacklisted, or
+                # about to be re-read.
+                del stats_by_sample[sample]
+        if len(stats_by_sample) == 0:
+            del stats_cache[graph]
+            
+    RealTimeLogger.get().info("Reading {} new or changed stats files for "
+        "region {} ({} cached)".format(len(to_read), region,
+        len(new_manifest)))
+        
+    # Stats files get downloaded to here
+    temp_dir = job.fileStore.getLocalTempDir()
+        
+    def read_one(item):
+        """
+        Read and summarize the stats for a (graph, sample, manifest entry) item.
+        Returns the item and the summary.
+        """
+        
+        graph, sample, (filename, _, _) = item
+        return item, load_sample_stats(in_store, temp_dir,
+            "stats/{}/{}/{}".format(region, graph, filename))
+            
+    # Download and crunch the stats files a few at a time
+    pool = multiprocessing.pool.ThreadPool(options.collate_threads)
+    
+    try:
+        for (graph, sample, entry), summary in pool.imap_unordered(read_one,
+            to_read):
+            
+            # Remember where this sample's stats came from
+            new_manifest[(graph, sample)] = entry
+            
+            if summary is None:
                 # If no reads got aligned, the sample is broken and we want to
                 # skip it (and make the user fix it).
-                if total_reads == 0:
-                    RealTimeLogger.get().warning(
-                        "No reads available for {} {} {}".format(
-                        region, graph, sample_name))
-                    continue
-                
-                # How many reads are mapped at all for this sample (not just
-                # good enough)?
-                total_mapped_at_all = stats["total_mapped"]
-                
-                # How many reads do we know are sufficiently unique?
-                observed_unique = stats.get("total_sufficiently_unique", 0)
-                
-                # How many could we have seen if they were sufficiently unique?
-                observable = stats.get("total_secondary_visible", 0)
-                
-                # What was the runtime?
-                runtime = stats.get("run_time", None)
-                if runtime is None:
-                    # We need NaN floats if there's no runtime
-                    runtime = float("nan")
-                else:
-                    # Convert to time per read aligned
-                    runtime /= total_reads
-                    
-                # Compute the stats we actually care about and save them
-                
-                # Get the dict we want to put the computed stats in
-                sample_stats = stats_cache[graph][sample_name]
-                
-                # How many reads are mapped well, single-mapped well, and
-                # existing at all? We need these for computing an overall
-                # perfect vs unique plot.
-                sample_stats["perfect"] = total_perfect
-                sample_stats["single_mapped_well"] = (total_mapped_well -
-                    total_multimapped_well)
-                sample_stats["total_reads"] = total_reads
-                
-                # What portion have one good mapping?
-                sample_stats["portion_single_mapped_well"] = \
-                    ((total_mapped_well - total_multimapped_well) / 
-                    float(total_reads))
-                # What portion only have one mapping at all?
-                sample_stats["portion_single_mapped_at_all"] = \
-                    ((total_mapped_at_all - total_multimapped_at_all) / 
-                    float(total_reads))
-                # What portion of reads have a mapping that thinks it's unique
-                # by MAPQ?
-                sample_stats["portion_unique"] = \
-                    (observed_unique / float(observable))
-                # What portion are mapped well?
-                sample_stats["portion_mapped_well"] = (total_mapped_well /
-                    float(total_reads))
-                # What portion are perfect?
-                sample_stats["portion_perfect"] = (total_perfect /
-                    float(total_reads))
-                # What portion are mapped at all?
-                sample_stats["portion_mapped_at_all"] = (total_mapped_at_all / 
-                    float(total_reads))
-                # What was the portion with no indels?
-                sample_stats["portion_no_indels"] = (total_no_indels / 
-                    float(total_reads))
-                # And the potion mapped with indels (as opposed to unmapped)
-                # TODO: what part of this is horrible mappings with tiny scores
-                # overall?
-                sample_stats["portion_with_indels"] = (total_with_indels / 
-                    float(total_reads))
-                # How many have one indel exactly?
-                sample_stats["portion_one_indel"] = (total_one_indel / 
-                    float(total_reads))    
-                # And the portion with no substitutions
-                sample_stats["portion_no_substitutions"] = \
-                    (total_no_substitutions / float(total_reads))
+                RealTimeLogger.get().warning(
+                    "No reads available for {} {} {}".format(
+                    region, graph, sample))
+                continue
                 
-                if total_mapped_at_all > 0:
-                    # Some things we want to divide by the mapped reads
+            stats_cache[graph][sample] = summary
+    finally:
+        pool.terminate()
+        pool.join()
+    
+    # Now save all these portion stats we extracted back to the cache
+    writer = tsv.TsvWriter(open(local_filename, "w"))
+    
+    for graph, stats_by_sample in stats_cache.iteritems():
+        # For each graph and all the stats for that graph
+        for sample, stats_by_name in stats_by_sample.iteritems():
+            # For each sample and all the stats for that sample
+            for stat_name, stat_value in stats_by_name.iteritems():
+                # For each stat
                 
-                    # What's the average matches per column for primary alignments
-                    # for reads that actually aligned?
-                    sample_stats["mean_matches_per_column"] = \
-                        (total_matches_per_column / float(total_mapped_at_all))
-                    # What's the average score for primary alignments of reads that
-                    # actually aligned?
-                    sample_stats["mean_score"] = \
-                        (total_score / float(total_mapped_at_all))
-                else:
-                    # If no reads actually mapped we can just put 0
-                    
-                    sample_stats["mean_matches_per_column"] = 0
-                    sample_stats["mean_score"] = 0
-                    
-                # What was the runtime?
-                sample_stats["runtime"] = runtime
-                
-                try:
-                    # See if we have access to these extra stats
-                    
-                    # How many total bases of reads have primary alignments (to
-                    # non-Ns)?
-                    total_aligned = sum((count * float(weight)
-                        for weight, count in 
-                        stats["aligned_lengths"].iteritems()))
-                        
-                    # The aligned bases are the ones that aren't in indels or
-                    # leading/trailing softclips.
-                    
-                    # Calculate portion of aligned bases that are substitutions.
-                    # Doesn't count indels at all.
-                    sample_stats["substitution_rate"] = (substitution_bases /
-                        float(total_aligned))
-                        
-                    # Calculate indels per base
-                    sample_stats["indel_rate"] = (indel_instances /
-                        float(total_aligned))
-                        
-                except:
-                    # Sometimes we just won't have these stats available
-                    pass
-                    
-        
-        # Now save all these portion stats we extracted back to the cache
-        writer = tsv.TsvWriter(open(local_filename, "w"))
+                # Save each stat value
+                writer.line(graph, sample, stat_name, stat_value)
+            
+    # Close the file and save the results for the next run
+    writer.close()
+    out_store.write_output_file(local_filename, cache_tsv_key)
+    
+    # And save the manifest of where they came from. Upload it second, so we
+    # never have a manifest claiming stats that aren't in the cache.
+    writer = tsv.TsvWriter(open(local_manifest, "w"))
+    
+    for (graph, sample), (filename, mtime, size) in new_manifest.iteritems():
+        writer.line(graph, sample, filename, mtime, size)
         
-        for graph, stats_by_sample in stats_cache.iteritems():
-            # For each graph and all the stats for that graph
-            for sample, stats_by_name in stats_by_sample.iteritems():
-                # For each sample and all the stats for that sample
-                for stat_name, stat_value in stats_by_name.iteritems():
-                    # For each stat
-                    
-                    # Save each stat value
-                    writer.line(graph, sample, stat_name, stat_value)
-                
-        # Close the file and save the results for the next run
-        writer.close()
-        out_store.write_output_file(local_filename, cache_tsv_key)        
+    writer.close()
+    out_store.write_output_file(local_manifest, manifest_tsv_key)
     
     # We want normalized and un-normalized versions of the stats cache
     stats_by_mode = {"absolute": stats_cache}
@@ -8,6 +8,7 @@ depends on callVariants.py output directory structure. Can do:
 
 import argparse, sys, os, os.path, random, subprocess, shutil, itertools, glob
 import doctest, re, json, collections, time, timeit, string, math, copy
+import multiprocessing
 from collections import defaultdict
 from Bio.Phylo.TreeConstruction import _DistanceMatrix, DistanceTreeConstructor
 from Bio import Phylo
@@ -21,7 +22,7 @@ from toillib import RealTimeLogger, robust_makedirs
 from callVariants import alignment_sample_tag, alignment_region_tag, alignment_graph_tag, run
 from callVariants import graph_path, sample_vg_path, g1k_vg_path, graph_path, sample_txt_path
 from evaluateVariantCalls import defaultdict_set
-from vcfQualStats import vcf_qual_stats, balance_tables
+from vcfQualStats import vcfeval_qual_stats, balance_tables
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description=__doc__, 
@@ -115,6 +116,9 @@ def parse_args(args):
                         help="name of the combined sample to generate")
     parser.add_argument("--tp_baseline", action="store_true", default=False,
                         help="use tp-baseline.vcf instead of tp.vcf from vcfeval output for precision and recall")
+    parser.add_argument("--tsv_processes", type=int, default=multiprocessing.cpu_count(),
+                        help="processes to read comparison results with when making tables "
+                        "(0 to read them serially, every time a table needs them)")
                             
     args = args[1:]
 
@@ -309,33 +313,46 @@ def raw_tsv_path(options, region, category, distance, sample = None):
     return os.path.join(options.comp_dir, "comp_tables_raw",
                         category + "-" + distance + "-" + rtag + ".tsv")
                         
+# parsed json comparison output by path, so jaccard, precision and recall
+# (and both orders of a pair) only read each file once per group of pairs in
+# compute_pair_distances.  None (outside a group) means don't remember anything
+comparison_json_cache = None
+
+def read_comparison_json(path):
+    """ load a json comparison output file, remembering it in
+    comparison_json_cache if we're computing a group of pairs
+    """
+    if comparison_json_cache is not None and path in comparison_json_cache:
+        return comparison_json_cache[path]
+    with open(path) as f:
+        j = json.loads(f.read())
+    if comparison_json_cache is not None:
+        comparison_json_cache[path] = j
+    return j
+
 def jaccard_dist_fn(graph1, graph2, options):
     """ scrape jaccard dist from vg compare output
     """
-    jpath = comp_path(graph1, graph2, options)
-    with open(jpath) as f:
-        j = json.loads(f.read())
-        if float(j["union"]) == 0:
-            jaccard = 2.
-        else:
-            jaccard = float(j["intersection"]) / float(j["union"])
-        return [[1. - jaccard]]
+    j = read_comparison_json(comp_path(graph1, graph2, options))
+    if float(j["union"]) == 0:
+        jaccard = 2.
+    else:
+        jaccard = float(j["intersection"]) / float(j["union"])
+    return [[1. - jaccard]]
 
 def recall_dist_fn(graph1, graph2, options):
     """ assymmetric version of above to compute recall of graph1 on graph2
     return recall to be consistent with other functions where similar is smaller. 
     """
-    jpath = comp_path(graph1, graph2, options)
-    with open(jpath) as f:
-        j = json.loads(f.read())
-        if index_path(graph2, options) == j["db2_path"]:
-            denom = float(j["db2_total"])
-        else:
-            assert index_path(graph2, options) == j["db1_path"]
-            denom = float(j["db1_total"])
-        intersection = float(j["intersection"])
-        recall = intersection / denom
-        return [[recall]]
+    j = read_comparison_json(comp_path(graph1, graph2, options))
+    if index_path(graph2, options) == j["db2_path"]:
+        denom = float(j["db2_total"])
+    else:
+        assert index_path(graph2, options) == j["db1_path"]
+        denom = float(j["db1_total"])
+    intersection = float(j["intersection"])
+    recall = intersection / denom
+    return [[recall]]
 
 def precision_dist_fn(graph1, graph2, options):
     """ get 1 - precision of graph1 on graph2
@@ -709,11 +726,9 @@ def generate_combined_vcfeval_sample(region, method, baseline_method, graphs, ba
                 run("bgzip -f {}".format(out_vcfs[i]))
                 run("tabix -f -p vcf {}.gz".format(out_vcfs[i]))
 
-            # generate the roc tables. 
-            # this is slow if clipping enabled, and would ideally get moved under toil
-            fn_table = vcf_qual_stats(out_vcfs[0] + ".gz", options.clip, ignore_keywords = ["OverlapConflict"])
-            fp_table = vcf_qual_stats(out_vcfs[1] + ".gz", options.clip_fp if options.clip_fp else options.clip)
-            tp_table = vcf_qual_stats(out_vcfs[2] + ".gz", options.clip)
+            # generate the roc tables, streaming each vcf once
+            fn_table, fp_table, tp_table = vcfeval_qual_stats(out_vcfs[0] + ".gz", out_vcfs[1] + ".gz", out_vcfs[2] + ".gz",
+                                                              options.clip, options.clip_fp)
             save_vcfeval_stats(out_vcfeval_dir, fn_table, fp_table, tp_table)
 
         # now we stick a new entry back in options tables so COMBINED gets iterated over
@@ -733,6 +748,112 @@ def generate_combined_vcfeval_sample(region, method, baseline_method, graphs, ba
         RealTimeLogger.get().warning("{}".format(str(in_vcfs)))
 
                     
+def tsv_comparisons(options):
+    """ get all the (graph1, graph2) pairs that make_tsvs will look up
+    distances for, grouped into lists by unordered pair (which share their
+    comparison output)
+    """
+    pairs = defaultdict(set)
+    def want(graph1, graph2):
+        pairs[tuple(sorted([graph1, graph2]))].add((graph1, graph2))
+
+    for region in options.sample_graphs.keys():
+        for sample in options.sample_graphs[region].keys():
+            # baseline tables (only the first platvcf truth is used)
+            for truth in options.baseline_graphs[region][sample]:
+                if options.tags[truth][2] == "platvcf":
+                    for graph in options.sample_graphs[region][sample]:
+                        want(graph, truth)
+                    break
+
+            graphs = set(options.sample_graphs[region][sample])
+            if options.orig_and_sample:
+                graphs = graphs.union(options.orig_graphs[region])
+            if options.sample or options.orig_and_sample:
+                for graph1 in graphs:
+                    for graph2 in graphs:
+                        want(graph1, graph2)
+
+        if options.orig:
+            for graph1 in options.orig_graphs[region]:
+                for graph2 in options.orig_graphs[region]:
+                    want(graph1, graph2)
+
+    return [sorted(ordered) for _, ordered in sorted(pairs.items())]
+
+# Distance worker processes keep the options and distance functions here.
+worker_options = None
+worker_dist_fns = None
+
+def init_distance_worker(options, dist_fns):
+    """ set up a process to compute distances with the given options and
+    distance functions
+    """
+    global worker_options, worker_dist_fns
+    worker_options = options
+    worker_dist_fns = dist_fns
+
+def compute_pair_distances(ordered_pairs):
+    """ compute every distance function for the given (graph1, graph2) pairs
+    (which should share comparison output, so it's only parsed once), in a
+    worker process.  returns a list of ((distance function name, graph1,
+    graph2), result) where result is the distance rows or the error message
+    string
+    """
+    global comparison_json_cache
+    results = []
+    # only share parsed files within the group, so we don't keep every parsed
+    # file in the worker
+    comparison_json_cache = dict()
+    try:
+        for graph1, graph2 in ordered_pairs:
+            for d in worker_dist_fns:
+                try:
+                    result = d(graph1, graph2, worker_options)
+                except Exception as e:
+                    result = str(e)
+                results.append(((d.__name__, graph1, graph2), result))
+    finally:
+        comparison_json_cache = None
+    return results
+
+def compute_tsv_distances(options, dist_fns):
+    """ read all the comparison outputs that make_tsvs needs, in
+    options.tsv_processes processes, and return a dict from (distance function
+    name, graph1, graph2) to result for lookup_distance
+    """
+    comparisons = tsv_comparisons(options)
+    distances = dict()
+    if options.tsv_processes <= 1:
+        init_distance_worker(options, dist_fns)
+        for ordered_pairs in comparisons:
+            distances.update(compute_pair_distances(ordered_pairs))
+    else:
+        pool = multiprocessing.Pool(options.tsv_processes, init_distance_worker,
+                                    (options, dist_fns))
+        try:
+            for results in pool.imap_unordered(compute_pair_distances, comparisons,
+                                               chunksize=max(1, len(comparisons) / (options.tsv_processes * 16))):
+                distances.update(results)
+        finally:
+            pool.terminate()
+            pool.join()
+    return distances
+
+def lookup_distance(distances, d, graph1, graph2, options):
+    """ get the distance rows for the given distance function and graphs out
+    of the distances from compute_tsv_distances, or compute them if they
+    aren't there (or distances is None).  raises an exception if they couldn't
+    be computed
+    """
+    if distances is None or (d.__name__, graph1, graph2) not in distances:
+        return d(graph1, graph2, options)
+    result = distances[(d.__name__, graph1, graph2)]
+    if isinstance(result, basestring):
+        raise RuntimeError(result)
+    # tables extend these rows in place, so hand out a copy
+    return copy.deepcopy(result)
+
 def make_tsvs(options):
     """ make some tsv files in the output dir
     """
@@ -757,6 +878,14 @@ def make_tsvs(options):
         dist_fns = [vcfeval_dist_fn]
     else:
         assert False
+
+    start_time = timeit.default_timer()
+    distances = None
+    if options.tsv_processes > 0:
+        # read each comparison once, up front, in parallel
+        distances = compute_tsv_distances(options, dist_fns)
+        RealTimeLogger.get().info("Read {} distances with {} processes in {:.2f} s".format(
+            len(distances), options.tsv_processes, timeit.default_timer() - start_time))
         
     # break apart by region
     for region in options.sample_graphs.keys():
@@ -776,7 +905,7 @@ def make_tsvs(options):
                             rows = []
                             for d in dist_fns:
                                 try:
-                                    dist_res = d(graph, truth, options)
+                                    dist_res = lookup_distance(distances, d, graph, truth, options)
                                 except Exception as e:
                                     RealTimeLogger.get().warning("Unable to retrieve distance between {} and {} because {}".format(graph, truth, e))
                                     dist_res = [[None] * len(header)]
@@ -807,7 +936,7 @@ def make_tsvs(options):
                     for graph1 in options.sample_graphs[region][sample]:
                         for graph2 in options.sample_graphs[region][sample]:
                             try:
-                                dist_res = d(graph1, graph2, options)
+                                dist_res = lookup_distance(distances, d, graph1, graph2, options)
                             except Exception as e:
                                 RealTimeLogger.get().warning("Unable to retrieve distance between {} and {} because {}".format(graph1, graph2, e))
                                 dist_res = [[None] * len(header)]
@@ -844,7 +973,7 @@ def make_tsvs(options):
                 for graph1 in options.orig_graphs[region]:
                     for graph2 in options.orig_graphs[region]:
                         try:
-                            dist_res = d(graph1, graph2, options)
+                            dist_res = lookup_distance(distances, d, graph1, graph2, options)
                         except Exception as e:
                             RealTimeLogger.get().warning("Unable to retrieve distance between {} and {} because {}".format(graph1, graph2, e))
                             dist_res = [[None] * len(header)]
@@ -878,7 +1007,7 @@ def make_tsvs(options):
                     for graph1 in options.sample_graphs[region][sample].union(options.orig_graphs[region]):
                         for graph2 in options.sample_graphs[region][sample].union(options.orig_graphs[region]):
                             try:
-                                dist_res = d(graph1, graph2, options)
+                                dist_res = lookup_distance(distances, d, graph1, graph2, options)
                             except Exception as e:
                                 RealTimeLogger.get().warning("Unable to retrieve distance between {} and {} because {}".format(graph1, graph2, e))
                                 dist_res = [[None] * len(header)]
@@ -916,8 +1045,11 @@ def make_tsvs(options):
                 clean_mat, clean_header, clean_row_labels = remove_nones(mat, header, row_labels)
                 tsv_path = out_tsv_path(options, region, "hm-orig_and_sample", dist_names[di])
                 write_tsv(tsv_path, clean_mat, clean_header, clean_row_labels, "Graph")
-                
-        
+
+    # compare with --tsv_processes 0 for the old serial timing
+    RealTimeLogger.get().info("Made {} tables in {:.2f} s".format(
+        options.comp_type, timeit.default_timer() - start_time))
+
 def write_tsv(out_path, mat, col_names, row_names, row_label):
     """ write tsv distance matrx
     """
@@ -1210,9 +1342,8 @@ def compute_vcf_comparison(job, graph1, graph2, options):
             tp_path = os.path.join(out_path, "{}.vcf.gz".format(tp_name))
 
             try:
-                fn_table = vcf_qual_stats(fn_path, options.clip, ignore_keywords = ["OverlapConflict"])
-                fp_table = vcf_qual_stats(fp_path, options.clip_fp if options.clip_fp else options.clip)
-                tp_table = vcf_qual_stats(tp_path, options.clip)
+                fn_table, fp_table, tp_table = vcfeval_qual_stats(fn_path, fp_path, tp_path,
+                                                                  options.clip, options.clip_fp)
                 save_vcfeval_stats(out_path, fn_table, fp_table, tp_table)
             except:
                 pass
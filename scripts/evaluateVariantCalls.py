@@ -454,60 +454,37 @@ def downloadTruth(job, options, sample_name, region_name,
     unnormalized_vcf_file = os.path.join(job.fileStore.getLocalTempDir(),
         "unnormalized.vcf")
         
-    with open(local_filename, "w") as vcf_file:
-        # Open it for writing, and download and normalize into it
-        
-        # TODO: Go back to Glenn's optionalFilterVCF when I can actually run a
-        # real-time text editor
-
-        # Hold all the popen objects we need for this
-        tasks = []
-        
-        # Download the region to the file. TODO: 1-based or 0-based range?
-        tasks.append(subprocess.Popen(["bcftools", "view",
-            options.truth_url.format(sample_name), "-r",
-            "{}:{}-{}".format(ref_name, ref_start, ref_end)],
-            stdout=subprocess.PIPE))
-    
-        if options.filter:
-            cmds = []
-            cmds.append(["scripts/vcfFilterIndels.py", "-"])
-            cmds[-1].append("--qual")
-            tasks.append(subprocess.Popen(cmds[-1], stdin=tasks[-1].stdout,
-                                          stdout=subprocess.PIPE))
+    # Download and normalize into the file
+    
+    # TODO: Go back to Glenn's optionalFilterVCF when I can actually run a
+    # real-time text editor
 
+    # Hold all the commands we need for this
+    commands = []
+    
+    # Download the region to the file. TODO: 1-based or 0-based range?
+    commands.append(["bcftools", "view",
+        options.truth_url.format(sample_name), "-r",
+        "{}:{}-{}".format(ref_name, ref_start, ref_end)])
 
-        # TODO: having a tee in here makes the job never finish
-        #tasks.append(subprocess.Popen(["tee", unnormalized_vcf_file],
-        #    stdin=tasks[-1].stdin, stdout=subprocess.PIPE))
+    if options.filter:
+        commands.append(["scripts/vcfFilterIndels.py", "-", "--qual"])
 
-        # Decompose multiallelic since decompose_blocksub messes up their genotypes
-        tasks.append(subprocess.Popen(["vt", "decompose",
-            "-"], stdin=tasks[-1].stdout, stdout=subprocess.PIPE))
-        
-        # Decompose horizontally (breaking variants) with vt
-        # Make sure to use aggressive alignment
-        tasks.append(subprocess.Popen(["vt", "decompose_blocksub", "-a",
-            "-"], stdin=tasks[-1].stdout, stdout=subprocess.PIPE))
-        
-        # Then normalize (which requires the reference) and write to the file
-        tasks.append(subprocess.Popen(["vt", "normalize", "-r", reference_fasta,
-            "-"], stdin=tasks[-1].stdout, stdout=vcf_file))
-            
-        # Did we make it through all the tasks OK?
-        for i, task in enumerate(tasks):
-            if task.wait() != 0:
-                raise RuntimeError("Pipeline step {} returned {}".format(i,
-                    task.returncode))
-                    
-        # Flush and sync
-        vcf_file.flush()
-        os.fsync(vcf_file.fileno())
+    # TODO: having a tee in here makes the job never finish
+    #commands.append(["tee", unnormalized_vcf_file])
 
-    # Wait for stuff to be on disk, because sometimes flush and sync maybe
-    # doesn't work? Actually I just don't trust the filesystem spec on inter-
-    # process consistency.
-    time.sleep(1)
+    # Decompose multiallelic since decompose_blocksub messes up their genotypes
+    commands.append(["vt", "decompose", "-"])
+    
+    # Decompose horizontally (breaking variants) with vt
+    # Make sure to use aggressive alignment
+    commands.append(["vt", "decompose_blocksub", "-a", "-"])
+    
+    # Then normalize (which requires the reference) and write to the file
+    commands.append(["vt", "normalize", "-r", reference_fasta, "-"])
+    
+    # This makes sure it's all on disk before we count it
+    run_pipeline(commands, stdout=local_filename)
 
     # Count the variants
     variant_count = 0
@@ -536,6 +513,47 @@ def downloadTruth(job, options, sample_name, region_name,
     
     return file_id
    
+class DroppedBasesScanner(object):
+    """
+    Stands in for a standard error stream for run_pipeline, passing everything
+    through to the real stream, and picking out how many bases of
+    unrepresentable variation glenn2vcf says it dropped.
+    
+    """
+    
+    def __init__(self, stream):
+        """
+        Pass lines through to the given stream.
+        """
+        
+        self.stream = stream
+        # This holds the number of bases dropped, once we see it
+        self.bases_dropped = None
+        
+    def write(self, line):
+        """
+        Look at and pass through a line of standard error.
+        """
+        
+        # Look for the line listing dropped bases
+        match = re.match(
+            "Had to drop ([0-9]+) bp of unrepresentable variation.", line)
+            
+        if match:
+            # We found the right line, parse out the base count
+            self.bases_dropped = int(match.group(1))
+            
+        # Pass the line through to our standard error in case something goes
+        # wrong.
+        self.stream.write(line)
+        
+    def flush(self):
+        """
+        Flush the real stream.
+        """
+        
+        self.stream.flush()
+        
 def convertGlennToVcf(job, options, sample_name, glenn_file_key, graph_file_id,
     reference_id, reference_index_id, vcf_file_key, ref_name, ref_start):
     """
@@ -582,87 +600,48 @@ def convertGlennToVcf(job, options, sample_name, glenn_file_key, graph_file_id,
     local_vcf_file = os.path.join(job.fileStore.getLocalTempDir(),
         "out.vcf")
         
-    # Open it for writing
-    vcf_file = open(local_vcf_file, "w")
-    
     # Run the conversion, send stdout to the file, and give us stderr.
     # "ref_name" is actually the name we *want* to have after conversion, not
     # the name we have now.
     
-    RealTimeLogger.get().info("Starting glenn2vcf")
-    
     # TODO: we subtract 1 off the ref start here because we agree at all with
     # the truth set VCF only if we do that. I'm not sure where exactly we're
     # fixing a coordinate mis-conversion.
     command = ["glenn2vcf", local_graph_file, local_glenn_file, "--contig",
         ref_name, "--offset", str(ref_start - 1), "--sample", sample_name]
-    conversion = subprocess.Popen(command,
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-    RealTimeLogger.get().info("Started glenn2vcf")
-    
-    # Start up some postprocessing vt normalization steps
-    tasks = [conversion]
+    commands = [command]
     
+    # Then some postprocessing vt normalization steps
     if options.filter:
-            cmds = []
-            cmds.append(["scripts/vcfFilterIndels.py", "-"])
-            tasks.append(subprocess.Popen(cmds[-1], stdin=tasks[-1].stdout,
-                                          stdout=subprocess.PIPE))
-
-    # Tee off into a temp file so we can see the unprocessed converted vcf
-    unnormalized_vcf_file = os.path.join(job.fileStore.getLocalTempDir(),
-        "unnormalized.vcf")
-    #tasks.append(subprocess.Popen(["tee", unnormalized_vcf_file],
-    #    stdin=tasks[-1].stdin, stdout=subprocess.PIPE))
-    
+        commands.append(["scripts/vcfFilterIndels.py", "-"])
+        
     # Decompose horizontally (breaking variants) with vt
     # Make sure to use aggressive alignment
-    tasks.append(subprocess.Popen(["vt", "decompose_blocksub", "-a",
-        "-"], stdin=tasks[-1].stdout, stdout=subprocess.PIPE))
+    commands.append(["vt", "decompose_blocksub", "-a", "-"])
     
     # Then normalize (which requires the reference) and write to the file
-    tasks.append(subprocess.Popen(["vt", "normalize", "-r",
-        local_reference_fasta, "-"], stdin=tasks[-1].stdout, stdout=vcf_file))
-        
-    # How many unrepresentable bases were dropped?
-    bases_dropped = None
+    commands.append(["vt", "normalize", "-r", local_reference_fasta, "-"])
+    
+    # Watch standard error for how many unrepresentable bases were dropped
+    dropped_bases_scanner = DroppedBasesScanner(sys.stderr)
+    
+    RealTimeLogger.get().info("Starting glenn2vcf")
+    
+    try:
+        run_pipeline(commands, stdout=local_vcf_file,
+            stderr=dropped_bases_scanner)
+    except RuntimeError as e:
+        # Complain if the conversion fails
         
-    for line in conversion.stderr:
-        # Look for the line listing dropped bases
-        match = re.match(
-            "Had to drop ([0-9]+) bp of unrepresentable variation.", line)
-            
-        if match:
-            # We found the right line, parse out the base count
-            bases_dropped = int(match.group(1))
-            
-        # Pass the line through to our standard error in case something goes
-        # wrong.
-        sys.stderr.write(line)
+        # Save the files that confused us
+        out_store.write_output_file(local_graph_file, "error/graph.vg")
+        out_store.write_output_file(local_glenn_file, "error/glenn.txt")
+        out_store.write_output_file(local_reference_fasta, "error/ref.fa")
         
-    # Did we make it through all the subsequent tasks OK?
-    for i, task in enumerate(tasks):
-        if task.wait() != 0:
-            # Complain if the conversion fails
-            
-            # Save the files that confused us
-            out_store.write_output_file(local_graph_file, "error/graph.vg")
-            out_store.write_output_file(local_glenn_file, "error/glenn.txt")
-            out_store.write_output_file(local_reference_fasta, "error/ref.fa")
+        raise RuntimeError("VCF conversion for {} via glenn2vcf command '{}' "
+            "failed: {}".format(glenn_file_key, " ".join(command), e))
             
-            raise RuntimeError("VCF conversion task {} for {} via glenn2vcf "
-                "command '{}' returned {}".format(i, glenn_file_key,
-                " ".join(command), task.returncode))
-    
-    vcf_file.flush()
-    os.fsync(vcf_file.fileno())       
-    vcf_file.close()
-    
-    # Wait for stuff to be on disk, because sometimes flush and sync maybe
-    # doesn't work? Actually I just don't trust the filesystem spec on inter-
-    # process consistency.
-    time.sleep(1)
+    bases_dropped = dropped_bases_scanner.bases_dropped
     
     RealTimeLogger.get().info("Upload results...")
     
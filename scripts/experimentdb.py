@@ -0,0 +1,338 @@
+"""
+experimentdb.py: a single-file SQLite store for variant calling experiment
+results.
+
+variantCallingExperiment.py tries a lot of conditions (combinations of read
+filtering, pileup, calling, and VCF conversion options) on a lot of samples.
+Each condition gets a max F score and a vcfeval ROC curve per region, graph, and
+sample, and each stage it runs takes some time. All of that goes in here, so
+picking the best condition, or looking at the results some other way, doesn't
+mean re-running the Toil workflow or re-reading every ROC from the cache.
+
+Conditions are keyed by ExperimentCondition.get_key(), and stored with their
+options, so they can be rebuilt without the cache. Results are also keyed by a
+scope string identifying the inputs and cache they were computed from, so
+pointing an experiment at new alignments or a fresh cache doesn't reuse old
+scores.
+
+"""
+
+import sys, os, os.path, json, collections, sqlite3, tempfile, shutil
+
+# This is the schema for a results database. Results are keyed by scope,
+# condition key, and the region, graph, and sample (GAM file name) they were
+# run on. Stage timings are only used for planning, so they aren't scoped.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conditions (
+    condition_key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    options TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    scope TEXT NOT NULL,
+    condition_key TEXT NOT NULL REFERENCES conditions (condition_key),
+    region TEXT NOT NULL,
+    graph TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    max_f REAL,
+    roc TEXT,
+    PRIMARY KEY (scope, condition_key, region, graph, sample)
+);
+CREATE TABLE IF NOT EXISTS stage_timings (
+    region TEXT NOT NULL,
+    graph TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    stage_name TEXT NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_by_sample ON results (scope, region, graph,
+    sample);
+"""
+
+def where_clause(regions=None, graphs=None, samples=None, scope=None):
+    """
+    Make an SQL WHERE clause (or an empty string) and a list of parameters for
+    it, restricting to the given lists of regions, graphs, and samples, and the
+    given scope. None means no restriction.
+
+    >>> where_clause()
+    ('', [])
+    >>> where_clause(regions=["brca1", "mhc"], samples=["NA12878.gam"])
+    ('WHERE region IN (?, ?) AND sample IN (?)', ['brca1', 'mhc', 'NA12878.gam'])
+    >>> where_clause(scope="s1")
+    ('WHERE scope IN (?)', ['s1'])
+
+    """
+
+    clauses = []
+    parameters = []
+    for column, values in [("region", regions), ("graph", graphs),
+        ("sample", samples), ("scope", None if scope is None else [scope])]:
+
+        if values is None:
+            continue
+        clauses.append("{} IN ({})".format(column,
+            ", ".join("?" for _ in values)))
+        parameters += list(values)
+
+    if len(clauses) == 0:
+        return "", parameters
+    return "WHERE " + " AND ".join(clauses), parameters
+
+class ResultsDatabase(object):
+    """
+    Stores experiment results in an SQLite file. Results are added in bulk, in
+    one transaction per call.
+
+    >>> db = ResultsDatabase(":memory:")
+    >>> db.add_conditions([("c1", "loose", [{"-r": 0}]),
+    ...     ("c2", "strict", [{"-r": 0.97}])])
+    >>> db.add_results([
+    ...     ("s1", "c1", "brca1", "cactus", "NA1.gam", 0.9, [[1, 0.9]]),
+    ...     ("s1", "c1", "brca1", "cactus", "NA2.gam", 0.7, [[1, 0.7]]),
+    ...     ("s1", "c2", "brca1", "cactus", "NA1.gam", 0.95, [[1, 0.95]]),
+    ...     ("s2", "c2", "brca1", "cactus", "NA2.gam", 0.1, None)])
+    >>> db.rank_conditions(scope="s1")
+    [(u'c1', 0.8, 2)]
+    >>> db.rank_conditions()
+    [(u'c1', 0.8, 2), (u'c2', 0.525, 2)]
+    >>> db.rank_conditions(samples=["NA1.gam"])
+    [(u'c2', 0.95, 1), (u'c1', 0.9, 1)]
+    >>> db.rank_conditions(condition_keys=["c2"], scope="s1")
+    [(u'c2', 0.95, 1)]
+    >>> db.scopes()
+    [u's1', u's2']
+    >>> db.scopes(samples=["NA1.gam"])
+    [u's1']
+    >>> db.f_scores(scope="s1")["brca1/cactus/NA2.gam"]
+    {u'c1': 0.7}
+    >>> db.f_scores(scope="s3")
+    {}
+    >>> db.get_condition("c2")
+    (u'strict', [{u'-r': 0.97}])
+    >>> db.get_roc("c1", "brca1", "cactus", "NA2.gam", scope="s1")
+    [[1, 0.7]]
+    >>> db.add_stage_timings([("brca1", "cactus", "NA1.gam", "pileup", "a", 10),
+    ...     ("brca1", "cactus", "NA2.gam", "pileup", "a", 20)])
+    >>> db.stage_seconds()
+    {u'pileup': 15.0}
+
+    """
+
+    def __init__(self, filename):
+        """
+        Open (or create) the results database in the given file.
+        """
+
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(SCHEMA)
+
+        columns = [row[1] for row in
+            self.connection.execute("PRAGMA table_info(results)")]
+        if "scope" not in columns:
+            raise RuntimeError("Results database {} has no result scopes; it "
+                "was made by an older version and can't be added to".format(
+                filename))
+
+    def close(self):
+        """
+        Close the database.
+        """
+
+        self.connection.close()
+
+    def add_conditions(self, conditions):
+        """
+        Save the given (condition key, condition name, options) tuples, where
+        the options are any JSON-able object. Conditions already in the database
+        are left alone.
+
+        """
+
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO conditions "
+                "VALUES (?, ?, ?)", ((key, name, json.dumps(options))
+                for key, name, options in conditions))
+
+    def add_results(self, results):
+        """
+        Save the given (scope, condition key, region, graph, sample, max F
+        score, ROC) tuples, replacing any old results for the same scope,
+        condition, and sample. The ROC is a list of rows, or None if we don't
+        have it.
+
+        """
+
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO results "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", ((scope, key, region, graph,
+                sample, max_f, None if roc is None else json.dumps(roc))
+                for scope, key, region, graph, sample, max_f, roc in results))
+
+    def add_stage_timings(self, timings):
+        """
+        Save the given (region, graph, sample, stage, stage condition name,
+        seconds) tuples, for stages that were actually run.
+
+        """
+
+        with self.connection:
+            self.connection.executemany("INSERT INTO stage_timings "
+                "VALUES (?, ?, ?, ?, ?, ?)", timings)
+
+    def get_condition(self, condition_key):
+        """
+        Return the name and options for the condition with the given key, or
+        None if it isn't stored.
+
+        """
+
+        row = self.connection.execute("SELECT name, options FROM conditions "
+            "WHERE condition_key = ?", (condition_key,)).fetchone()
+        if row is None:
+            return None
+        return (row[0], json.loads(row[1]))
+
+    def condition_clause(self, where, condition_keys):
+        """
+        Extend the given WHERE clause to only match the given condition keys,
+        if not None. The keys go in a temporary table, since there can be more
+        of them than SQLite allows query parameters.
+
+        """
+
+        if condition_keys is None:
+            return where
+
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS "
+            "wanted_conditions (condition_key TEXT PRIMARY KEY)")
+        with self.connection:
+            self.connection.execute("DELETE FROM wanted_conditions")
+            self.connection.executemany("INSERT OR IGNORE INTO "
+                "wanted_conditions VALUES (?)", ((key,) for key in
+                condition_keys))
+
+        clause = ("condition_key IN (SELECT condition_key FROM "
+            "wanted_conditions)")
+        if where == "":
+            return "WHERE " + clause
+        return where + " AND " + clause
+
+    def scopes(self, regions=None, graphs=None, samples=None):
+        """
+        Return a sorted list of the results scopes that have results for the
+        given regions, graphs, and samples (or any of them).
+        
+        """
+        
+        where, parameters = where_clause(regions, graphs, samples)
+        
+        return [row[0] for row in self.connection.execute("SELECT DISTINCT "
+            "scope FROM results " + where + " ORDER BY scope", parameters)]
+        
+    def f_scores(self, regions=None, graphs=None, samples=None, scope=None):
+        """
+        Return a dict from "<region>/<graph>/<sample>" to a dict from condition
+        key to max F score, for the given regions, graphs, and samples (or all
+        of them), in the given scope (or any scope).
+
+        """
+
+        where, parameters = where_clause(regions, graphs, samples, scope)
+
+        scores = collections.defaultdict(dict)
+        for key, region, graph, sample, max_f in self.connection.execute(
+            "SELECT condition_key, region, graph, sample, max_f FROM results " +
+            where, parameters):
+
+            scores["{}/{}/{}".format(region, graph, sample)][key] = max_f
+
+        return dict(scores)
+
+    def rank_conditions(self, regions=None, graphs=None, samples=None,
+        condition_keys=None, scope=None):
+        """
+        Return (condition key, average max F score, sample count) tuples, best
+        first, for the conditions run on the most of the given regions, graphs,
+        and samples (or all of them). If condition_keys is given, only those
+        conditions are ranked, so results from other experiments' grids don't
+        count. If scope is given, only results in that scope count.
+
+        Conditions run on fewer samples than the others (like those dropped
+        early in a halving search) aren't compared, since they could win by
+        doing well on just a few easy samples.
+
+        """
+
+        where, parameters = where_clause(regions, graphs, samples, scope)
+        where = self.condition_clause(where, condition_keys)
+
+        rows = self.connection.execute("SELECT condition_key, AVG(max_f), "
+            "COUNT(*) AS samples FROM results " + where + " GROUP BY "
+            "condition_key ORDER BY samples DESC, AVG(max_f) DESC, "
+            "condition_key", parameters).fetchall()
+
+        return [row for row in rows if row[2] == rows[0][2]]
+
+    def get_roc(self, condition_key, region, graph, sample, scope=None):
+        """
+        Return the ROC curve rows stored for the given condition and sample, in
+        the given scope (or any scope), or None if we don't have them.
+
+        """
+
+        where, parameters = where_clause([region], [graph], [sample], scope)
+        row = self.connection.execute("SELECT roc FROM results " + where +
+            " AND condition_key = ? AND roc IS NOT NULL",
+            parameters + [condition_key]).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def stage_seconds(self):
+        """
+        Return a dict from stage to the average seconds it took to run.
+        """
+
+        return dict(self.connection.execute("SELECT stage, AVG(seconds) FROM "
+            "stage_timings GROUP BY stage"))
+
+    def export(self, filename, condition_keys=None, scope=None):
+        """
+        Copy the results for the given condition keys (or all of them) in the
+        given scope (or all scopes) into a new results database in the given
+        file, along with all the stage timings.
+
+        >>> db = ResultsDatabase(":memory:")
+        >>> db.add_conditions([("c1", "a", []), ("c2", "b", [])])
+        >>> db.add_results([("s1", "c1", "r", "g", "s", 0.5, None),
+        ...     ("s1", "c2", "r", "g", "s", 0.6, [[1]]),
+        ...     ("s2", "c2", "r", "g", "s", 0.7, [[1]])])
+        >>> out_dir = tempfile.mkdtemp()
+        >>> db.export(os.path.join(out_dir, "out.db"), ["c2"], "s1")
+        >>> ResultsDatabase(os.path.join(out_dir, "out.db")).f_scores()
+        {'r/g/s': {u'c2': 0.6}}
+        >>> shutil.rmtree(out_dir)
+
+        """
+
+        where = self.condition_clause("", condition_keys)
+        result_where, parameters = where_clause(scope=scope)
+        result_where = self.condition_clause(result_where, condition_keys)
+
+        exported = ResultsDatabase(filename)
+        try:
+            with exported.connection:
+                exported.connection.executemany("INSERT OR REPLACE INTO "
+                    "conditions VALUES (?, ?, ?)", self.connection.execute(
+                    "SELECT * FROM conditions " + where).fetchall())
+                exported.connection.executemany("INSERT OR REPLACE INTO "
+                    "results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    self.connection.execute("SELECT * FROM results " +
+                    result_where, parameters).fetchall())
+                exported.connection.executemany("INSERT INTO stage_timings "
+                    "VALUES (?, ?, ?, ?, ?, ?)", self.connection.execute(
+                    "SELECT * FROM stage_timings").fetchall())
+        finally:
+            exported.close()
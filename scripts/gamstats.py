@@ -0,0 +1,988 @@
+"""
+gamstats.py: one stats engine for vg alignments (GAM files).
+
+The mapping evaluation, the calling evaluation, and redoStats.py all compute
+histograms over the alignments in a GAM file. They all do it here, so there is
+only one edit-walking hot path to profile and optimize.
+
+A StatsEngine reads alignments, works out the per-alignment edit stats (matches,
+indels, substitutions, aligned bases and alignment columns, discounting
+reference Ns), and feeds each alignment to a set of pluggable StatsCollectors.
+Each collector fills in some of the keys of the final stats dict, and declares
+which alignment fields it needs, so the GAM decoder can skip everything else.
+
+"""
+
+import sys, os, os.path, json, collections, itertools, string
+import multiprocessing
+
+import numpy
+
+from vglib import *
+
+# Reverse complement needs a global translation table
+reverse_complement_translation_table = string.maketrans("ACGTN", "TGCAN")
+def reverse_complement(sequence):
+    """
+    Compute the reverse complement of a DNA sequence.
+
+    Follows algorithm from <http://stackoverflow.com/a/26615937>
+    """
+
+    if isinstance(sequence, unicode):
+        # Encode the sequence in ASCII for easy translation
+        sequence = sequence.encode("ascii", "replace")
+
+    # Translate and then reverse
+    return sequence.translate(reverse_complement_translation_table)[::-1]
+
+def count_Ns(sequence):
+    """
+    Return the number of N bases in the given DNA sequence
+    """
+
+    n_count = 0
+    for item in sequence:
+        if item == "N":
+            n_count += 1
+
+    return n_count
+
+def alignment_edit_stats(alignment, node_sequences):
+    """
+    Walk the edits of the given aligned Alignment record against the reference
+    sequences from the given node sequence store or dict. Returns the number
+    of matches, indels, substitutions, aligned bases, and alignment columns.
+
+    If node_sequences is None, the reference is taken to have no Ns at all.
+
+    This is the reference implementation for edit_stats_kernel in vglib, which
+    must produce exactly the same results.
+
+    >>> store = NodeSequenceStore.from_nodes([(1, "ACGNNT"), (2, "GGNA")])
+    >>> alignments = [
+    ...     Alignment(score=1, mappings=[Mapping(1, 0, False,
+    ...         [Edit(3, 3, None), Edit(3, 3, "ACG")])]),
+    ...     Alignment(score=1, mappings=[Mapping(1, 2, True,
+    ...         [Edit(0, 2, "TT"), Edit(2, 2, None), Edit(2, 0, None)]),
+    ...         Mapping(2, 1, False, [Edit(1, 1, "C"), Edit(0, 1, "A"),
+    ...         Edit(2, 2, None), Edit(0, 3, "AAA")])]),
+    ...     Alignment(score=1, mappings=[Mapping(None, 0, False,
+    ...         [Edit(0, 4, "ACGT")]), Mapping(2, 9, True, [Edit(2, 2, "AC")]),
+    ...         Mapping(1, 5, False, [Edit(3, 1, "A")]), Mapping(2, 0, True,
+    ...         [])]),
+    ...     Alignment()]
+    >>> [alignment_edit_stats(a, store) for a in alignments[:3]]
+    [(3, 0, 1, 4, 4), (4, 2, 1, 3, 11), (0, 1, 2, 2, 9)]
+    >>> edit_stats_kernel(flatten_edits(alignments), store)
+    [(3, 0, 1, 4, 4), (4, 2, 1, 3, 11), (0, 1, 2, 2, 9), (0, 0, 0, 0, 0)]
+    >>> [alignment_edit_stats(a, None) for a in alignments[:3]]
+    [(3, 0, 3, 6, 6), (4, 2, 1, 5, 13), (0, 1, 2, 2, 9)]
+
+    """
+
+    # Get the mappings
+    mappings = alignment.mappings
+
+    # Calculate the exact match bases
+    matches = 0
+
+    # And total up the instances of indels (only counting those where
+    # the reference has no Ns, and which aren't leading or trailing soft
+    # clips)
+    indels = 0
+
+    # And total up the number of substitutions (mismatching/alternative
+    # bases in edits with equal lengths where the reference has no Ns).
+    substitutions = 0
+
+    # What should the denominator for substitution rate be for this
+    # read? How many bases are in the read and aligned?
+    aligned_length = 0
+
+    # How many total columns are there in the alignment?
+    alignment_columns = 0
+
+    for mapping_number, mapping in enumerate(mappings):
+        # Figure out what the reference sequence for this mapping should
+        # be
+
+        if mapping.node_id is not None and node_sequences is not None:
+            # We actually are mapped to a reference node
+            ref_sequence = node_sequences[mapping.node_id]
+
+            # Grab the offset
+            offset = mapping.offset
+
+            if mapping.is_reverse:
+                # We start at the offset base on the reverse strand.
+                # This means we count from the end.
+                # But if offset is 0 we take the whole thing.
+                ref_sequence = reverse_complement(
+                    ref_sequence[0:-offset] if offset != 0
+                    else ref_sequence)
+            else:
+                # Just clip so we start at the specified offset
+                ref_sequence = ref_sequence[offset:]
+
+        else:
+            # We're aligned against no node (and thus must be all insertions),
+            # or we have no reference to look at. Either way there are no Ns
+            # to find.
+            ref_sequence = ""
+
+        # Start at the beginning of the reference sequence for the
+        # mapping.
+        index_in_ref = 0
+
+        # Pull out the edits
+        edits = mapping.edits
+
+        for edit_number, edit in enumerate(edits):
+            # An edit may be a soft clip if it's either the first edit
+            # in the first mapping, or the last edit in the last
+            # mapping. This flag stores whether that is the case
+            # (although to actually be a soft clip it also has to be an
+            # insertion, and not either a substitution or a perfect
+            # match as spelled by the aligner).
+            may_be_soft_clip = ((edit_number == 0 and
+                mapping_number == 0) or
+                (edit_number == len(edits) - 1 and
+                mapping_number == len(mappings) - 1))
+
+            # Count up the Ns in the reference sequence for the edit. We
+            # get the part of the reference string that should belong to
+            # this edit.
+            reference_N_count = count_Ns(ref_sequence[
+                index_in_ref:index_in_ref + edit.from_length])
+
+            # Count up the columns, which is the max of the from and to
+            # lengths, but discounting any columns where the reference
+            # has an N.
+            alignment_columns += max(edit.to_length,
+                edit.from_length) - reference_N_count
+
+            if edit.to_length == edit.from_length:
+                # Add in the length of this edit if it's actually
+                # aligned (not an indel or softclip).
+                # Make sure not to count Ns in the reference.
+                aligned_length += (edit.to_length -
+                    reference_N_count)
+
+            if (edit.sequence is None and
+                edit.to_length == edit.from_length):
+                # The edit has equal from and to lengths, but no
+                # sequence provided.
+
+                # We found a perfect match edit. Grab its length
+                matches += edit.from_length
+
+                # We don't care about Ns when evaluating perfect
+                # matches. VG already split out any mismatches into non-
+                # perfect matches, and we ignore the N-matched-to-N
+                # case.
+
+            if (not may_be_soft_clip and
+                edit.to_length != edit.from_length):
+                # This edit is an indel and isn't on the very end of a
+                # read.
+                if reference_N_count == 0:
+                    # Only count the indel if it's not against an N in
+                    # the reference
+                    indels += 1
+
+            if (edit.to_length == edit.from_length and
+                edit.sequence is not None):
+                # The edit has equal from and to lengths, and a provided
+                # sequence. This edit is thus a SNP or MNP. It
+                # represents substitutions.
+
+                # We take as substituted all the bases except those
+                # opposite reference Ns. Sequence Ns are ignored.
+                substitutions += edit.to_length - reference_N_count
+
+            # We still count query Ns as "aligned" when not in indels
+
+            # Advance in the reference sequence
+            index_in_ref += edit.from_length
+
+    return (matches, indels, substitutions, aligned_length, alignment_columns)
+
+def with_edit_stats(alignments, node_sequences, batch_size=10000):
+    """
+    Yield each Alignment record from the given iterable, paired with its edit
+    stats tuple as computed by alignment_edit_stats (or None for unaligned
+    alignments).
+
+    If node_sequences is a NodeSequenceStore, the edit stats are computed in
+    batches with edit_stats_kernel. Otherwise, they are computed one alignment
+    at a time.
+
+    """
+
+    alignments = iter(alignments)
+
+    while True:
+        batch = list(itertools.islice(alignments, batch_size))
+        if len(batch) == 0:
+            break
+
+        if isinstance(node_sequences, NodeSequenceStore):
+            # Do the whole batch at once
+            batch_stats = edit_stats_kernel(flatten_edits(batch),
+                node_sequences)
+        else:
+            # Do each alignment individually
+            batch_stats = [alignment_edit_stats(alignment, node_sequences)
+                if alignment.score is not None else None
+                for alignment in batch]
+
+        for alignment, edit_stats in itertools.izip(batch, batch_stats):
+            if alignment.score is None:
+                # Unaligned alignments don't get edit stats
+                edit_stats = None
+            yield alignment, edit_stats
+
+def add_stats(stats, other_stats):
+    """
+    Add the counts and histograms from one stats dict into another. Keys that
+    aren't numbers or Counters (like a run time of None) are left alone.
+
+    >>> stats = {"total": 1, "hist": collections.Counter({3: 1})}
+    >>> add_stats(stats, {"total": 2, "hist": collections.Counter({3: 2, 4: 1})})
+    >>> stats["total"], sorted(stats["hist"].items())
+    (3, [(3, 3), (4, 1)])
+
+    """
+
+    for key, value in other_stats.iteritems():
+        if isinstance(value, collections.Counter):
+            # Add in all the histogram counts
+            stats[key].update(value)
+        elif value is not None:
+            # Add in the totals
+            stats[key] += value
+
+def matches_per_column(alignment, edit_stats):
+    """
+    Calculate matches per alignment column for an alignment with the given
+    edit stats, which is a way better measure of alignment identity than vg's
+    "identity" which also ignores deletions. Returns None for unaligned
+    alignments.
+
+    """
+
+    if edit_stats is None:
+        return None
+
+    matches, _, _, _, alignment_columns = edit_stats
+
+    return (float(matches) / alignment_columns
+        if alignment_columns > 0 else 0)
+
+class StatsCollector(object):
+    """
+    A pluggable collector of stats over a run of alignments. Fills in its own
+    keys in the stats dict.
+
+    Subclasses say which Alignment fields (by name, from ALIGNMENT_FIELDS) they
+    look at, and whether they need per-alignment edit stats, so the engine
+    only decodes and computes what some collector will use.
+
+    The StatsEngine always decodes "name", "score" and "is_secondary".
+
+    """
+
+    # Which Alignment fields this collector looks at
+    fields = frozenset()
+
+    # Whether this collector needs edit stats for aligned alignments
+    needs_edit_stats = False
+
+    def __init__(self):
+        """
+        Start a new shard with zeroed stats.
+
+        """
+
+        self.stats = self.empty_stats()
+
+    def empty_stats(self):
+        """
+        Return a new dict of this collector's stats, with all the counts zeroed.
+
+        """
+
+        raise NotImplementedError()
+
+    def add(self, alignment, edit_stats, last_alignment):
+        """
+        Count the given Alignment, with the given edit stats (or None if it is
+        unaligned). last_alignment is the alignment that came right before it
+        in the shard, or None.
+
+        """
+
+        raise NotImplementedError()
+
+    def finish(self, last_alignment):
+        """
+        Return this collector's result for the shard, which ended with the given
+        alignment. The result must be picklable, and is passed to merge.
+
+        """
+
+        return self.stats
+
+    @classmethod
+    def merge(cls, shard_results):
+        """
+        Combine the given list of shard results, in GAM order, into a single
+        stats dict.
+
+        """
+
+        stats = cls().stats
+
+        for shard_stats in shard_results:
+            add_stats(stats, shard_stats)
+
+        return stats
+
+class ReadStatsCollector(StatsCollector):
+    """
+    Collects read counts, and score, mismatch, indel and substitution
+    histograms for primary and secondary alignments.
+
+    """
+
+    fields = frozenset(["sequence"])
+    needs_edit_stats = True
+
+    def empty_stats(self):
+        return {
+            "total_reads": 0,
+            "total_mapped": 0,
+            "total_multimapped": 0,
+            "primary_scores": collections.Counter(),
+            "primary_mismatches": collections.Counter(), # Deprecated; doesn't count deletions
+            "primary_indels": collections.Counter(),
+            "primary_substitutions": collections.Counter(),
+            "secondary_scores": collections.Counter(),
+            "secondary_mismatches": collections.Counter(), # Deprecated; doesn't count deletions
+            "secondary_indels": collections.Counter(),
+            "secondary_substitutions": collections.Counter()
+        }
+
+    def add(self, alignment, edit_stats, last_alignment):
+        stats = self.stats
+
+        if edit_stats is not None:
+            # This alignment is aligned.
+            matches, indels, substitutions, _, _ = edit_stats
+
+            # Calculate mismatches as what's not perfect matches
+            mismatches = len(alignment.sequence) - matches
+
+            if alignment.is_secondary:
+                # It's a multimapping. We can have max 1 per read, so it's a
+                # multimapped read.
+                stats["total_multimapped"] += 1
+                stats["secondary_scores"][alignment.score] += 1
+                stats["secondary_mismatches"][mismatches] += 1
+                stats["secondary_indels"][indels] += 1
+                stats["secondary_substitutions"][substitutions] += 1
+            else:
+                # Log its stats as primary. We'll get exactly one of these per
+                # read with any mappings.
+                stats["total_mapped"] += 1
+                stats["primary_scores"][alignment.score] += 1
+                stats["primary_mismatches"][mismatches] += 1
+                stats["primary_indels"][indels] += 1
+                stats["primary_substitutions"][substitutions] += 1
+
+                # We won't see an unaligned primary alignment for this read, so
+                # count the read
+                stats["total_reads"] += 1
+
+        elif not alignment.is_secondary:
+            # We have an unmapped primary "alignment". Count the read by its
+            # primary alignment.
+            stats["total_reads"] += 1
+
+class LengthStatsCollector(StatsCollector):
+    """
+    Collects histograms of the lengths of mapped and unmapped reads, and of the
+    number of aligned (not indel) bases in primary alignments, not counting
+    bases opposite reference Ns.
+
+    """
+
+    fields = frozenset(["sequence"])
+    needs_edit_stats = True
+
+    def empty_stats(self):
+        return {
+            "mapped_lengths": collections.Counter(),
+            "unmapped_lengths": collections.Counter(),
+            "aligned_lengths": collections.Counter()
+        }
+
+    def add(self, alignment, edit_stats, last_alignment):
+        if alignment.is_secondary:
+            # Only primary alignments count here
+            return
+
+        if edit_stats is not None:
+            # Record that a read of this length was mapped
+            self.stats["mapped_lengths"][len(alignment.sequence)] += 1
+
+            # And that a read with this many aligned primary bases was found
+            self.stats["aligned_lengths"][edit_stats[3]] += 1
+        else:
+            # Record that an unmapped read has this length
+            self.stats["unmapped_lengths"][len(alignment.sequence)] += 1
+
+class QualityStatsCollector(StatsCollector):
+    """
+    Collects histograms of mapping quality, vg identity, and matches per
+    alignment column for primary and secondary alignments.
+
+    """
+
+    fields = frozenset(["mapping_quality", "identity"])
+    needs_edit_stats = True
+
+    def empty_stats(self):
+        return {
+            "primary_mapqs": collections.Counter(),
+            "primary_identities": collections.Counter(), # Deprecated; doesn't count deletions in this vg
+            "primary_matches_per_column": collections.Counter(),
+            "secondary_mapqs": collections.Counter(),
+            "secondary_identities": collections.Counter(), # Deprecated; doesn't count deletions in this vg
+            "secondary_matches_per_column": collections.Counter()
+        }
+
+    def add(self, alignment, edit_stats, last_alignment):
+        if edit_stats is None:
+            # Only aligned alignments count here
+            return
+
+        prefix = "secondary_" if alignment.is_secondary else "primary_"
+
+        # The mapping quality may not be defined on some reads.
+        self.stats[prefix + "mapqs"][alignment.mapping_quality] += 1
+        self.stats[prefix + "identities"][alignment.identity] += 1
+        self.stats[prefix + "matches_per_column"][matches_per_column(
+            alignment, edit_stats)] += 1
+
+def add_unpaired_primary(stats, score, matches_per_column):
+    """
+    Record in the given stats dict a primary alignment with the given score and
+    matches per column that had no secondary alignment at all (not even a
+    duplicate of itself).
+
+    """
+
+    # It was aligned (nonzero score), so we need to pretend it had a secondary
+    # of score 0, and an advantage over that secondary equal to its score.
+    stats["primary_advantage"][score] += 1
+
+    # We could have seen a secondary for that alignment, but we didn't.
+    stats["total_secondary_visible"] += 1
+
+    if matches_per_column >= 0.95:
+        # If the alignment was sufficiently good, given that it had no
+        # secondary at all, it is sufficiently unique.
+        stats["total_sufficiently_unique"] += 1
+
+class UniquenessStatsCollector(StatsCollector):
+    """
+    Collects the score advantage of each primary alignment over its secondary,
+    and counts how many reads were sufficiently unique (a good primary with a
+    bad or no secondary).
+
+    Whether a primary at the end of a shard has a secondary depends on the
+    next shard, so this collector's shard results carry enough information to
+    settle that when merging.
+
+    """
+
+    needs_edit_stats = True
+
+    def __init__(self):
+        super(UniquenessStatsCollector, self).__init__()
+
+        # Holds the matches per column of the last alignment, if it's a primary
+        self.last_matches_per_column = None
+
+        # Does this shard start with a mapped primary alignment? If so, a
+        # pending primary at the end of the previous shard has no secondary.
+        self.starts_with_mapped_primary = None
+
+    def empty_stats(self):
+        return {
+            "total_secondary_visible": 0,
+            "total_sufficiently_unique": 0,
+            "primary_advantage": collections.Counter()
+        }
+
+    def add(self, alignment, edit_stats, last_alignment):
+        stats = self.stats
+
+        if self.starts_with_mapped_primary is None:
+            # Remember what kind of alignment we started with
+            self.starts_with_mapped_primary = (not alignment.is_secondary and
+                edit_stats is not None)
+
+        # Work out the matches per column, if we're aligned
+        alignment_matches_per_column = matches_per_column(alignment,
+            edit_stats)
+
+        if edit_stats is not None and alignment.is_secondary:
+            # We know we have a primary in last_alignment, so we can calculate a
+            # score advantage for the primary.
+            score_advantage = (last_alignment.score or 0) - alignment.score
+            stats["primary_advantage"][score_advantage] += 1
+
+            # We saw a secondary alignment
+            stats["total_secondary_visible"] += 1
+
+            if (self.last_matches_per_column >= 0.95 and
+                alignment_matches_per_column < 0.85):
+                # If the last alignment was sufficiently good, and this
+                # secondary is sufficiently bad, then the last alignment is
+                # sufficiently unique.
+                stats["total_sufficiently_unique"] += 1
+
+        elif (edit_stats is not None and last_alignment is not None and
+            not last_alignment.is_secondary and
+            last_alignment.score is not None):
+            # This is a primary alignment, and it comes after another primary
+            # alignment. That other primary alignment has no secondary at all
+            # (not even a duplicate of itself).
+            add_unpaired_primary(stats, last_alignment.score,
+                self.last_matches_per_column)
+
+        self.last_matches_per_column = alignment_matches_per_column
+
+    def finish(self, last_alignment):
+        # Leave the last alignment overall for the merge step to handle, since
+        # we can't see the next shard from here.
+        if (last_alignment is not None and
+            not last_alignment.is_secondary and
+            last_alignment.score is not None):
+
+            unpaired_primary = (last_alignment.score,
+                self.last_matches_per_column)
+        else:
+            unpaired_primary = None
+
+        return (self.stats, bool(self.starts_with_mapped_primary),
+            unpaired_primary)
+
+    @classmethod
+    def merge(cls, shard_results):
+        stats = cls().stats
+
+        # This holds the (score, matches per column) of a primary at the end of
+        # the previous shard that hasn't been accounted for yet.
+        pending_primary = None
+
+        for shard_stats, starts_with_mapped_primary, unpaired_primary in \
+            shard_results:
+
+            if pending_primary is not None and starts_with_mapped_primary:
+                # The last primary from the previous shard is followed by
+                # another mapped primary, so it had no secondary.
+                add_unpaired_primary(stats, *pending_primary)
+
+            add_stats(stats, shard_stats)
+
+            pending_primary = unpaired_primary
+
+        if pending_primary is not None:
+            # The last alignment overall is a primary with no secondary.
+            add_unpaired_primary(stats, *pending_primary)
+
+        return stats
+
+# These are the collectors each kind of stats file is made of
+MAPPING_COLLECTORS = [ReadStatsCollector, LengthStatsCollector,
+    QualityStatsCollector, UniquenessStatsCollector]
+CALLING_COLLECTORS = [ReadStatsCollector, LengthStatsCollector]
+
+class StatsEngine(object):
+    """
+    Computes a stats dict for a GAM file (or any iterable of Alignment records),
+    by running a set of StatsCollectors over it.
+
+    The engine checks that every secondary alignment comes right after its
+    primary, computes the edit stats once per alignment for all the collectors
+    that need them (in vectorized batches if the node sequences are in a
+    NodeSequenceStore), and can split a GAM file into shards at read
+    boundaries and do the shards in parallel.
+
+    >>> engine = StatsEngine([ReadStatsCollector, UniquenessStatsCollector],
+    ...     NodeSequenceStore.from_nodes([(1, "ACGT")]),
+    ...     skip_duplicate_secondaries=True)
+    >>> sorted(engine.fields)
+    ['is_secondary', 'name', 'path', 'score', 'sequence']
+    >>> primary = Alignment(name="r1", sequence="ACGT", score=8,
+    ...     mappings=[Mapping(1, 0, False, [Edit(4, 4, None)])])
+    >>> secondary = Alignment(name="r1", sequence="ACGT", score=8,
+    ...     is_secondary=True, mappings=primary.mappings)
+    >>> unmapped = Alignment(name="r2", sequence="AC")
+    >>> stats = engine.run_alignments([primary, secondary, unmapped], 5)
+    >>> stats["total_reads"], stats["total_multimapped"], stats["run_time"]
+    (2, 0, 5)
+    >>> stats["total_secondary_visible"], stats["total_sufficiently_unique"]
+    (0, 0)
+    >>> stats == engine.merge([engine.compute_shard([primary, secondary]),
+    ...     engine.compute_shard([unmapped])], 5)
+    True
+    >>> engine.run_alignments([secondary])
+    Traceback (most recent call last):
+    ...
+    RuntimeError: r1 secondary alignment comes after alignment of nothing instead of corresponding primary alignment
+    <BLANKLINE>
+
+    """
+
+    def __init__(self, collector_types, node_sequences=None,
+        skip_duplicate_secondaries=False):
+        """
+        Make a new engine that runs the given list of StatsCollector classes,
+        looking up reference bases in the given NodeSequenceStore or dict of
+        node sequences by ID (or, if that is None, assuming that the reference
+        has no Ns).
+
+        If skip_duplicate_secondaries is set, secondary alignments that take
+        the same path as their primaries are not shown to the collectors.
+
+        """
+
+        self.collector_types = list(collector_types)
+        self.node_sequences = node_sequences
+        self.skip_duplicate_secondaries = skip_duplicate_secondaries
+
+        # Do we need to walk the edits at all?
+        self.needs_edit_stats = any(collector_type.needs_edit_stats
+            for collector_type in self.collector_types)
+
+        # Work out what fields we need to decode. We always need enough to find
+        # primaries and secondaries.
+        self.fields = set(["name", "score", "is_secondary"])
+        for collector_type in self.collector_types:
+            self.fields.update(collector_type.fields)
+        if self.needs_edit_stats or self.skip_duplicate_secondaries:
+            # We need to look at the mappings
+            self.fields.add("path")
+
+    def compute_shard(self, alignments):
+        """
+        Run the collectors over a run of Alignment records that starts at a
+        read boundary. Returns a list of the collectors' shard results, to be
+        combined with merge.
+
+        """
+
+        collectors = [collector_type() for collector_type in
+            self.collector_types]
+
+        if self.needs_edit_stats:
+            # Walk all the edits up front
+            records = with_edit_stats(alignments, self.node_sequences)
+        else:
+            records = ((alignment, None) for alignment in alignments)
+
+        # We need to track the last alignment
+        last_alignment = None
+
+        for alignment, edit_stats in records:
+            if alignment.is_secondary:
+                # It's a multimapping.
+
+                if (last_alignment is None or
+                    last_alignment.name != alignment.name or
+                    last_alignment.is_secondary):
+
+                    # This is a secondary alignment without a corresponding
+                    # primary alignment (which would have to be right before it
+                    # in GAM format with up to 2 mappings per read)
+                    raise RuntimeError("{} secondary alignment comes after "
+                        "alignment of {} instead of corresponding primary "
+                        "alignment\n".format(alignment.name,
+                        last_alignment.name if last_alignment is not None
+                        else "nothing"))
+
+                if (self.skip_duplicate_secondaries and
+                    alignment.mappings == last_alignment.mappings):
+                    # This secondary takes the same path as the primary, so we
+                    # don't want to consider it as a separate alignment. It's
+                    # just there to even things up for the secondary alignment
+                    # of the other end of the read.
+                    last_alignment = alignment
+                    continue
+
+            for collector in collectors:
+                collector.add(alignment, edit_stats, last_alignment)
+
+            # Save the alignment for checking for wayward secondaries
+            last_alignment = alignment
+
+        return [collector.finish(last_alignment) for collector in collectors]
+
+    def merge(self, shard_results, run_time=None):
+        """
+        Combine the given iterable of results from compute_shard, in GAM order,
+        into a single stats dict, recording the given run time. Produces exactly
+        the stats that computing everything as one shard would.
+
+        """
+
+        # Gather up the results for each collector
+        by_collector = zip(*shard_results)
+        if len(by_collector) == 0:
+            # There were no shards at all
+            by_collector = [[] for _ in self.collector_types]
+
+        stats = {}
+        for collector_type, collector_results in itertools.izip(
+            self.collector_types, by_collector):
+            stats.update(collector_type.merge(list(collector_results)))
+
+        stats["run_time"] = run_time
+
+        return stats
+
+    def run_alignments(self, alignments, run_time=None):
+        """
+        Compute the stats dict for the given iterable of Alignment records,
+        recording the given run time.
+
+        """
+
+        return self.merge([self.compute_shard(alignments)], run_time)
+
+    def run(self, gam_filename, vg="vg", native=True, processes=1,
+        shard_size=100000, run_time=None):
+        """
+        Compute the stats dict for the given GAM file, recording the given run
+        time.
+
+        If native is set, the GAM is decoded directly, only decoding the
+        fields the collectors need, and if more than one process is requested
+        the work is split into shards of about shard_size alignments that are
+        done in parallel. Otherwise, the GAM is read through the given vg
+        binary in one process.
+
+        """
+
+        if processes > 1 and native and is_gzipped(gam_filename):
+            # Split up the GAM and do the stats in parallel
+            return self.run_sharded(gam_filename, processes, shard_size,
+                run_time)
+
+        # Otherwise just read the alignments, either directly or through vg
+        # view, and do them all as one shard.
+        return self.run_alignments(read_alignments(gam_filename,
+            fields=self.fields, vg=vg, native=native), run_time)
+
+    def run_sharded(self, gam_filename, processes, shard_size=100000,
+        run_time=None):
+        """
+        Compute the stats for the given GAM file by splitting it into shards at
+        read boundaries and computing stats for the shards in parallel in the
+        given number of processes.
+
+        """
+
+        pool = multiprocessing.Pool(processes, init_stats_worker, (self,))
+
+        try:
+            # Compute all the shards in parallel, but get the results back in
+            # order for merging.
+            shard_results = pool.imap(compute_shard_messages,
+                split_shards(gam_filename, shard_size))
+
+            stats = self.merge(shard_results, run_time)
+        finally:
+            pool.terminate()
+            pool.join()
+
+        return stats
+
+# Stats worker processes keep the engine they are running here.
+worker_engine = None
+
+def init_stats_worker(engine):
+    """
+    Set up a stats worker process to use the given StatsEngine.
+
+    """
+
+    global worker_engine
+    worker_engine = engine
+
+def compute_shard_messages(messages):
+    """
+    Compute stats for a shard of serialized alignment messages, in a worker
+    process. Returns the same thing as StatsEngine.compute_shard.
+
+    """
+
+    fields = worker_engine.fields
+
+    return worker_engine.compute_shard(parse_alignment(message, fields)
+        for message in messages)
+
+def split_shards(alignment_file, shard_size):
+    """
+    Yield lists of serialized alignment messages from the given GAM file, of
+    about the given size, splitting only at read-name boundaries so that no
+    secondary alignment is separated from its primary.
+
+    """
+
+    shard = []
+    last_name = None
+
+    # We only need to look at enough of each alignment to find boundaries
+    boundary_fields = set(["name", "is_secondary"])
+
+    for message in read_messages(alignment_file):
+        alignment = parse_alignment(message, boundary_fields)
+
+        if (len(shard) >= shard_size and not alignment.is_secondary and
+            alignment.name != last_name):
+            # This is a new read, and the shard is full, so start a new shard
+            yield shard
+            shard = []
+
+        shard.append(message)
+        last_name = alignment.name
+
+    if len(shard) > 0:
+        yield shard
+
+# A Histogram is a numpy array of the distinct values a stat took on, and a
+# parallel numpy array of how many times each value was seen.
+Histogram = collections.namedtuple("Histogram", ["values", "counts"])
+
+def histogram_from_counter(counter):
+    """
+    Make a Histogram from a Counter or dict of counts by value, where the values
+    may be numbers or strings of numbers (as they are in stats JSON). Values of
+    None become NaN.
+
+    >>> histogram = histogram_from_counter({"0.5": 2, "1.0": 3, "null": 1})
+    >>> sorted((value, count) for value, count in zip(histogram.values.tolist(),
+    ...     histogram.counts.tolist()) if not numpy.isnan(value))
+    [(0.5, 2), (1.0, 3)]
+    >>> histogram.counts[numpy.isnan(histogram.values)].tolist()
+    [1]
+
+    """
+
+    values = numpy.fromiter((float(value) if value not in (None, "null")
+        else float("nan") for value in counter.iterkeys()),
+        dtype=numpy.float64, count=len(counter))
+    counts = numpy.fromiter(counter.itervalues(), dtype=numpy.int64,
+        count=len(counter))
+
+    return Histogram(values, counts)
+
+def save_stats_npz(stats, stats_file):
+    """
+    Save the given stats dict to the given file (or filename) as a compressed
+    NumPy .npz archive. Each Counter is saved as a "<stat>.values" array and a
+    "<stat>.counts" array, and each other stat as a single value, with None
+    saved as NaN.
+
+    """
+
+    arrays = {}
+
+    for key, value in stats.iteritems():
+        if isinstance(value, (collections.Counter, dict)):
+            # Store the histogram as two columns
+            histogram = histogram_from_counter(value)
+            arrays["{}.values".format(key)] = histogram.values
+            arrays["{}.counts".format(key)] = histogram.counts
+        elif value is None:
+            arrays[key] = numpy.array(float("nan"))
+        else:
+            arrays[key] = numpy.array(value)
+
+    if isinstance(stats_file, basestring):
+        # Don't let numpy go sticking another extension on the filename
+        with open(stats_file, "wb") as stats_handle:
+            numpy.savez_compressed(stats_handle, **arrays)
+    else:
+        numpy.savez_compressed(stats_file, **arrays)
+
+def load_stats_npz(stats_file):
+    """
+    Load a stats dict saved by save_stats_npz from the given file or filename.
+    Histogram stats come back as Histograms, and other stats as plain Python
+    values (or lists of them), with NaN coming back as None.
+
+    >>> import io
+    >>> buffer = io.BytesIO()
+    >>> save_stats_npz({"total_reads": 5, "run_time": None,
+    ...     "primary_scores": collections.Counter({10: 4, 12: 1}),
+    ...     "chunk_run_times": [1.5, 2.0]}, buffer)
+    >>> _ = buffer.seek(0)
+    >>> stats = load_stats_npz(buffer)
+    >>> stats["total_reads"], stats["run_time"], stats["chunk_run_times"]
+    (5, None, [1.5, 2.0])
+    >>> sorted(zip(stats["primary_scores"].values.tolist(),
+    ...     stats["primary_scores"].counts.tolist()))
+    [(10.0, 4), (12.0, 1)]
+
+    """
+
+    stats = {}
+
+    with numpy.load(stats_file) as data:
+        for name in data.files:
+            if name.endswith(".values"):
+                # Pull in the histogram columns
+                key = name[:-len(".values")]
+                stats[key] = Histogram(data[name],
+                    data["{}.counts".format(key)])
+            elif name.endswith(".counts"):
+                # We get these along with the values
+                continue
+            elif data[name].ndim > 0:
+                # This is a list of values
+                stats[name] = data[name].tolist()
+            else:
+                value = data[name].item()
+                if isinstance(value, float) and numpy.isnan(value):
+                    # This was a None
+                    value = None
+                stats[name] = value
+
+    return stats
+
+def load_stats_json(stats_file):
+    """
+    Load a stats dict from the given stats JSON file or filename, in the same
+    form as load_stats_npz returns.
+
+    """
+
+    if isinstance(stats_file, basestring):
+        with open(stats_file) as stats_handle:
+            stats = json.load(stats_handle)
+    else:
+        stats = json.load(stats_file)
+
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            # Convert each dict of counts by stringified value to a Histogram
+            stats[key] = histogram_from_counter(value)
+
+    return stats
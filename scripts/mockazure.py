@@ -0,0 +1,274 @@
+"""
+mockazure.py: an in-memory stand-in for the Azure blob service, for testing and
+benchmarking toillib's AzureIOStore without Azure.
+
+"""
+
+import os, os.path, collections, threading, time, tempfile, hashlib, base64
+import datetime
+
+import dateutil.tz
+
+from toillib import AzureIOStore, BlobBlock, ContentSettings
+
+class MockBlockBlobService(object):
+    """
+    An in-memory stand-in for the parts of Azure's BlockBlobService that
+    AzureIOStore uses, for testing and benchmarking without Azure.
+    
+    Every request can be made to take a fixed amount of time, to stand in for
+    network latency. Setting fail_after to a number makes that many more
+    requests succeed, and then makes the next one fail.
+    
+    >>> service = MockBlockBlobService()
+    >>> store = AzureIOStore("account", "container", "prefix",
+    ...     blob_service=service, transfer_threads=3, block_size=10)
+    >>> handle, path = tempfile.mkstemp()
+    >>> os.write(handle, "Hello, blob service!")
+    20
+    >>> os.close(handle)
+    >>> store.write_output_file(path, "dir/hello.txt")
+    >>> service.put_block_count
+    2
+    >>> list(store.list_input_directory("dir"))
+    ['hello.txt']
+    >>> store.get_size("dir/hello.txt"), store.exists("dir/nothing.txt")
+    (20, False)
+    >>> store.read_input_file("dir/hello.txt", path + ".copy")
+    >>> open(path + ".copy").read()
+    'Hello, blob service!'
+    >>> os.unlink(path)
+    >>> os.unlink(path + ".copy")
+    
+    """
+    
+    class Blob(object):
+        """
+        A blob with content and properties, like those the real service returns.
+        """
+        
+        def __init__(self, name, content, properties):
+            self.name = name
+            self.content = content
+            self.properties = properties
+            
+    class BlobProperties(object):
+        """
+        The properties of a blob.
+        """
+        
+        def __init__(self, content_length, last_modified, etag,
+            content_settings):
+            self.content_length = content_length
+            self.last_modified = last_modified
+            self.etag = etag
+            self.content_settings = content_settings
+            
+    class BlobList(list):
+        """
+        A page of a blob listing, with the marker for the next page.
+        """
+        
+        next_marker = None
+        
+    class BlockList(object):
+        """
+        The committed and uncommitted blocks of a blob.
+        """
+        
+        def __init__(self, committed_blocks, uncommitted_blocks):
+            self.committed_blocks = committed_blocks
+            self.uncommitted_blocks = uncommitted_blocks
+    
+    def __init__(self, latency=0, page_size=5000):
+        """
+        Make a new empty mock blob service, where each request takes the given
+        number of seconds, and listings come in pages of the given size.
+        
+        """
+        
+        self.latency = latency
+        self.page_size = page_size
+        
+        # How many more requests should succeed before one fails? None if no
+        # failure should happen.
+        self.fail_after = None
+        
+        # How many blocks have been put, and how many ranges fetched?
+        self.put_block_count = 0
+        self.get_range_count = 0
+        
+        # This holds committed Blobs by container and then name
+        self.containers = collections.defaultdict(dict)
+        # This holds dicts of uncommitted block data by ID, by container and
+        # blob name.
+        self.uncommitted = collections.defaultdict(dict)
+        # This holds the IDs and data of the committed blocks of each blob, by
+        # container and blob name.
+        self.committed = {}
+        
+        # How many blobs have we committed? Used for etags.
+        self.version = 0
+        
+        # Requests can come from many threads at once
+        self.lock = threading.Lock()
+        
+    def __request(self):
+        """
+        Account for a request, taking the configured time, and failing if we
+        are supposed to fail now.
+        
+        """
+        
+        if self.latency > 0:
+            time.sleep(self.latency)
+        
+        with self.lock:
+            if self.fail_after is not None:
+                if self.fail_after == 0:
+                    self.fail_after = None
+                    raise RuntimeError("Mock request failure")
+                self.fail_after -= 1
+                
+    def __commit(self, container_name, blob_name, content, content_md5):
+        """
+        Save the given content as the given blob. Must hold the lock.
+        
+        """
+        
+        self.version += 1
+        
+        self.containers[container_name][blob_name] = self.Blob(blob_name,
+            content, self.BlobProperties(len(content),
+            datetime.datetime.utcnow().replace(tzinfo=dateutil.tz.tzutc()),
+            "0x{:x}".format(self.version),
+            ContentSettings(content_md5=content_md5)))
+        
+    def __get(self, container_name, blob_name):
+        """
+        Get the Blob with the given name, or raise an error if it doesn't
+        exist.
+        
+        """
+        
+        try:
+            return self.containers[container_name][blob_name]
+        except KeyError:
+            raise RuntimeError("Blob {} not found".format(blob_name))
+        
+    def put_blob(self, container_name, blob_name, content, content_md5=None):
+        """
+        Save the given string as a blob all at once, with the given MD5 (or the
+        MD5 of the content if none is given). Not part of the real API; used to
+        set up tests.
+        
+        """
+        
+        if content_md5 is None:
+            content_md5 = base64.b64encode(hashlib.md5(content).digest())
+            
+        with self.lock:
+            self.__commit(container_name, blob_name, content, content_md5)
+        
+    def create_container(self, container_name, fail_on_exist=False):
+        self.__request()
+        with self.lock:
+            if container_name in self.containers:
+                return False
+            self.containers[container_name] = {}
+            return True
+        
+    def put_block(self, container_name, blob_name, block, block_id, **kwargs):
+        self.__request()
+        with self.lock:
+            self.uncommitted[(container_name, blob_name)][block_id] = block
+            self.put_block_count += 1
+            
+    def put_block_list(self, container_name, blob_name, block_list,
+        content_settings=None, **kwargs):
+        self.__request()
+        with self.lock:
+            # We can use uncommitted blocks or already committed ones
+            available = dict(self.committed.get((container_name, blob_name),
+                []))
+            available.update(self.uncommitted[(container_name, blob_name)])
+            
+            blocks = []
+            for block in block_list:
+                if block.id not in available:
+                    raise RuntimeError("Block {} not found".format(block.id))
+                blocks.append((block.id, available[block.id]))
+                
+            self.__commit(container_name, blob_name,
+                "".join(data for _, data in blocks),
+                content_settings.content_md5 if content_settings is not None
+                else None)
+            
+            # Committing throws away the uncommitted blocks
+            self.committed[(container_name, blob_name)] = blocks
+            del self.uncommitted[(container_name, blob_name)]
+            
+    def get_block_list(self, container_name, blob_name, snapshot=None,
+        block_list_type=None, **kwargs):
+        self.__request()
+        with self.lock:
+            key = (container_name, blob_name)
+            if key not in self.committed and len(self.uncommitted[key]) == 0:
+                raise RuntimeError("Blob {} not found".format(blob_name))
+                
+            def make_block(block_id, data):
+                block = BlobBlock(id=block_id)
+                block.size = len(data)
+                return block
+                
+            return self.BlockList(
+                [make_block(block_id, data) for block_id, data in 
+                self.committed.get(key, [])],
+                [make_block(block_id, data) for block_id, data in
+                self.uncommitted[key].iteritems()])
+                
+    def get_blob_properties(self, container_name, blob_name, **kwargs):
+        self.__request()
+        with self.lock:
+            return self.__get(container_name, blob_name)
+        
+    def get_blob_to_bytes(self, container_name, blob_name, start_range=None,
+        end_range=None, **kwargs):
+        self.__request()
+        with self.lock:
+            blob = self.__get(container_name, blob_name)
+            
+            if start_range is None:
+                # Get the whole thing
+                content = blob.content
+            else:
+                # Ranges are inclusive
+                content = blob.content[start_range:end_range + 1]
+                self.get_range_count += 1
+                
+            return self.Blob(blob.name, content, blob.properties)
+            
+    def list_blobs(self, container_name, prefix=None, marker=None,
+        num_results=None, **kwargs):
+        self.__request()
+        with self.lock:
+            # Blobs list in name order, and markers are just where to start
+            names = sorted(name for name in self.containers[container_name]
+                if name.startswith(prefix or "") and
+                (marker is None or name >= marker))
+                
+            page_size = min(num_results or self.page_size, self.page_size)
+            
+            result = self.BlobList(self.containers[container_name][name]
+                for name in names[:page_size])
+            if len(names) > page_size:
+                result.next_marker = names[page_size]
+            
+            return result
+            
+    def delete_blob(self, container_name, blob_name, **kwargs):
+        self.__request()
+        with self.lock:
+            self.__get(container_name, blob_name)
+            del self.containers[container_name][blob_name]
+            self.committed.pop((container_name, blob_name), None)
@@ -23,6 +23,8 @@ import dateutil.parser
 from toil.job import Job
 
 from toillib import *
+from vglib import *
+from gamstats import *
 
 def parse_args(args):
     """
@@ -90,34 +92,6 @@ def parse_args(args):
 
     return parser.parse_args(args)
 
-# Reverse complement needs a global translation table
-reverse_complement_translation_table = string.maketrans("ACGTN", "TGCAN")
-def reverse_complement(sequence):
-    """  
-    Compute the reverse complement of a DNA sequence.
-    
-    Follows algorithm from <http://stackoverflow.com/a/26615937>
-    """
-    
-    if isinstance(sequence, unicode):
-        # Encode the sequence in ASCII for easy translation
-        sequence = sequence.encode("ascii", "replace")
-    
-    # Translate and then reverse
-    return sequence.translate(reverse_complement_translation_table)[::-1]
-    
-def count_Ns(sequence):
-    """  
-    Return the number of N bases in the given DNA sequence
-    """
-    
-    n_count = 0
-    for item in sequence:
-        if item == "N": 
-            n_count += 1 
-     
-    return n_count
-
 def run(cmd, proc_stdout = sys.stdout, proc_stderr = sys.stderr,
         check = True):
     """ run command in shell and throw exception if it doesn't work 
@@ -173,28 +147,13 @@ def run_indexing(options, job_cores):
                 print("Pruning {} to {}".format(
                     graph_filename, to_index_filename))
 
-                # Prune out hard bits of the graph
-                tasks = []
-
-                # Prune out complex regions
-                tasks.append(subprocess.Popen(["vg", "mod",
-                    "-p", "-l", str(options.kmer_size), "-t", str(job_cores),
-                    "-e", str(options.edge_max), options.vg_graph],
-                    stdout=subprocess.PIPE))
-
-                # Throw out short disconnected chunks
-                tasks.append(subprocess.Popen(["vg", "mod",
-                    "-S", "-l", str(options.kmer_size * 2),
-                    "-t", str(job_cores), "-"], stdin=tasks[-1].stdout,
-                    stdout=to_index_file))
-
-                # Did we make it through all the tasks OK?
-                for task in tasks:
-                    if task.wait() != 0:
-                        raise RuntimeError("Pipeline step returned {}".format(
-                            task.returncode))
-
-                time.sleep(1)
+                # Prune out hard bits of the graph: first complex regions,
+                # and then short disconnected chunks.
+                run_pipeline([["vg", "mod", "-p", "-l",
+                    str(options.kmer_size), "-t", str(job_cores), "-e",
+                    str(options.edge_max), options.vg_graph],
+                    ["vg", "mod", "-S", "-l", str(options.kmer_size * 2),
+                    "-t", str(job_cores), "-"]], stdout=to_index_file)
 
             if options.include_primary:
 
@@ -219,65 +178,28 @@ def run_indexing(options, job_cores):
                     ref_options.append("-r")
                     ref_options.append(name)
 
-                tasks = []
-
-                # Retain only the specified paths (only one should really exist)
-                tasks.append(subprocess.Popen(
-                    ["vg", "mod", "-N"] + ref_options +
-                    ["-t", str(job_cores), options.vg_graph],
-                    stdout=to_index_file))
+                # Retain only the specified paths (only one should really
+                # exist). We don't parallelize with the first pipeline so we
+                # don't need to use an extra cat step.
+                run_pipeline([["vg", "mod", "-N"] + ref_options +
+                    ["-t", str(job_cores), options.vg_graph]],
+                    stdout=to_index_file)
 
                 # TODO: if we merged the primary path back on itself, it's
                 # possible for it to braid with itself. Right now we just ignore
                 # this and let those graphs take a super long time to index.
 
-                # Wait for this second pipeline. We don't parallelize with the
-                # first one so we don't need to use an extra cat step.
-                for task in tasks:
-                    if task.wait() != 0:
-                        raise RuntimeError("Pipeline step returned {}".format(
-                            task.returncode))
-
-                # Wait to make sure no weird file-not-being-full bugs happen
-                # TODO: how do I wait on child process output?
-                time.sleep(1)
-
-        time.sleep(1)
-
         # Now we have the combined to-index graph in one vg file. We'll load
         # it (which deduplicates nodes/edges) and then find kmers.
 
-        tasks = []
-        with open(kmers_filename, "w") as kmers_file:
-
-            tasks = []
-
-            print("Finding kmers in {} to {}".format(
-                to_index_filename, kmers_filename))
-
-            # Deduplicate the graph
-            tasks.append(subprocess.Popen(["vg",
-                "view", "-v", to_index_filename],
-                stdout=subprocess.PIPE))
-            
-            # Make the GCSA2 kmers file
-            tasks.append(subprocess.Popen(["vg",
-                "kmers", "-g", "-B", "-k", str(options.kmer_size),
-                "-H", "1000000000", "-T", "1000000001",
-                "-t", str(job_cores), "-"], stdin=tasks[-1].stdout,
-                stdout=kmers_file))
-                
-            # Did we make it through all the tasks OK?
-            for task in tasks:
-                if task.wait() != 0:
-                    raise RuntimeError("Pipeline step returned {}".format(
-                        task.returncode))
-
-            # Wait to make sure no weird file-not-being-full bugs happen
-            # TODO: how do I wait on child process output?
-            time.sleep(1)
-
-        time.sleep(1)
+        print("Finding kmers in {} to {}".format(
+            to_index_filename, kmers_filename))
+
+        # Deduplicate the graph, and make the GCSA2 kmers file
+        run_pipeline([["vg", "view", "-v", to_index_filename],
+            ["vg", "kmers", "-g", "-B", "-k", str(options.kmer_size),
+            "-H", "1000000000", "-T", "1000000001", "-t", str(job_cores),
+            "-"]], stdout=kmers_filename)
 
         # Where do we put the GCSA2 index?
         gcsa_filename = options.out_dir + "/" + graph_filename + ".gcsa"
@@ -287,8 +209,9 @@ def run_indexing(options, job_cores):
 
         # Make the gcsa2 index. Make sure to use 3 doubling steps to work
         # around <https://github.com/vgteam/vg/issues/301>
-        subprocess.check_call(["vg", "index", "-t", str(job_cores), "-i",
-            kmers_filename, "-g", gcsa_filename, "-X", "3"])
+        run_pipeline([["vg", "index", "-t", str(job_cores), "-i",
+            kmers_filename, "-g", gcsa_filename, "-X", "3"]],
+            outputs=[gcsa_filename])
 
         # Where do we put the XG index?
         xg_filename = options.out_dir + "/" + graph_filename + ".xg"
@@ -296,8 +219,8 @@ def run_indexing(options, job_cores):
         print("XG-indexing {} to {}".format(
                 options.vg_graph, xg_filename))
 
-        subprocess.check_call(["vg", "index", "-t", str(job_cores), "-x",
-            xg_filename, options.vg_graph])
+        run_pipeline([["vg", "index", "-t", str(job_cores), "-x",
+            xg_filename, options.vg_graph]], outputs=[xg_filename])
     
     # Define a file to keep the compressed index in, so we can send it to
     # the output store.
@@ -403,253 +326,22 @@ def run_stats(options, job_cores):
     # We know what the vg file in there will be named
     graph_file = options.vg_graph
 
-    # Load the node sequences into memory. This holds node sequence string by
-    # ID.
-    node_sequences = {}
-
-    # Read the alignments in in JSON-line format
-    read_graph = subprocess.Popen(["vg", "view", "-j",
-        graph_file], stdout=subprocess.PIPE)
-
-    for line in read_graph.stdout:
-        # Parse the graph chunk JSON
-        graph_chunk = json.loads(line)
-        for node_dict in graph_chunk.get("node", []):
-            # For each node, store its sequence under its id. We want to crash
-            # if a node exists for which one or the other isn't defined.
-            node_sequences[node_dict["id"]] = node_dict["sequence"]
-
-    if read_graph.wait() != 0:
-        # Complain if vg dies
-        raise RuntimeError("vg died with error {}".format(
-            read_graph.returncode))
+    # Pack the node sequences, so we can discount Ns in the reference. This
+    # holds node sequence string by ID.
+    node_sequences = NodeSequenceStore.from_graph(graph_file)
 
     # Declare local files for everything
     stats_file = "{}/stats.json".format(options.out_dir)
     alignment_file = "{}/output.gam".format(options.out_dir)
 
-    # Read the alignments in in JSON-line format
-    read_alignment = subprocess.Popen(["vg", "view", "-aj",
-        alignment_file], stdout=subprocess.PIPE)
-
     # Count up the stats
-    stats = {
-        "total_reads": 0,
-        "total_mapped": 0,
-        "total_multimapped": 0,
-        "mapped_lengths": collections.Counter(),
-        "unmapped_lengths": collections.Counter(),
-        "aligned_lengths": collections.Counter(),
-        "primary_scores": collections.Counter(),
-        "primary_mismatches": collections.Counter(),
-        "primary_indels": collections.Counter(),
-        "primary_substitutions": collections.Counter(),
-        "secondary_scores": collections.Counter(),
-        "secondary_mismatches": collections.Counter(),
-        "secondary_indels": collections.Counter(),
-        "secondary_substitutions": collections.Counter(),
-        "run_time": run_time
-    }
-
-    last_alignment = None
-
-    for line in read_alignment.stdout:
-        # Parse the alignment JSON
-        alignment = json.loads(line)
-
-        # How long is this read?
-        length = len(alignment["sequence"])
-
-        if alignment.has_key("score"):
-            # This alignment is aligned.
-            # Grab its score
-            score = alignment["score"]
-
-            # Get the mappings
-            mappings = alignment.get("path", {}).get("mapping", [])
-
-            # Calculate the exact match bases
-            matches = 0
-
-            # And total up the instances of indels (only counting those where
-            # the reference has no Ns, and which aren't leading or trailing soft
-            # clips)
-            indels = 0
-
-            # And total up the number of substitutions (mismatching/alternative
-            # bases in edits with equal lengths where the reference has no Ns).
-            substitutions = 0
-
-            # What should the denominator for substitution rate be for this
-            # read? How many bases are in the read and aligned?
-            aligned_length = 0
-
-            for mapping_number, mapping in enumerate(mappings):
-                # Figure out what the reference sequence for this mapping should
-                # be
-
-                position = mapping.get("position", {})
-                if position.has_key("node_id"):
-                    # We actually are mapped to a reference node
-                    ref_sequence = node_sequences[position["node_id"]]
- 
-                    # Grab the offset
-                    offset = position.get("offset", 0)
-
-                    if mapping.get("is_reverse", False):
-                        # We start at the offset base on the reverse strand.
-
-                        # Add 1 to make the offset inclusive as an end poiint                        
-                        ref_sequence = reverse_complement(
-                            ref_sequence[0:offset + 1])
-                    else:
-                        # Just clip so we start at the specified offset
-                        ref_sequence = ref_sequence[offset:]
-
-                else:
-                    # We're aligned against no node, and thus an empty reference
-                    # sequence (and thus must be all insertions)
-                    ref_sequence = ""
-
-                # Start at the beginning of the reference sequence for the
-                # mapping.
-                index_in_ref = 0
-
-                # Pull out the edits
-                edits = mapping.get("edit", [])
-
-                for edit_number, edit in enumerate(edits):
-                    # An edit may be a soft clip if it's either the first edit
-                    # in the first mapping, or the last edit in the last
-                    # mapping. This flag stores whether that is the case
-                    # (although to actually be a soft clip it also has to be an
-                    # insertion, and not either a substitution or a perfect
-                    # match as spelled by the aligner).
-                    may_be_soft_clip = ((edit_number == 0 and
-                        mapping_number == 0) or
-                        (edit_number == len(edits) - 1 and
-                        mapping_number == len(mappings) - 1))
-
-                    # Count up the Ns in the reference sequence for the edit. We
-                    # get the part of the reference string that should belong to
-                    # this edit.
-                    reference_N_count = count_Ns(ref_sequence[
-                        index_in_ref:index_in_ref + edit.get("from_length", 0)])
-
-                    if edit.get("to_length", 0) == edit.get("from_length", 0):
-                        # Add in the length of this edit if it's actually
-                        # aligned (not an indel or softclip)
-                        aligned_length += edit.get("to_length", 0)
-
-                    if (not edit.has_key("sequence") and
-                        edit.get("to_length", 0) == edit.get("from_length", 0)):
-                        # The edit has equal from and to lengths, but no
-                        # sequence provided.
-
-                        # We found a perfect match edit. Grab its length
-                        matches += edit["from_length"]
-
-                        # We don't care about Ns when evaluating perfect
-                        # matches. VG already split out any mismatches into non-
-                        # perfect matches, and we ignore the N-matched-to-N
-                        # case.
-
-                    if not may_be_soft_clip and (edit.get("to_length", 0) !=
-                        edit.get("from_length", 0)):
-                        # This edit is an indel and isn't on the very end of a
-                        # read.
-                        if reference_N_count == 0:
-                            # Only count the indel if it's not against an N in
-                            # the reference
-                            indels += 1
-
-                    if (edit.get("to_length", 0) ==
-                        edit.get("from_length", 0) and
-                        edit.has_key("sequence")):
-                        # The edit has equal from and to lengths, and a provided
-                        # sequence. This edit is thus a SNP or MNP. It
-                        # represents substitutions.
-
-                        # We take as substituted all the bases except those
-                        # opposite reference Ns. Sequence Ns are ignored.
-                        substitutions += (edit.get("to_length", 0) -
-                            reference_N_count)
-
-                        # Pull those Ns out of the substitution rate denominator
-                        # as well.
-                        aligned_length -= reference_N_count
-
-                    # We still count query Ns as "aligned" when not in indels
-
-                    # Advance in the reference sequence
-                    index_in_ref += edit.get("from_length", 0)
-
-            # Calculate mismatches as what's not perfect matches
-            mismatches = length - matches
-
-            if alignment.get("is_secondary", False):
-                # It's a multimapping. We can have max 1 per read, so it's a
-                # multimapped read.
-
-                if (last_alignment is None or
-                    last_alignment.get("name") != alignment.get("name") or
-                    last_alignment.get("is_secondary", False)):
-
-                    # This is a secondary alignment without a corresponding primary
-                    # alignment (which would have to be right before it given the
-                    # way vg dumps buffers
-                    raise RuntimeError("{} secondary alignment comes after "
-                        "alignment of {} instead of corresponding primary "
-                        "alignment\n".format(alignment.get("name"),
-                        last_alignment.get("name") if last_alignment is not None
-                        else "nothing"))
-
-                # Log its stats as multimapped
-                stats["total_multimapped"] += 1
-                stats["secondary_scores"][score] += 1
-                stats["secondary_mismatches"][mismatches] += 1
-                stats["secondary_indels"][indels] += 1
-                stats["secondary_substitutions"][substitutions] += 1
-            else:
-                # Log its stats as primary. We'll get exactly one of these per
-                # read with any mappings.
-                stats["total_mapped"] += 1
-                stats["primary_scores"][score] += 1
-                stats["primary_mismatches"][mismatches] += 1
-                stats["primary_indels"][indels] += 1
-                stats["primary_substitutions"][substitutions] += 1
-
-                # Record that a read of this length was mapped
-                stats["mapped_lengths"][length] += 1
-
-                # And that a read with this many aligned primary bases was found
-                stats["aligned_lengths"][aligned_length] += 1
-
-                # We won't see an unaligned primary alignment for this read, so
-                # count the read
-                stats["total_reads"] += 1
-
-        elif not alignment.get("is_secondary", False):
-            # We have an unmapped primary "alignment"
-
-            # Count the read by its primary alignment
-            stats["total_reads"] += 1
-
-            # Record that an unmapped read has this length
-            stats["unmapped_lengths"][length] += 1
-
-        # Save the alignment for checking for wayward secondaries
-        last_alignment = alignment
+    engine = StatsEngine(CALLING_COLLECTORS, node_sequences)
+    stats = engine.run(alignment_file, run_time=run_time)
 
     with open(stats_file, "w") as stats_handle:
         # Save the stats as JSON
         json.dump(stats, stats_handle)
 
-    if read_alignment.wait() != 0:
-        # Complain if vg dies
-        raise RuntimeError("vg died with error {}".format(
-            read_alignment.returncode))
-
 def run_calling(options, job_cores):
     
     graph_filename = ntpath.basename(options.vg_graph)
@@ -673,9 +365,11 @@ def run_calling(options, job_cores):
     vcf_path = options.out_dir + "/" + options.sample_name + ".vcf"
     xg_path = options.out_dir + "/" + graph_filename + ".xg"
     offset = xg_path_node_offset(xg_path, options.path_name, options.offset)
-    run("glenn2vcf {} {} -o {} -c {} -s {} -l {} > {} 2> {}".format(
-        ag_path, tsv_path, options.offset, options.path_name, options.sample_name, options.path_size,
-        vcf_path + ".us", vcf_path + ".log"))
+    # The log has the bases dropped, etc.
+    run_pipeline([["glenn2vcf", ag_path, tsv_path, "-o", str(options.offset),
+        "-c", options.path_name, "-s", options.sample_name, "-l",
+        str(options.path_size)]], stdout=vcf_path + ".us",
+        stderr=vcf_path + ".log")
     sort_vcf(vcf_path + ".us", vcf_path)
     run("rm {}".format(vcf_path + ".us"))
     run("bgzip {}".format(vcf_path))
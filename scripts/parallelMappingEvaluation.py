@@ -8,17 +8,45 @@ BAM files with reads must have been already downloaded.
 """
 
 import argparse, sys, os, os.path, random, subprocess, shutil, itertools, glob
-import doctest, re, json, collections, time, timeit
+import doctest, re, json, collections, time, timeit, math
 import logging, logging.handlers, SocketServer, struct, socket, threading
 import string
 import urlparse
 import fnmatch
+import multiprocessing.pool
+import hashlib
+import distutils.spawn
 
 import dateutil.parser
 
 from toil.job import Job
 
 from toillib import *
+from vglib import *
+from gamstats import *
+
+# These are the most resources each kind of big job will ask for, and what they
+# ask for when there's no model from earlier runs, or with --fixed_resources.
+DEFAULT_RESOURCES = {
+    "run_region_alignments": {"cores": 16, "memory": 100 * 1024 ** 3,
+        "disk": 50 * 1024 ** 3},
+    "index_region_and_run_samples": {"cores": 16, "memory": 100 * 1024 ** 3,
+        "disk": 50 * 1024 ** 3},
+    "run_alignment": {"cores": 16, "memory": 100 * 1024 ** 3,
+        "disk": 50 * 1024 ** 3},
+    "run_alignment_chunk": {"cores": 16, "memory": 100 * 1024 ** 3,
+        "disk": 20 * 1024 ** 3}
+}
+
+# These rules of thumb shrink the cores and disk requested for small inputs.
+# They are only used for jobs we have a fitted model for, or with
+# --scale_resources, since they are guesses.
+# How many bases of graph sequence should each indexing core get?
+INDEX_BASES_PER_CORE = 1000000
+# How many bytes of FASTQ should each alignment core get?
+ALIGNMENT_BYTES_PER_CORE = 100 * 1024 ** 2
+# How much disk do we need to index a graph, as a multiple of its file size?
+INDEX_DISK_FACTOR = 50
 
 def parse_args(args):
     """
@@ -68,7 +96,10 @@ def parse_args(args):
     parser.add_argument("--restat", default=False, action="store_true",
         help="recompute and overwrite existing stats files")
     parser.add_argument("--reindex", default=False, action="store_true",
-        help="don't re-use existing indexed graphs")
+        help="download graphs again, and only re-use existing indexes if the "
+        "graph contents, parameters, and vg binary are the same")
+    parser.add_argument("--force_reindex", action="store_true",
+        help="don't re-use existing indexed graphs at all")
     parser.add_argument("--alignments_too_old", default=None, type=str,
         help="recompute alignments older than this date")
     parser.add_argument("--stats_too_old", default=None, type=str,
@@ -80,10 +111,52 @@ def parse_args(args):
         help="use the pruned graph in the index")
     parser.add_argument("--include_primary", action="store_true",
         help="use the primary path in the index")
+    parser.add_argument("--save_pruned_graphs", action="store_true",
+        help="save the pruned graphs that GCSA2 indexes are made from in the "
+        "output store under debug/")
     parser.add_argument("--serialize_downloads", action="store_true",
         help="download and index graphs one at a time")
+    parser.add_argument("--downloads_per_host", type=int, default=4,
+        help="download at most this many graphs from each server at once, or "
+        "0 for no limit")
+    parser.add_argument("--stream_downloads", action="store_true",
+        help="convert graphs from servers as they download, without saving "
+        "the JSON first")
     parser.add_argument("--min_gam_size", type=int, default=1024, 
         help="minimum size of a legitimate GAM file to accept")
+    parser.add_argument("--gam_reader", choices=["native", "json"],
+        default="native",
+        help="decode GAMs directly, or through vg view JSON, for stats")
+    parser.add_argument("--stats_processes", type=int, default=1,
+        help="split GAMs into shards and compute stats in this many processes")
+    parser.add_argument("--sequence_sidecar", action="store_true",
+        help="save packed node sequences in indexes for stats jobs to map")
+    parser.add_argument("--fan_out_width", type=int, default=10,
+        help="give no job more than this many children when queueing samples")
+    parser.add_argument("--fan_out_batch", type=int, default=10,
+        help="queue this many samples from each job")
+    parser.add_argument("--stream_stats", action="store_true",
+        help="compute stats from vg map's output as it aligns, instead of "
+        "in a separate job that reads the GAM back")
+    parser.add_argument("--scatter_chunks", type=int, default=1,
+        help="split each sample's reads into this many chunks to align in "
+        "parallel")
+    parser.add_argument("--metrics_report", default=None,
+        help="write job timing and memory metrics to this prefix .tsv and "
+        ".json")
+    parser.add_argument("--resource_report", action="append", default=[],
+        help="size jobs using memory measurements in this --metrics_report "
+        "JSON from an earlier run")
+    parser.add_argument("--resource_margin", type=float, default=1.5,
+        help="request this multiple of the estimated memory and disk")
+    parser.add_argument("--fixed_resources", action="store_true",
+        help="always request the full default resources for big jobs")
+    parser.add_argument("--scale_resources", action="store_true",
+        help="scale cores and disk for big jobs to their input sizes, even "
+        "without a --resource_report to model them from")
+    parser.add_argument("--index_codec", default=DIRECTORY_CODEC,
+        choices=sorted(DIRECTORY_CODECS.keys()),
+        help="compress index tarballs with this codec, on all the job's cores")
     
     
     # The command line arguments start with the program name, which we don't
@@ -93,34 +166,7 @@ def parse_args(args):
     return parser.parse_args(args)
     
     
-# Reverse complement needs a global translation table
-reverse_complement_translation_table = string.maketrans("ACGTN", "TGCAN")
-def reverse_complement(sequence):
-    """
-    Compute the reverse complement of a DNA sequence.
-    
-    Follows algorithm from <http://stackoverflow.com/a/26615937>
-    """
-    
-    if isinstance(sequence, unicode):
-        # Encode the sequence in ASCII for easy translation
-        sequence = sequence.encode("ascii", "replace")
-    
-    # Translate and then reverse
-    return sequence.translate(reverse_complement_translation_table)[::-1]
-    
-def count_Ns(sequence):
-    """
-    Return the number of N bases in the given DNA sequence
-    """
-    
-    n_count = 0
-    for item in sequence:
-        if item == "N":
-            n_count += 1
-            
-    return n_count
-
+@metered_job
 def run_all_alignments(job, options):
     """
     For each server listed in the server_list tsv, kick off child jobs to
@@ -158,11 +204,8 @@ def run_all_alignments(job, options):
     # Make sure we skip the header
     is_first = True
     
-    # We may want to run all the download-and-index jobs as follow-ons of this
-    # job, or we may want to run them in serial, so as to not overload the
-    # location we're downloading from. So each next download job is added as a
-    # follow on of this one.
-    download_predecessor_job = job
+    # This holds the region and URL for each graph to do
+    graphs = []
     
     for line in options.server_list:
         if is_first:
@@ -185,26 +228,44 @@ def run_all_alignments(job, options):
             
         # Pull out the first 3 fields
         region, url, generator = parts[0:3]
-        
-        # We cleverly just split the lines out to different nodes.
-        download_successor_job = download_predecessor_job.addFollowOnJobFn(
-            run_region_alignments, options, bin_dir_id, region, url,
-            cores=16, memory="100G", disk="50G")
-            
-        # Say what we did
-        RealTimeLogger.get().info("Adding downloader for {}".format(parts[1]))
-        
-        if options.serialize_downloads:
-            # The next download job needs to be a follow-on of this download job
-            download_predecessor_job = download_successor_job
+        graphs.append((region, url))
+        
+    # We don't want to overload the servers we're downloading from. So we split
+    # the graphs into lanes, with only so many lanes per server (or just one
+    # lane, if we're serializing downloads), and chain the download-and-index
+    # jobs in each lane as follow-ons of each other. Each download job starts
+    # when the previous one in its lane has its graph, while indexing for the
+    # previous one goes on.
+    if options.serialize_downloads:
+        lanes = [graphs]
+    else:
+        lanes = bounded_lanes(graphs, lambda graph: url_host(graph[1]),
+            options.downloads_per_host)
+    
+    for lane in lanes:
+        # Each lane starts as a follow-on of this job
+        download_predecessor_job = job
+        
+        for region, url in lane:
+            # We cleverly just split the lines out to different nodes.
+            download_predecessor_job = \
+                download_predecessor_job.addFollowOnJobFn(
+                run_region_alignments, options, bin_dir_id, region, url,
+                **options.resource_estimator.estimate("run_region_alignments"))
+                
+            # Say what we did
+            RealTimeLogger.get().info("Adding downloader for {}".format(url))
         
 
+@metered_job
 def run_region_alignments(job, options, bin_dir_id, region, url):
     """
     For the given region, download, index, and then align to the given graph.
     
     """
     
+    RealTimeMetrics.add_tags(region=region)
+    
     RealTimeLogger.get().info("Running on {} for {}".format(url, region))
     
     # Set up the IO stores each time, since we can't unpickle them on Azure for
@@ -252,10 +313,14 @@ def run_region_alignments(job, options, bin_dir_id, region, url):
     # Also for statistics
     stats_dir = "stats/{}/{}".format(region, graph_name)
     
+    # Get the sizes and mtimes of all the existing stats and alignment files
+    # at once, instead of asking about each file.
+    stats_file_stats = out_store.stat_directory(stats_dir)
+    alignment_file_stats = out_store.stat_directory(alignment_dir)
+    
     # What smaples have been completed? Map from ID to mtime
     completed_samples = {}
-    for filename, mtime in out_store.list_input_directory(stats_dir,
-        with_times=True):
+    for filename, (_, mtime) in stats_file_stats.iteritems():
         # See if every file is a stats file
         match = re.match("(.*)\.json$", filename)
     
@@ -263,12 +328,9 @@ def run_region_alignments(job, options, bin_dir_id, region, url):
             # Skip random extra files
             continue
         
-        # Get the size of the corresponding GAM, if it exists
-        gam_size = out_store.get_size("{}/{}.gam".format(alignment_dir,
-            match.group(1)))
-        # And its mtime
-        gam_mtime = out_store.get_mtime("{}/{}.gam".format(alignment_dir,
-            match.group(1)))
+        # Get the size of the corresponding GAM, and its mtime, if it exists
+        gam_size, gam_mtime = alignment_file_stats.get("{}.gam".format(
+            match.group(1)), (None, None))
     
         if (gam_size is None or
             gam_size < options.min_gam_size or 
@@ -334,46 +396,34 @@ def run_region_alignments(job, options, bin_dir_id, region, url):
             # We need to run this sample
             samples_to_run.append(sample)
             
-    if len(samples_to_run) == 0 and not options.reindex:
+    if len(samples_to_run) == 0 and not (options.reindex or
+        options.force_reindex):
         # Don't bother indexing the graph if all the samples are done, and we
         # didn't explicitly ask to do it.
         RealTimeLogger.get().info("Nothing to align to {}".format(basename))
         return
     
     
-    # Where will the indexed graph go in the output
-    index_key = "indexes/{}-{}-{}/{}/{}.tar.gz".format(options.index_mode,
-        options.kmer_size, options.edge_max, region, graph_name)
+    # Indexes are saved under the hash of what went into them, and the
+    # manifest for this graph name says which one the graph had last time.
+    manifest_key = manifest_key_for(options, region, graph_name)
     
-    if (not options.reindex) and out_store.exists(index_key):
-        # See if we have an index already available in the output store from a
-        # previous run
-        
+    # See if we have an index already available in the output store from a
+    # previous run
+    index_key = None
+    if not (options.reindex or options.force_reindex):
+        index_key = find_saved_index(job, options, out_store, manifest_key,
+            region, graph_name)
+    
+    if index_key is not None:
         RealTimeLogger.get().info("Retrieving indexed {} graph from output "
             "store".format(basename))
             
-        # Download the pre-made index directory
-        tgz_file = "{}/index.tar.gz".format(job.fileStore.getLocalTempDir())
-        out_store.read_input_file(index_key, tgz_file)
-        
-        # Save it to the global file store and keep around the ID.
-        # Will be compatible with read_global_directory
-        index_dir_id = job.fileStore.writeGlobalFile(tgz_file, cleanup=True)
-        
-        RealTimeLogger.get().info("Index for {} retrieved "
-            "successfully".format(basename))
-        
         # We already have the index, so we can move straight on to the actual
         # running of samples, after this job ends. Don't make them children as
         # other jobs may be waiting on this download to finish.
-        RealTimeLogger.get().info("Queueing alignment of {} samples to "
-        "{} {}".format(len(samples_to_run), graph_name, region))
-            
-        job.addFollowOnJobFn(recursively_run_samples, options, bin_dir_id, 
-            graph_name, region, index_dir_id, samples_to_run,
-            cores=1, memory="4G", disk="4G")
-                
-        RealTimeLogger.get().info("Done making children for {}".format(basename))
+        queue_saved_index(job, options, out_store, index_key, bin_dir_id,
+            graph_name, region, samples_to_run)
         
     else:
         # Download the graph, put it in the file store, and queue up a job to
@@ -386,112 +436,80 @@ def run_region_alignments(job, options, bin_dir_id, region, url):
         
         graph_filename = "{}/graph.vg".format(graph_dir)
         
-        # Download and fix up the graph with this ugly subprocess pipeline
-        # sg2vg "${URL}" -u | vg view -Jv - | vg mod -X 100 - | 
-        # vg ids -s - > "graphs/${BASENAME}.vg"
-        
-        with open(graph_filename, "w") as output_file:
-        
-            # Hold all the popen objects we need for this
-            tasks = []
+        # Get a pipeline that spits out the graph in vg format
+        download_commands, commands, pipeline_input = graph_fetch_pipeline(
+            options, url, bin_prefix, job.fileStore.getLocalTempDir())
             
-            if url_parts.scheme == "file":
-                # Grab the vg graph from a local file
-                
-                RealTimeLogger.get().info("Reading {} to {}".format(
-                    url, graph_filename))
-                    
-                # Just cat the file. We need a process so we can do the
-                # tasks[-1].stdout trick.
-                tasks.append(subprocess.Popen(["cat", url_parts.path],
-                    stdout=subprocess.PIPE))
+        if len(download_commands) > 0:
+            # We have to download the graph before converting it
+            RealTimeLogger.get().info("Downloading {} to {}".format(url,
+                pipeline_input))
             
-            elif url.endswith(".vg"):
-                # Assume it's a vg file
-                
-                RealTimeLogger.get().info("Downloading {} to {}".format(
-                    url, graph_filename))
-                    
-                tasks.append(subprocess.Popen(["curl", url],
-                    stdout=subprocess.PIPE))
-                
-            else:
-                # Assume it's on a server
-                
-                # Make the real URL with the version
-                versioned_url = url + options.server_version
-                
-                # We'll download to this JSON file, and then run the rest of the
-                # pipeline
-                graph_json = "{}/graph.json".format(
-                    job.fileStore.getLocalTempDir())
-                
-                RealTimeLogger.get().info("Downloading {} to {}".format(
-                    versioned_url, graph_json))
-                
-                @backoff
-                def try_download(url, filename):
-                    """
-                    Try downloading the URL to the file with sg2vg. Annotated
-                    with randomized exponential backoff from toillib.
-                    """
-                    
-                    RealTimeLogger.get().info("Trying to download {}".format(
-                        url))
-                    
-                    handle = open(filename, 'w')
-                    subprocess.check_call(["{}sg2vg".format(bin_prefix),
-                        url, "-u"], stdout=handle)
-                    # We sometimes manage not to be able to read our children's
-                    # writes for some reason.
-                    time.sleep(10)
-                    handle.close()
-                
-                # Do the download
-                try_download(versioned_url, graph_json)
-                
-                RealTimeLogger.get().info("Converting {} to {}".format(
-                    versioned_url, graph_filename))
-                
-                # Convert to vg
-                tasks.append(subprocess.Popen(["{}vg".format(bin_prefix),
-                    "view", "-Jv", "-"], stdin=open(graph_json),
-                    stdout=subprocess.PIPE))
+            # Do the download, with randomized exponential backoff from
+            # toillib.
+            backoff(run_pipeline)(download_commands, stdout=pipeline_input)
+        
+        # And cut nodes
+        commands.append(["{}vg".format(bin_prefix), "mod", "-X100", "-"])
             
-            # And cut nodes
-            tasks.append(subprocess.Popen(["{}vg".format(bin_prefix), "mod",
-                "-X100", "-"], stdin=tasks[-1].stdout, stdout=subprocess.PIPE))
-                
-            # And sort ids
-            tasks.append(subprocess.Popen(["{}vg".format(bin_prefix), "ids",
-                "-s", "-"], stdin=tasks[-1].stdout, stdout=output_file))
-                
-            # Did we make it through all the tasks OK?
-            for task in tasks:
-                if task.wait() != 0:
-                    raise RuntimeError("Pipeline step returned {}".format(
-                        task.returncode))
-                     
-        # TODO: We sometimes don't see the files written immediately, for some
-        # reason. Maybe because we opened them? Anyway, this is a hack to wait
-        # for them to be on disk and readable.
-        time.sleep(1)
+        # And sort ids
+        commands.append(["{}vg".format(bin_prefix), "ids", "-s", "-"])
+        
+        RealTimeLogger.get().info("Fetching and converting {} to {}".format(
+            url, graph_filename))
+        
+        # Download and fix up the graph with this ugly subprocess pipeline
+        # sg2vg "${URL}" -u | vg view -Jv - | vg mod -X 100 - | 
+        # vg ids -s - > "graphs/${BASENAME}.vg"
+        # If it's downloading, it might fail on the network, and since the
+        # pipeline writes the graph from scratch we can just run it again.
+        if pipeline_input is None:
+            backoff(run_pipeline)(commands, stdout=graph_filename)
+        else:
+            run_pipeline(commands, stdin=pipeline_input, stdout=graph_filename)
+        
+        # Work out what the index would be called, from what goes into it
+        manifest = index_manifest(options, graph_filename,
+            find_vg_binary(bin_prefix), url)
+        index_key = "indexes/sha256/{}.tar.gz".format(manifest["hash"])
+        
+        if (not options.force_reindex) and out_store.exists(index_key):
+            # The graph, parameters, and vg are all the same as an index we
+            # already made, maybe under another name. Use that.
+            RealTimeLogger.get().info("Reusing index {} for unchanged "
+                "{}".format(index_key, basename))
+            save_manifest(job, out_store, manifest, manifest_key)
+            queue_saved_index(job, options, out_store, index_key, bin_dir_id,
+                graph_name, region, samples_to_run)
+            return
         
         # Put graph in file store
         graph_id = job.fileStore.writeGlobalFile(graph_filename)   
         
+        # Measure the graph, so we can ask for what indexing it will need
+        graph_features = measure_graph(options, graph_filename, bin_prefix)
+        resources = index_resources(options, graph_features)
+        
+        RealTimeLogger.get().info("Requesting {} cores, {} bytes of memory, "
+            "and {} bytes of disk to index {}".format(resources["cores"],
+            resources["memory"], resources["disk"], basename))
+        
         # Queue an indexing follow-on
         job.addFollowOnJobFn(index_region_and_run_samples, options, bin_dir_id,
-            region, url, graph_id, samples_to_run,
-            cores=16, memory="100G", disk="50G")
+            region, url, graph_id, samples_to_run, graph_features, manifest,
+            **resources)
         
+@metered_job
 def index_region_and_run_samples(job, options, bin_dir_id, region, url,
-    graph_id, samples_to_run):
+    graph_id, samples_to_run, graph_features, manifest):
     """
     For a region whose graph has already been downloaded, create and save the
-    index.
+    index. graph_features is the dict of graph sizes from measure_graph, and
+    manifest is the dict from index_manifest, which says where the index goes.
     """
     
+    RealTimeMetrics.add_tags(region=region)
+    
     RealTimeLogger.get().info("Indexing {} for {}".format(url, region))
     
     # Set up the IO stores each time, since we can't unpickle them on Azure for
@@ -532,6 +550,8 @@ def index_region_and_run_samples(job, options, bin_dir_id, region, url,
     # Get graph name (without region and its associated dash) from basename
     graph_name = basename.replace("-{}".format(region), "").replace(
         "{}-".format(region), "")
+    RealTimeMetrics.add_tags(graph=graph_name)
+    record_features(graph_features)
     
     # Download the graph
     job.fileStore.readGlobalFile(graph_id, graph_filename)    
@@ -552,162 +572,213 @@ def index_region_and_run_samples(job, options, bin_dir_id, region, url,
         # We want a GCSA2/xg index. We have to prune the graph ourselves.
         # See <https://github.com/vgteam/vg/issues/286>.
         
-        # What will we use as our temp combined graph file (containing only
-        # the bits of the graph we want to index, used for deduplication)?
-        to_index_filename = "{}/to_index.vg".format(
-            job.fileStore.getLocalTempDir())
+        # The XG index only needs the graph, so we build it in the background
+        # while the pruning, kmer finding, and GCSA2 indexing go on. It gets a
+        # share of the cores, and the GCSA2 side gets the rest.
+        xg_threads = max(1, job.cores / 4)
+        gcsa_threads = max(1, job.cores - xg_threads)
         
-        # Where will we save the kmers?
-        kmers_filename = "{}/index.graph".format(
-            job.fileStore.getLocalTempDir())
+        # Where do we put the XG index?
+        xg_filename = graph_filename + ".xg"
+        
+        RealTimeLogger.get().info("XG-indexing {} to {}".format(
+                graph_filename, xg_filename))
+                
+        # Time each side, so we can say how much doing them together saved
+        start_time = timeit.default_timer()
+        
+        def build_xg():
+            """
+            Build the XG index, and return how long it took.
+            """
             
-        with open(to_index_filename, "w") as to_index_file:
+            run_pipeline([["{}vg".format(bin_prefix), "index", "-t",
+                str(xg_threads), "-x", xg_filename, graph_filename]],
+                outputs=[xg_filename])
+            return timeit.default_timer() - start_time
+        
+        xg_pool = multiprocessing.pool.ThreadPool(1)
+        xg_result = xg_pool.apply_async(build_xg)
+        
+        try:
+            # Where will we save the kmers? GCSA2 construction needs them in a
+            # file.
+            kmers_filename = "{}/index.graph".format(
+                job.fileStore.getLocalTempDir())
             
-            if options.include_pruned:
+            # The pruned graph and primary path get streamed into kmer finding
+            # through this pipe, instead of being saved first.
+            read_fd, write_fd = os.pipe()
+            to_index_input = os.fdopen(read_fd)
+            to_index_stream = os.fdopen(write_fd, "w")
+        
+            def write_to_index():
+                """
+                Write the parts of the graph we want to index to the pipe, one
+                after the other.
+                """
             
-                RealTimeLogger.get().info("Pruning {} to {}".format(
-                    graph_filename, to_index_filename))
-                
-                # Prune out hard bits of the graph
-                tasks = []
+                try:
+                    if options.include_pruned:
                 
-                # Prune out complex regions
-                tasks.append(subprocess.Popen(["{}vg".format(bin_prefix), "mod",
-                    "-p", "-l", str(options.kmer_size), "-t", str(job.cores),
-                    "-e", str(options.edge_max), graph_filename],
-                    stdout=subprocess.PIPE))
+                        RealTimeLogger.get().info("Pruning {}".format(
+                            graph_filename))
                     
-                # Throw out short disconnected chunks
-                tasks.append(subprocess.Popen(["{}vg".format(bin_prefix), "mod",
-                    "-S", "-l", str(options.kmer_size * 2),
-                    "-t", str(job.cores), "-"], stdin=tasks[-1].stdout,
-                    stdout=to_index_file))
+                        # Prune out hard bits of the graph: first complex
+                        # regions, and then short disconnected chunks.
+                        run_pipeline([["{}vg".format(bin_prefix), "mod",
+                            "-p", "-l", str(options.kmer_size), "-t",
+                            str(gcsa_threads), "-e", str(options.edge_max),
+                            graph_filename], ["{}vg".format(bin_prefix), "mod",
+                            "-S", "-l", str(options.kmer_size * 2), "-t",
+                            str(gcsa_threads), "-"]], stdout=to_index_stream)
                     
-                # Did we make it through all the tasks OK?
-                for task in tasks:
-                    if task.wait() != 0:
-                        raise RuntimeError("Pipeline step returned {}".format(
-                            task.returncode))
-                            
-                time.sleep(1)
-                
-            if options.include_primary:
-            
-                # Then append in the primary path. Since we don't knoiw what
-                # "it's called, we retain "ref" and all the 19", "6", etc paths
-                # "from 1KG.
-                
-                RealTimeLogger.get().info(
-                    "Adding primary path to {}".format(to_index_filename))
+                    if options.include_primary:
                 
-                # See
-                # https://github.com/vgteam/vg/issues/318#issuecomment-215102199
-                
-                # Generate all the paths names we might have for primary paths.
-                # It should be "ref" but some graphs don't listen
-                ref_names = (["ref", "x", "X", "y", "Y", "m", "M"] +
-                    [str(x) for x in xrange(1, 23)])
+                        # Then append in the primary path. Since we don't
+                        # knoiw what "it's called, we retain "ref" and all the
+                        # 19", "6", etc paths "from 1KG.
                     
-                ref_options = []
-                for name in ref_names:
-                    # Put each in a -r option to retain the path
-                    ref_options.append("-r")
-                    ref_options.append(name)
-
-                tasks = []
-
-                # Retain only the specified paths (only one should really exist)
-                tasks.append(subprocess.Popen(
-                    ["{}vg".format(bin_prefix), "mod", "-N"] + ref_options + 
-                    ["-t", str(job.cores), graph_filename], 
-                    stdout=to_index_file))
+                        RealTimeLogger.get().info("Adding primary path of "
+                            "{}".format(graph_filename))
                     
-                # TODO: if we merged the primary path back on itself, it's
-                # possible for it to braid with itself. Right now we just ignore
-                # this and let those graphs take a super long time to index.
+                        # See <https://github.com/vgteam/vg/issues/318
+                        # #issuecomment-215102199>
                     
-                # Wait for this second pipeline. We don't parallelize with the
-                # first one so we don't need to use an extra cat step.
-                for task in tasks:
-                    if task.wait() != 0:
-                        raise RuntimeError("Pipeline step returned {}".format(
-                            task.returncode))
-                         
-                # Wait to make sure no weird file-not-being-full bugs happen
-                # TODO: how do I wait on child process output?
-                time.sleep(1)
-            
-        time.sleep(1)
-            
-        # Now we have the combined to-index graph in one vg file. We'll load
-        # it (which deduplicates nodes/edges) and then find kmers.
-            
-        # Save the intermediate vg file, in case we want to look at it
-        out_store.write_output_file(to_index_filename,
-            "debug/{}-{}-{}-{}-{}.vg".format(options.index_mode,
-            options.kmer_size, options.edge_max, region, graph_name))
+                        # Generate all the paths names we might have for
+                        # primary paths. It should be "ref" but some graphs
+                        # don't listen
+                        ref_names = (["ref", "x", "X", "y", "Y", "m", "M"] +
+                            [str(x) for x in xrange(1, 23)])
+                        
+                        ref_options = []
+                        for name in ref_names:
+                            # Put each in a -r option to retain the path
+                            ref_options.append("-r")
+                            ref_options.append(name)
+
+                        # Retain only the specified paths (only one should
+                        # really exist).
+                        run_pipeline([["{}vg".format(bin_prefix), "mod",
+                            "-N"] + ref_options + ["-t", str(gcsa_threads),
+                            graph_filename]], stdout=to_index_stream)
+                        
+                        # TODO: if we merged the primary path back on itself,
+                        # it's possible for it to braid with itself. Right now
+                        # we just ignore this and let those graphs take a super
+                        # long time to index.
+                finally:
+                    # Let the kmer finding know it has everything
+                    to_index_stream.close()
+                
+            to_index_pool = multiprocessing.pool.ThreadPool(1)
+            to_index_result = to_index_pool.apply_async(write_to_index)
+        
+            try:
+                # Now we have the combined to-index graph coming down the
+                # pipe. We'll load it (which deduplicates nodes/edges) and then
+                # find kmers.
+                commands = [["{}vg".format(bin_prefix), "view", "-v", "-"],
+                    ["{}vg".format(bin_prefix), "kmers", "-g", "-B", "-k",
+                    str(options.kmer_size), "-H", "1000000000", "-T",
+                    "1000000001", "-t", str(gcsa_threads), "-"]]
             
-        with open(kmers_filename, "w") as kmers_file:
+                # What will we use as our temp combined graph file (containing
+                # only the bits of the graph we want to index, used for
+                # deduplication), if we want to look at it?
+                to_index_filename = "{}/to_index.vg".format(
+                    job.fileStore.getLocalTempDir())
         
-            tasks = []
-            
-            RealTimeLogger.get().info("Finding kmers in {} to {}".format(
-                to_index_filename, kmers_filename))
+                if options.save_pruned_graphs:
+                    # Save a copy of the intermediate vg file on the way through
+                    commands.insert(0, ["tee", to_index_filename])
+        
+                RealTimeLogger.get().info("Finding kmers in {} to {}".format(
+                    graph_filename, kmers_filename))
             
-            # Deduplicate the graph
-            # Discard warnings about duplicate nodes or edges
-            tasks.append(subprocess.Popen(["{}vg".format(bin_prefix),
-                "view", "-v", to_index_filename],
-                stdout=subprocess.PIPE, stderr=open(os.devnull, 'wb')))
+                try:
+                    # Deduplicate the graph, and make the GCSA2 kmers file.
+                    # Don't pass on warnings about duplicate nodes or edges,
+                    # unless it fails.
+                    with to_index_input:
+                        run_pipeline(commands, stdin=to_index_input,
+                            stdout=kmers_filename, quiet=[len(commands) - 2])
+                except:
+                    # The pruning will probably die of a broken pipe now, but
+                    # that's not the real problem. Wait for it and report this
+                    # error.
+                    error = sys.exc_info()
+                    to_index_result.wait()
+                    raise error[0], error[1], error[2]
             
-            # Make the GCSA2 kmers file
-            tasks.append(subprocess.Popen(["{}vg".format(bin_prefix),
-                "kmers", "-g", "-B", "-k", str(options.kmer_size),
-                "-H", "1000000000", "-T", "1000000001",
-                "-t", str(job.cores), "-"], stdin=tasks[-1].stdout,
-                stdout=kmers_file))
+                # Make sure the pruning actually worked
+                to_index_result.get()
+            finally:
+                # Nobody is going to read any more of the pipe, so the pruning
+                # can't block on it, and we can wait for it to stop.
+                to_index_input.close()
+                to_index_pool.close()
+                to_index_pool.join()
                 
-            # Did we make it through all the tasks OK?
-            task_number = 0
-            for task in tasks:
-                if task.wait() != 0:
-                    raise RuntimeError(
-                        "Pipeline step {} returned {}".format(
-                        task_number, task.returncode))
-                task_number += 1
+            if options.save_pruned_graphs:
+                # Save the intermediate vg file, in case we want to look at it
+                out_store.write_output_file(to_index_filename,
+                    "debug/{}-{}-{}-{}-{}.vg".format(options.index_mode,
+                    options.kmer_size, options.edge_max, region, graph_name))
                         
-            # Wait to make sure no weird file-not-being-full bugs happen
-            # TODO: how do I wait on child process output?
-            time.sleep(1)
-            
-        time.sleep(1)
-                        
-        # Where do we put the GCSA2 index?
-        gcsa_filename = graph_filename + ".gcsa"
+            # Where do we put the GCSA2 index?
+            gcsa_filename = graph_filename + ".gcsa"
         
-        RealTimeLogger.get().info("GCSA-indexing {} to {}".format(
-                kmers_filename, gcsa_filename))
+            RealTimeLogger.get().info("GCSA-indexing {} to {}".format(
+                    kmers_filename, gcsa_filename))
         
-        # Make the gcsa2 index. Make sure to use 3 doubling steps to work
-        # around <https://github.com/vgteam/vg/issues/301>
-        subprocess.check_call(["{}vg".format(bin_prefix), "index", "-t",
-            str(job.cores), "-i", kmers_filename, "-g", gcsa_filename,
-            "-X", "3", "-Z", "2000"])
+            # Make the gcsa2 index. Make sure to use 3 doubling steps to work
+            # around <https://github.com/vgteam/vg/issues/301>
+            run_pipeline([["{}vg".format(bin_prefix), "index", "-t",
+                str(gcsa_threads), "-i", kmers_filename, "-g", gcsa_filename,
+                "-X", "3", "-Z", "2000"]], outputs=[gcsa_filename])
             
-        # Where do we put the XG index?
-        xg_filename = graph_filename + ".xg"
-        
-        RealTimeLogger.get().info("XG-indexing {} to {}".format(
-                graph_filename, xg_filename))
-                
-        subprocess.check_call(["{}vg".format(bin_prefix), "index", "-t",
-            str(job.cores), "-x", xg_filename, graph_filename])
+            gcsa_time = timeit.default_timer() - start_time
+        except:
+            # Don't leave the XG indexing running in a work directory that's
+            # about to be cleaned up. Wait for it, and report our error instead
+            # of any it had.
+            error = sys.exc_info()
+            xg_result.wait()
+            raise error[0], error[1], error[2]
+        finally:
+            xg_pool.close()
+            xg_pool.join()
+            
+        # Pass along any error from the XG index
+        xg_time = xg_result.get()
+        
+        # Say how much running the two sides together saved, compared to
+        # running them one after the other.
+        wall_time = timeit.default_timer() - start_time
+        RealTimeMetrics.record("index_serial_seconds", xg_time + gcsa_time,
+            "seconds")
+        RealTimeMetrics.record("index_critical_path_seconds", wall_time,
+            "seconds")
+        RealTimeLogger.get().info("Indexed {} in {:.0f} seconds instead of "
+            "{:.0f} (XG {:.0f}, GCSA2 {:.0f}): saved {:.0f} seconds".format(
+            graph_name, wall_time, xg_time + gcsa_time, xg_time, gcsa_time,
+            xg_time + gcsa_time - wall_time))
     
     else:
         raise RuntimeError("Invalid indexing mode: " + options.index_mode)
         
+    if options.sequence_sidecar:
+        # Pack the node sequences into the index, so stats jobs can map them
+        # instead of re-reading the graph.
+        RealTimeLogger.get().info("Packing node sequences of {}".format(
+            graph_filename))
+        NodeSequenceStore.from_graph(graph_filename,
+            vg="{}vg".format(bin_prefix)).save(graph_dir)
+        
     # Define a file to keep the compressed index in, so we can send it to
-    # the output store.
+    # the output store. It keeps the .tar.gz name whatever the codec, so old
+    # and new indexes live at the same keys; readers detect the codec.
     index_dir_tgz = "{}/index.tar.gz".format(
         job.fileStore.getLocalTempDir())
         
@@ -716,11 +787,11 @@ def index_region_and_run_samples(job, options, bin_dir_id, region, url,
     RealTimeLogger.get().info("Compressing index of {}".format(
         graph_filename))
     index_dir_id = write_global_directory(job.fileStore, graph_dir,
-        cleanup=True, tee=index_dir_tgz)
+        cleanup=True, tee=index_dir_tgz, codec=options.index_codec,
+        threads=job.cores)
         
-    # Where will the indexed graph go in the output
-    index_key = "indexes/{}-{}-{}/{}/{}.tar.gz".format(options.index_mode,
-        options.kmer_size, options.edge_max, region, graph_name)
+    # Where will the indexed graph go in the output? It's named for its inputs.
+    index_key = "indexes/sha256/{}.tar.gz".format(manifest["hash"])
         
     # Save it as output
     RealTimeLogger.get().info("Uploading index of {}".format(
@@ -729,43 +800,59 @@ def index_region_and_run_samples(job, options, bin_dir_id, region, url,
     RealTimeLogger.get().info("Index {} uploaded successfully".format(
         index_key))
         
+    # Save the graph sizes next to it, so runs that reuse the index can size
+    # their alignment jobs.
+    features_file = "{}/features.json".format(job.fileStore.getLocalTempDir())
+    with open(features_file, "w") as features_stream:
+        json.dump(graph_features, features_stream)
+    out_store.write_output_file(features_file, features_key_for(index_key))
+    
+    # Now that the index is all there, point this graph's name at it
+    save_manifest(job, out_store, manifest, manifest_key_for(options, region,
+        graph_name))
+        
         
     # Now that we have the index, make the actual alignment children.        
     RealTimeLogger.get().info("Queueing alignment of {} samples to "
         "{} {}".format(len(samples_to_run), graph_name, region))
             
-    job.addChildJobFn(recursively_run_samples, options, bin_dir_id, 
+    job.addChildJobFn(run_samples, options, bin_dir_id, 
         graph_name, region, index_dir_id, samples_to_run,
-        cores=1, memory="4G", disk="4G")
+        graph_features=graph_features, cores=1, memory="4G", disk="4G")
             
     RealTimeLogger.get().info("Done making children for {}".format(basename))
    
-def recursively_run_samples(job, options, bin_dir_id, graph_name, region,
-    index_dir_id, samples_to_run, num_per_call=10):
+@metered_job
+def run_samples(job, options, bin_dir_id, graph_name, region, index_dir_id,
+    samples_to_run, graph_features=None):
     """
-    Create child jobs to run a few samples from the samples_to_run list, and a
-    recursive child job to create a few more.
-    
-    This is a hack to deal with the problems produced by having a job with
-    thousands of children on the Azure job store: the job graph gets cut up into
-    tiny chunks of data and stored as table values, and when you have many table
-    store operations one of them is likely to fail and screw up your whole
+    Queue up alignment or stats jobs for all the samples in samples_to_run,
+    against the given indexed graph.
+    
+    This looks up the existing GAM and stats files, and the input FASTQs, for
+    all the samples with one listing of each directory. Then it spreads the
+    samples over a balanced tree of fan_out jobs, which each queue up a batch
+    with queue_samples. We can't just make one job with thousands of children,
+    because on the Azure job store the job graph gets cut up into tiny chunks of
+    data and stored as table values, and when you have many table store
+    operations one of them is likely to fail and screw up your whole
     serialization process.
     
-    We have some logic here to decide how much of the sample needs to be rerun.
-    If we get a sample, all we know is that it doesn't have an up to date stats
-    file, but it may or may not have an alignment file already.
+    graph_features, if set, is the dict of graph sizes from measure_graph, used
+    with the FASTQ size to decide what resources each alignment job needs.
     
     """
     
+    RealTimeMetrics.add_tags(graph=graph_name, region=region)
+    
     # Set up the IO stores each time, since we can't unpickle them on Azure for
     # some reason.
     sample_store = IOStore.get(options.sample_store)
     out_store = IOStore.get(options.out_store)
     
-    # Get some samples to run
-    samples_to_run_now = samples_to_run[:num_per_call]
-    samples_to_run_later = samples_to_run[num_per_call:]
+    if graph_features is None:
+        # We don't know how big the graph is
+        graph_features = {}
     
     # Work out where samples for this region live
     region_dir = region.upper()    
@@ -776,7 +863,60 @@ def recursively_run_samples(job, options, bin_dir_id, graph_name, region,
     # Also for statistics
     stats_dir = "stats/{}/{}".format(region, graph_name)
     
-    for sample in samples_to_run_now:
+    # Look up all the existing files at once, instead of asking about each
+    # file for each sample.
+    alignment_file_stats = out_store.stat_directory(alignment_dir)
+    stats_file_stats = out_store.stat_directory(stats_dir)
+    input_file_stats = sample_store.stat_directory(region_dir)
+    
+    # This holds, for each sample, the sample name, the GAM size, GAM mtime,
+    # stats file mtime, and FASTQ size (each None if the file doesn't exist).
+    sample_stats = []
+    for sample in samples_to_run:
+        gam_size, gam_mtime = alignment_file_stats.get(
+            "{}.gam".format(sample), (None, None))
+        _, stats_mtime = stats_file_stats.get("{}.json".format(sample),
+            (None, None))
+        fastq_size, _ = input_file_stats.get("{}/{}.bam.fq".format(sample,
+            sample), (None, None))
+        sample_stats.append((sample, gam_size, gam_mtime, stats_mtime,
+            fastq_size))
+            
+    RealTimeLogger.get().info("Fanning out {} samples for {} {}".format(
+        len(sample_stats), graph_name, region))
+            
+    job.addChildJobFn(fan_out, queue_samples, sample_stats, (options,
+        bin_dir_id, graph_name, region, index_dir_id, graph_features),
+        width=options.fan_out_width, batch_size=options.fan_out_batch,
+        resources={"cores": 1, "memory": "4G", "disk": "4G"},
+        cores=1, memory="4G", disk="4G")
+    
+def queue_samples(job, sample_stats, options, bin_dir_id, graph_name, region,
+    index_dir_id, graph_features):
+    """
+    Create child jobs to align or compute stats for each of a batch of samples,
+    as needed. Called by fan_out from run_samples, with tuples of sample name,
+    GAM size, GAM mtime, stats file mtime, and FASTQ size.
+    
+    We have some logic here to decide how much of the sample needs to be rerun.
+    If we get a sample, all we know is that it doesn't have an up to date stats
+    file, but it may or may not have an alignment file already.
+    
+    """
+    
+    RealTimeMetrics.add_tags(graph=graph_name, region=region)
+    
+    # Work out where samples for this region live
+    region_dir = region.upper()    
+    
+    # Work out the directory for the alignments to be dumped in in the output
+    alignment_dir = "alignments/{}/{}".format(region, graph_name)
+    
+    # Also for statistics
+    stats_dir = "stats/{}/{}".format(region, graph_name)
+    
+    for (sample, gam_size, gam_mtime, stats_mtime,
+        fastq_size) in sample_stats:
         # Split out over each sample that needs to be run
         
         # For each sample, know the FQ name
@@ -786,14 +926,6 @@ def recursively_run_samples(job, options, bin_dir_id, graph_name, region,
         alignment_file_key = "{}/{}.gam".format(alignment_dir, sample)
         stats_file_key = "{}/{}.json".format(stats_dir, sample)
         
-        # How big is the GAM file (or None if it's not made yet):
-        gam_size = out_store.get_size(alignment_file_key)
-        # And when was it made (or None if it's not made yet)?
-        gam_mtime = out_store.get_mtime(alignment_file_key)
-        
-        # And the same for the stats file. We don't care about its size though.
-        stats_mtime = out_store.get_mtime(stats_file_key)
-        
         if (options.overwrite or
             gam_mtime is None or
             (options.alignments_too_old is not None and 
@@ -825,10 +957,18 @@ def recursively_run_samples(job, options, bin_dir_id, graph_name, region,
             
             # Go and bang that input fastq against the correct indexed graph.
             # Its output will go to the right place in the output store.
-            job.addChildJobFn(run_alignment, options, bin_dir_id, sample,
-                graph_name, region, index_dir_id, sample_fastq,
-                alignment_file_key, stats_file_key, 
-                cores=16, memory="100G", disk="50G")
+            if options.scatter_chunks > 1:
+                # Split it up so it doesn't hold up everything else.
+                job.addChildJobFn(scatter_alignment, options, bin_dir_id,
+                    sample, graph_name, region, index_dir_id, sample_fastq,
+                    alignment_file_key, stats_file_key, graph_features,
+                    fastq_size, cores=1, memory="4G", disk="50G")
+            else:
+                job.addChildJobFn(run_alignment, options, bin_dir_id, sample,
+                    graph_name, region, index_dir_id, sample_fastq,
+                    alignment_file_key, stats_file_key, graph_features,
+                    fastq_size, **alignment_resources(options, "run_alignment",
+                    graph_features, fastq_size))
         
         elif (options.restat or
             stats_mtime is None or
@@ -844,7 +984,8 @@ def recursively_run_samples(job, options, bin_dir_id, graph_name, region,
             
             job.addFollowOnJobFn(run_stats, options, bin_dir_id,
                 index_dir_id, alignment_file_key, stats_file_key,
-                run_time=None, cores=2, memory="4G", disk="10G")
+                run_time=None, cores=max(2, options.stats_processes),
+                memory="4G", disk="10G")
                     
         else:
             # The stats are up to date and the alignment doesn't need
@@ -852,43 +993,8 @@ def recursively_run_samples(job, options, bin_dir_id, graph_name, region,
             # be on the todo list. But it means we can just skip the sample.
             RealTimeLogger.get().warning("SKIPPING sample "
                 "{} on {} {}".format(sample, graph_name, region))
-                    
-    if len(samples_to_run_later) > 0:
-        # We need to recurse and run more later.
-        RealTimeLogger.get().debug("Postponing queueing {} samples".format(
-            len(samples_to_run_later)))
-            
-        if len(samples_to_run_later) < num_per_call:
-            # Just run them all in one batch
-            job.addChildJobFn(recursively_run_samples, options, bin_dir_id,
-                    graph_name, region, index_dir_id, samples_to_run_later,
-                    num_per_call, cores=1, memory="4G", disk="4G")
-        else:
-            # Split them up
-        
-            part_size = len(samples_to_run_later) / num_per_call
-            
-            RealTimeLogger.get().info("Splitting remainder of {} {} into {} "
-                "parts of {}".format(graph_name, region, num_per_call,
-                part_size))
-            
-            for i in xrange(num_per_call + 1):
-                # Do 1 more part for any remainder
-                
-                # Grab this bit of the rest
-                part = samples_to_run_later[(i * part_size) :
-                    ((i + 1) * part_size)]
-                
-                if len(part) > 0:
-                
-                    # Make a job to run it
-                    job.addChildJobFn(recursively_run_samples, options,
-                        bin_dir_id, graph_name, region, index_dir_id, part,
-                        num_per_call, cores=1, memory="4G", disk="4G")
-        
-        
-    
             
+@metered_job
 def save_indexed_graph(job, options, index_dir_id, output_key):
     """
     Save the index dir tar file in the given output key.
@@ -923,17 +1029,620 @@ def save_indexed_graph(job, options, index_dir_id, output_key):
         output_key))
     
    
+def manifest_key_for(options, region, graph_name):
+    """
+    Return the output store key for the manifest that says which index the
+    graph with the given name had, when indexed with the given options.
+    
+    Each graph name gets its own small manifest file, so jobs indexing
+    different graphs at the same time never have to update the same file.
+    
+    >>> options = argparse.Namespace(index_mode="gcsa-kmer", kmer_size=16,
+    ...     edge_max=3)
+    >>> manifest_key_for(options, "brca1", "cactus")
+    'indexes/gcsa-kmer-16-3/brca1/cactus.manifest.json'
+    
+    """
+    
+    return "indexes/{}-{}-{}/{}/{}.manifest.json".format(options.index_mode,
+        options.kmer_size, options.edge_max, region, graph_name)
+    
+def find_vg_binary(bin_prefix):
+    """
+    Return the path to the vg binary that will be used with the given binary
+    prefix.
+    
+    """
+    
+    if bin_prefix != "":
+        return "{}vg".format(bin_prefix)
+        
+    vg_binary = distutils.spawn.find_executable("vg")
+    if vg_binary is None:
+        raise RuntimeError("Could not find vg on the PATH")
+    return vg_binary
+    
+def index_manifest(options, graph_filename, vg_binary, url):
+    """
+    Work out what index the given normalized graph file would get with the
+    given options and vg binary.
+    
+    Returns a manifest dict, where "hash" is a hash of everything that goes into
+    the index, and the other entries say what those things were.
+    
+    Graphs with the same contents get the same index, whatever they are called,
+    and changing the indexing parameters (or vg) changes the index:
+    
+    >>> import tempfile
+    >>> options = argparse.Namespace(index_mode="gcsa-kmer", kmer_size=16,
+    ...     edge_max=3, include_pruned=True, include_primary=True,
+    ...     sequence_sidecar=False)
+    >>> def manifest_for(contents, name):
+    ...     graph = tempfile.NamedTemporaryFile()
+    ...     graph.write(contents)
+    ...     graph.flush()
+    ...     return index_manifest(options, graph.name, "/bin/sh",
+    ...         "file:///data/{}.vg".format(name))
+    >>> (manifest_for("GRAPH", "cactus")["hash"] ==
+    ...     manifest_for("GRAPH", "cactus-copy")["hash"])
+    True
+    >>> (manifest_for("GRAPH", "cactus")["hash"] ==
+    ...     manifest_for("OTHER", "cactus")["hash"])
+    False
+    >>> hash_before = manifest_for("GRAPH", "cactus")["hash"]
+    >>> options.kmer_size = 20
+    >>> manifest_for("GRAPH", "cactus")["hash"] == hash_before
+    False
+    >>> sorted(manifest_for("GRAPH", "cactus").keys())
+    ['graph_sha256', 'hash', 'parameters', 'url', 'vg_sha256']
+    
+    """
+    
+    # These are the options that change what's in the index
+    parameters = {
+        "index_mode": options.index_mode,
+        "kmer_size": options.kmer_size,
+        "edge_max": options.edge_max,
+        "include_pruned": options.include_pruned,
+        "include_primary": options.include_primary,
+        "sequence_sidecar": options.sequence_sidecar
+    }
+    
+    graph_sha256 = file_sha256(graph_filename)
+    vg_sha256 = file_sha256(vg_binary)
+    
+    # Hash a canonical serialization of all of it together
+    index_hash = hashlib.sha256(json.dumps({"graph": graph_sha256,
+        "vg": vg_sha256, "parameters": parameters},
+        sort_keys=True)).hexdigest()
+        
+    return {
+        "hash": index_hash,
+        "graph_sha256": graph_sha256,
+        "vg_sha256": vg_sha256,
+        "parameters": parameters,
+        "url": url
+    }
+    
+def save_manifest(job, out_store, manifest, manifest_key):
+    """
+    Save the given index manifest dict to the given key in the output store.
+    
+    """
+    
+    manifest_file = "{}/manifest.json".format(job.fileStore.getLocalTempDir())
+    with open(manifest_file, "w") as manifest_stream:
+        json.dump(manifest, manifest_stream, indent=2, sort_keys=True)
+    out_store.write_output_file(manifest_file, manifest_key)
+    
+def find_saved_index(job, options, out_store, manifest_key, region,
+    graph_name):
+    """
+    Return the output store key of the index the graph with the given name had
+    last time, or None if there isn't one saved.
+    
+    Falls back to the indexes that older runs saved by graph name.
+    
+    """
+    
+    if out_store.exists(manifest_key):
+        manifest_file = "{}/manifest.json".format(
+            job.fileStore.getLocalTempDir())
+        out_store.read_input_file(manifest_key, manifest_file)
+        with open(manifest_file) as manifest_stream:
+            manifest = json.load(manifest_stream)
+            
+        index_key = "indexes/sha256/{}.tar.gz".format(manifest["hash"])
+        if out_store.exists(index_key):
+            return index_key
+            
+    # Older runs put the index right where the manifest is now
+    index_key = re.sub("\.manifest\.json$", ".tar.gz", manifest_key)
+    if out_store.exists(index_key):
+        return index_key
+        
+    return None
+    
+def queue_saved_index(job, options, out_store, index_key, bin_dir_id,
+    graph_name, region, samples_to_run):
+    """
+    Get the index at the given key in the output store into the file store,
+    and queue up the given samples to run against it as a follow-on.
+    
+    """
+    
+    # Download the pre-made index directory
+    tgz_file = "{}/index.tar.gz".format(job.fileStore.getLocalTempDir())
+    out_store.read_input_file(index_key, tgz_file)
+    
+    # Save it to the global file store and keep around the ID.
+    # Will be compatible with read_global_directory
+    index_dir_id = job.fileStore.writeGlobalFile(tgz_file, cleanup=True)
+    
+    RealTimeLogger.get().info("Index {} retrieved successfully".format(
+        index_key))
+        
+    # Indexes made by newer runs come with the sizes of their graphs, which
+    # we use to size the alignment jobs.
+    graph_features = {}
+    features_key = features_key_for(index_key)
+    if out_store.exists(features_key):
+        features_file = "{}/features.json".format(
+            job.fileStore.getLocalTempDir())
+        out_store.read_input_file(features_key, features_file)
+        with open(features_file) as features_stream:
+            graph_features = json.load(features_stream)
+            
+    RealTimeLogger.get().info("Queueing alignment of {} samples to "
+        "{} {}".format(len(samples_to_run), graph_name, region))
+        
+    job.addFollowOnJobFn(run_samples, options, bin_dir_id, 
+        graph_name, region, index_dir_id, samples_to_run,
+        graph_features=graph_features, cores=1, memory="4G", disk="4G")
+    
+def features_key_for(index_key):
+    """
+    Return the output store key where the graph features for the index at the
+    given key are kept.
+    
+    >>> features_key_for("indexes/sha256/0123abcd.tar.gz")
+    'indexes/sha256/0123abcd.features.json'
+    
+    """
+    
+    return re.sub("\.tar\.gz$", ".features.json", index_key)
+    
+def graph_fetch_pipeline(options, url, bin_prefix, work_dir):
+    """
+    Work out how to get the graph at the given URL, which may be a file: URL or
+    an http(s) URL to a .vg file or to a GA4GH server.
+    
+    Doesn't run anything itself. Returns a list of download commands for
+    run_pipeline to run first (which may be empty), a list of commands for
+    run_pipeline that write the graph in vg format, and what the first of
+    those should read from (or None). If there are download commands, they
+    write to that file.
+    
+    Graphs on servers are downloaded to a JSON file in work_dir first, unless
+    options.stream_downloads is set, in which case sg2vg's output goes
+    straight into the conversion.
+    
+    >>> options = argparse.Namespace(server_version="v0.6.g",
+    ...     stream_downloads=True)
+    >>> graph_fetch_pipeline(options, "http://example.com/brca1/cactus/", "",
+    ...     "/tmp")
+    ([], [['sg2vg', 'http://example.com/brca1/cactus/v0.6.g', '-u'],
+    ['vg', 'view', '-Jv', '-']], None)
+    >>> graph_fetch_pipeline(options, "file:///data/cactus-brca1.vg", "",
+    ...     "/tmp")
+    ([], [], '/data/cactus-brca1.vg')
+    >>> options.stream_downloads = False
+    >>> graph_fetch_pipeline(options, "http://example.com/brca1/cactus/", "",
+    ...     "/tmp")
+    ([['sg2vg', 'http://example.com/brca1/cactus/v0.6.g', '-u']],
+    [['vg', 'view', '-Jv', '-']], '/tmp/graph.json')
+    
+    The downloads fail, instead of making bad graphs, if there's nothing there:
+    
+    >>> with LocalHTTPServer({"/cactus-brca1.vg": "GRAPH"}) as server:
+    ...     for path in ["/cactus-brca1.vg", "/cactus-brca2.vg"]:
+    ...         _, commands, _ = graph_fetch_pipeline(options,
+    ...             server.url(path), "", "/tmp")
+    ...         try:
+    ...             _ = run_pipeline(commands, stdout=open(os.devnull, "w"),
+    ...                 stderr=open(os.devnull, "w"))
+    ...             print "got", path
+    ...         except RuntimeError:
+    ...             print "failed", path
+    got /cactus-brca1.vg
+    failed /cactus-brca2.vg
+    
+    """
+    
+    url_parts = urlparse.urlparse(url, "file")
+    
+    if url_parts.scheme == "file":
+        # Read the vg graph from a local file
+        return [], [], url_parts.path
+    
+    if url.endswith(".vg"):
+        # Assume it's a vg file, and make sure HTTP errors are errors.
+        return [], [["curl", "--silent", "--show-error", "--fail",
+            "--location", url]], None
+    
+    # Otherwise, assume it's on a server. Make the real URL with the version
+    versioned_url = url + options.server_version
+    download_command = ["{}sg2vg".format(bin_prefix), versioned_url, "-u"]
+    convert_command = ["{}vg".format(bin_prefix), "view", "-Jv", "-"]
+    
+    if options.stream_downloads:
+        # Convert as it comes in
+        return [], [download_command, convert_command], None
+        
+    # The caller needs to download to this JSON file, and then run the rest of
+    # the pipeline on it.
+    graph_json = "{}/graph.json".format(work_dir)
+    
+    return [download_command], [convert_command], graph_json
+    
+def make_resource_estimator(options):
+    """
+    Make a ResourceEstimator for the big jobs, fitted to the reports from
+    earlier runs in the options.
+    
+    """
+    
+    estimator = ResourceEstimator(DEFAULT_RESOURCES,
+        margin=options.resource_margin, fixed=options.fixed_resources)
+        
+    for report in options.resource_report:
+        estimator.load_report(report)
+    estimator.fit()
+    
+    for job_name, (feature_names, coefficients) in \
+        estimator.models.iteritems():
+        
+        RealTimeLogger.get().info("Memory model for {}: {} KB".format(job_name,
+            " + ".join(["{:.3g}".format(coefficients[0])] + ["{:.3g} * {}".format(
+            coefficient, name) for name, coefficient in zip(feature_names,
+            coefficients[1:])])))
+            
+    return estimator
+    
+def measure_graph(options, graph_filename, bin_prefix):
+    """
+    Return a dict of the features of the given graph file that are used to
+    size jobs that work on it.
+    
+    """
+    
+    size = graph_size(graph_filename, vg="{}vg".format(bin_prefix),
+        native=(options.gam_reader == "native"))
+        
+    return {
+        "graph_nodes": size.nodes,
+        "graph_edges": size.edges,
+        "graph_sequence_length": size.sequence_length,
+        "graph_bytes": os.path.getsize(graph_filename)
+    }
+    
+def record_features(features):
+    """
+    Report the given dict of input features for the current job, so later runs
+    can model its resource usage.
+    
+    """
+    
+    for name, value in features.iteritems():
+        RealTimeMetrics.count("feature_{}".format(name), value)
+        
+def scale_resources(options, job_name):
+    """
+    Return True if we should use our rules of thumb to scale the cores and disk
+    requested for jobs of the given name to their inputs. We only do that if we
+    have measured the jobs before, or have been told to.
+    
+    """
+    
+    return (options.scale_resources or
+        job_name in options.resource_estimator.models)
+    
+def index_resources(options, graph_features):
+    """
+    Return the resources to request for indexing a graph with the given
+    features.
+    
+    """
+    
+    if not scale_resources(options, "index_region_and_run_samples"):
+        return options.resource_estimator.estimate(
+            "index_region_and_run_samples", **graph_features)
+    
+    return options.resource_estimator.estimate("index_region_and_run_samples",
+        cores=math.ceil(graph_features["graph_sequence_length"] /
+        float(INDEX_BASES_PER_CORE)),
+        disk=graph_features["graph_bytes"] * INDEX_DISK_FACTOR,
+        **graph_features)
+        
+def alignment_resources(options, job_name, graph_features, fastq_bytes):
+    """
+    Return the resources to request for a job of the given name that aligns a
+    FASTQ of the given size to a graph with the given features (which may be
+    empty if we don't know them).
+    
+    """
+    
+    features = dict(graph_features)
+    if fastq_bytes is not None:
+        features["fastq_bytes"] = fastq_bytes
+        
+    if not scale_resources(options, job_name):
+        return options.resource_estimator.estimate(job_name, **features)
+    
+    disk = None
+    if fastq_bytes is not None and "graph_bytes" in graph_features:
+        # We need room for the reads, the GAM, and the index
+        disk = (fastq_bytes * 3 +
+            graph_features["graph_bytes"] * INDEX_DISK_FACTOR)
+    
+    return options.resource_estimator.estimate(job_name,
+        cores=(None if fastq_bytes is None else
+        math.ceil(fastq_bytes / float(ALIGNMENT_BYTES_PER_CORE))),
+        disk=disk, **features)
+    
+def vg_map_command(options, bin_prefix, graph_file, fastq_file, cores):
+    """
+    Return the vg map command to align the given interleaved paired FASTQ
+    against the given indexed graph, using the vg binary with the given prefix
+    and the given number of threads. It writes the GAM to standard output.
+    
+    """
+    
+    # Plan out what to run
+    vg_parts = ["{}vg".format(bin_prefix), "map", "-f", fastq_file,
+        "-i", "-M2", "-W", "1000", "-u", "0", "-U", "-t", str(cores),
+        graph_file]
+        
+    if options.index_mode == "rocksdb":
+        vg_parts += ["-d", graph_file + ".index", "-n3", "-k",
+            str(options.kmer_size)]
+    elif options.index_mode == "gcsa-kmer":
+        # Use the new default context size in this case
+        vg_parts += ["-x", graph_file + ".xg", "-g", graph_file + ".gcsa",
+            "-n5", "-k", str(options.kmer_size)]
+    elif options.index_mode == "gcsa-mem":
+        # Don't pass the kmer size, so MEM matching is used
+        vg_parts += ["-x", graph_file + ".xg", "-g", graph_file + ".gcsa",
+            "-n5"]
+    else:
+        raise RuntimeError("invalid indexing mode: " + options.index_mode)
+        
+    return vg_parts
+    
+def align_fastq(options, bin_prefix, graph_file, fastq_file, output_file,
+    cores, description):
+    """
+    Align the given interleaved paired FASTQ against the given indexed graph
+    with vg map, using the vg binary with the given prefix and the given number
+    of threads, and save the GAM to the given output file. The description says
+    what is being aligned, for logging.
+    
+    Returns the time taken by the alignment, in seconds.
+    
+    """
+    
+    vg_parts = vg_map_command(options, bin_prefix, graph_file, fastq_file,
+        cores)
+    
+    RealTimeLogger.get().info(
+        "Running VG for {}: {}".format(description, " ".join(vg_parts)))
+    
+    # Run the aligner and have it write to the file
+    stages = run_pipeline([vg_parts], stdout=output_file)
+        
+    return stages[0].wall_time
+    
+def align_fastq_with_stats(options, bin_prefix, graph_file, fastq_file,
+    output_file, cores, description, engine):
+    """
+    Align like align_fastq, but also run the given StatsEngine over the
+    alignments as vg map produces them, so the GAM doesn't need to be read
+    again.
+    
+    Returns the time taken by the alignment, in seconds, and the engine's shard
+    result for all the alignments.
+    
+    """
+    
+    vg = "{}vg".format(bin_prefix)
+    
+    # vg map writes to both the GAM file and a pipe to us
+    commands = [vg_map_command(options, bin_prefix, graph_file, fastq_file,
+        cores), ["tee", output_file]]
+    if options.gam_reader != "native":
+        # We want to read JSON
+        commands.append([vg, "view", "-aj", "-"])
+    
+    RealTimeLogger.get().info("Running VG with stats for {}: {}".format(
+        description, " | ".join(" ".join(command) for command in commands)))
+        
+    read_fd, write_fd = os.pipe()
+    
+    def run_aligner():
+        """
+        Run the aligner pipeline into the pipe, and return its stages.
+        """
+        
+        with os.fdopen(write_fd, "w") as alignment_stream:
+            return run_pipeline(commands, stdout=alignment_stream,
+                outputs=[output_file])
+    
+    aligner_pool = multiprocessing.pool.ThreadPool(1)
+    aligner_result = aligner_pool.apply_async(run_aligner)
+    
+    try:
+        with os.fdopen(read_fd) as alignment_stream:
+            if options.gam_reader == "native":
+                alignments = read_alignments_stream(alignment_stream,
+                    fields=engine.fields)
+            else:
+                alignments = read_alignments_json(alignment_stream)
+            shard_result = engine.compute_shard(alignments)
+    except:
+        # Either the aligner died and left us a truncated stream, or reading
+        # failed and the aligner will die on a broken pipe now. If the aligner
+        # failed, its error (with its exit status and standard error) is the
+        # one to report.
+        error = sys.exc_info()
+        RealTimeLogger.get().warning("Reading alignments for {} failed: "
+            "{}".format(description, error[1]))
+        try:
+            aligner_result.get()
+        finally:
+            aligner_pool.close()
+            aligner_pool.join()
+        # The aligner was fine, so the problem was on our end.
+        raise error[0], error[1], error[2]
+    
+    # Make sure the aligner actually worked
+    try:
+        stages = aligner_result.get()
+    finally:
+        aligner_pool.close()
+        aligner_pool.join()
+    
+    return stages[0].wall_time, shard_result
+    
+def load_node_sequences(options, graph_dir, bin_prefix):
+    """
+    Get a NodeSequenceStore for the graph.vg in the given extracted index
+    directory, using the packed sequences saved with the index if there are
+    any, and the vg binary with the given prefix otherwise.
+    
+    """
+    
+    if NodeSequenceStore.exists(graph_dir):
+        # The index came with packed node sequences, so just map them in.
+        RealTimeLogger.get().info("Mapping packed node sequences")
+        return NodeSequenceStore.load(graph_dir)
+    else:
+        # Pack the node sequences from the graph. This holds node sequence
+        # string by ID.
+        RealTimeLogger.get().info("Packing node sequences")
+        return NodeSequenceStore.from_graph("{}/graph.vg".format(graph_dir),
+            vg="{}vg".format(bin_prefix),
+            native=(options.gam_reader == "native"))
+            
+def save_stats(job, out_store, stats, stats_file_key):
+    """
+    Save the given stats dict to the given key in the given output store as
+    JSON, with the histograms in columnar .npz form next to it, for
+    collateStatistics.
+    
+    """
+    
+    # Save the histograms as columns, for fast collation. This has to go
+    # up before the JSON, since the JSON is what says the stats are done.
+    histogram_file = "{}/stats.npz".format(job.fileStore.getLocalTempDir())
+    save_stats_npz(stats, histogram_file)
+    out_store.write_output_file(histogram_file,
+        re.sub("\.json$", ".npz", stats_file_key))
+        
+    stats_file = "{}/stats.json".format(job.fileStore.getLocalTempDir())
+    with open(stats_file, "w") as stats_handle:
+        # Save the stats as JSON. Sort the keys so the file comes out the same
+        # no matter how the stats were computed.
+        json.dump(stats, stats_handle, sort_keys=True)
+        
+    # Now send the stats to the output store where they belong.
+    out_store.write_output_file(stats_file, stats_file_key)
+    
+def split_fastq_pairs(fastq_file, chunk_count, chunk_prefix):
+    """
+    Split the given interleaved paired FASTQ file into up to the given number
+    of chunks of about equal size, never separating the two ends of a pair.
+    Chunk files are named with the given prefix. Returns the list of chunk
+    filenames, in order; there may be fewer than requested if there are few
+    pairs.
+    
+    >>> import tempfile
+    >>> work_dir = tempfile.mkdtemp()
+    >>> fastq_file = os.path.join(work_dir, "input.fq")
+    >>> with open(fastq_file, "w") as fastq:
+    ...     for i in xrange(10):
+    ...         for end in [1, 2]:
+    ...             fastq.write("@r{}/{}\\nACGT\\n+\\nIIII\\n".format(i, end))
+    >>> chunks = split_fastq_pairs(fastq_file, 3, os.path.join(work_dir, "c"))
+    >>> [len(open(chunk).readlines()) / 8 for chunk in chunks]
+    [4, 4, 2]
+    >>> ("".join(open(chunk).read() for chunk in chunks) ==
+    ...     open(fastq_file).read())
+    True
+    >>> len(split_fastq_pairs(fastq_file, 100, os.path.join(work_dir, "d")))
+    10
+    >>> shutil.rmtree(work_dir)
+    
+    """
+    
+    # How many bytes should be in each chunk?
+    chunk_bytes = (os.path.getsize(fastq_file) + chunk_count - 1) / chunk_count
+    
+    chunk_files = []
+    # This holds the open file for the current chunk
+    chunk = None
+    # And how many bytes it has
+    written = 0
+    
+    with open(fastq_file) as fastq:
+        while True:
+            # Each pair is 2 reads of 4 lines each
+            pair = [fastq.readline() for _ in xrange(8)]
+            
+            if pair[0] == "":
+                # We hit the end of the file cleanly
+                break
+            if pair[-1] == "":
+                raise RuntimeError("FASTQ {} ends in the middle of a "
+                    "pair".format(fastq_file))
+                    
+            if chunk is None or written >= chunk_bytes:
+                # Start a new chunk
+                if chunk is not None:
+                    chunk.close()
+                chunk_files.append("{}{}.fq".format(chunk_prefix,
+                    len(chunk_files)))
+                chunk = open(chunk_files[-1], "w")
+                written = 0
+                
+            record = "".join(pair)
+            chunk.write(record)
+            written += len(record)
+            
+    if chunk is not None:
+        chunk.close()
+            
+    return chunk_files
+    
+@metered_job
 def run_alignment(job, options, bin_dir_id, sample, graph_name, region,
-    index_dir_id, sample_fastq_key, alignment_file_key, stats_file_key):
+    index_dir_id, sample_fastq_key, alignment_file_key, stats_file_key,
+    graph_features, fastq_size):
     """
     Align the the given fastq from the input store against the given indexed
     graph (in the file store as a directory) and put the GAM and statistics in
     the given output keys in the output store.
     
+    graph_features and fastq_size are the graph and input sizes the job was
+    sized from, which are reported so later runs can size it better.
+    
     Assumes that the alignment actually needs to be redone.
     
     """
     
+    RealTimeMetrics.add_tags(sample=sample, graph=graph_name, region=region)
+    record_features(dict(graph_features, fastq_bytes=fastq_size)
+        if fastq_size is not None else graph_features)
+    
     # Set up the IO stores each time, since we can't unpickle them on Azure for
     # some reason.
     sample_store = IOStore.get(options.sample_store)
@@ -952,9 +1661,12 @@ def run_alignment(job, options, bin_dir_id, sample, graph_name, region,
     else:
         bin_prefix = ""
     
-    # Download the indexed graph to a directory we can use
+    # Download the indexed graph to a directory we can use. RocksDB wants to
+    # write lock and log files into its index even when reading, so that can't
+    # be shared through the read-only node-local cache.
     graph_dir = "{}/graph".format(job.fileStore.getLocalTempDir())
-    read_global_directory(job.fileStore, index_dir_id, graph_dir)
+    read_global_directory(job.fileStore, index_dir_id, graph_dir,
+        cache=(options.index_mode != "rocksdb"))
     
     # We know what the vg file in there will be named
     graph_file = "{}/graph.vg".format(graph_dir)
@@ -971,46 +1683,28 @@ def run_alignment(job, options, bin_dir_id, sample, graph_name, region,
     # And a temp file for our aligner output
     output_file = "{}/output.gam".format(job.fileStore.getLocalTempDir())
     
-    # Open the file stream for writing
-    with open(output_file, "w") as alignment_file:
+    description = "{} against {} {}".format(sample, graph_name, region)
     
-        # Start the aligner and have it write to the file
-        
-        # Plan out what to run
-        vg_parts = ["{}vg".format(bin_prefix), "map", "-f", fastq_file,
-            "-i", "-M2", "-W", "1000", "-u", "0", "-U", "-t", str(job.cores), graph_file]
+    if options.stream_stats:
+        # Compute the stats as the alignments come out
+        engine = StatsEngine(MAPPING_COLLECTORS,
+            load_node_sequences(options, graph_dir, bin_prefix),
+            skip_duplicate_secondaries=True)
+        run_time, shard_result = align_fastq_with_stats(options, bin_prefix,
+            graph_file, fastq_file, output_file, job.cores, description,
+            engine)
             
-        if options.index_mode == "rocksdb":
-            vg_parts += ["-d", graph_file + ".index", "-n3", "-k",
-                str(options.kmer_size)]
-        elif options.index_mode == "gcsa-kmer":
-            # Use the new default context size in this case
-            vg_parts += ["-x", graph_file + ".xg", "-g", graph_file + ".gcsa",
-                "-n5", "-k", str(options.kmer_size)]
-        elif options.index_mode == "gcsa-mem":
-            # Don't pass the kmer size, so MEM matching is used
-            vg_parts += ["-x", graph_file + ".xg", "-g", graph_file + ".gcsa",
-                "-n5"]
-        else:
-            raise RuntimeError("invalid indexing mode: " + options.index_mode)
-        
-        RealTimeLogger.get().info(
-            "Running VG for {} against {} {}: {}".format(sample, graph_name,
-            region, " ".join(vg_parts)))
-        
-        # Mark when we start the alignment
-        start_time = timeit.default_timer()
-        process = subprocess.Popen(vg_parts, stdout=alignment_file)
-            
-        if process.wait() != 0:
-            # Complain if vg dies
-            raise RuntimeError("vg died with error {}".format(
-                process.returncode))
-                
-        # Mark when it's done
-        end_time = timeit.default_timer()
-        run_time = end_time - start_time
+        RealTimeLogger.get().info("Aligned {} with stats".format(output_file))
         
+        # Upload the alignment, and then the stats that say it's done
+        out_store.write_output_file(output_file, alignment_file_key)
+        save_stats(job, out_store, engine.merge([shard_result], run_time),
+            stats_file_key)
+        return
+    
+    # Run the alignment, and see how long it took
+    run_time = align_fastq(options, bin_prefix, graph_file, fastq_file,
+        output_file, job.cores, description)
                 
     RealTimeLogger.get().info("Aligned {}".format(output_file))
     
@@ -1020,19 +1714,186 @@ def run_alignment(job, options, bin_dir_id, sample, graph_name, region,
     RealTimeLogger.get().info("Need to recompute stats for new "
         "alignment: {}".format(stats_file_key))
 
-    # Add a follow-on to calculate stats. It only needs 2 cores since it's
-    # not really prarllel.
+    # Add a follow-on to calculate stats. It only needs 2 cores unless we're
+    # sharding the stats over multiple processes.
     job.addFollowOnJobFn(run_stats, options, bin_dir_id, index_dir_id,
         alignment_file_key, stats_file_key, run_time=run_time,
-        cores=2, memory="4G", disk="10G")
+        cores=max(2, options.stats_processes), memory="4G", disk="10G")
             
       
+@metered_job
+def scatter_alignment(job, options, bin_dir_id, sample, graph_name, region,
+    index_dir_id, sample_fastq_key, alignment_file_key, stats_file_key,
+    graph_features, fastq_size):
+    """
+    Align the given fastq from the input store against the given indexed graph
+    like run_alignment, but split it into options.scatter_chunks chunks of read
+    pairs that are aligned and have their stats computed as separate child
+    jobs, and then put back together by gather_alignment.
+    
+    graph_features and fastq_size are used to size the chunk jobs.
+    
+    """
+    
+    RealTimeMetrics.add_tags(sample=sample, graph=graph_name, region=region)
+    
+    sample_store = IOStore.get(options.sample_store)
+    
+    # Get the sample fastq
+    fastq_file = "{}/input.fq".format(job.fileStore.getLocalTempDir())
+    RealTimeLogger.get().info("Downloading FASTQ {} to {}".format(
+        sample_fastq_key, fastq_file))
+    sample_store.read_input_file(sample_fastq_key, fastq_file)
+    
+    # The FASTQ really should not be empty
+    assert(os.stat(fastq_file).st_size > 0)
+    
+    # Cut it up
+    chunk_files = split_fastq_pairs(fastq_file, options.scatter_chunks,
+        "{}/chunk".format(job.fileStore.getLocalTempDir()))
+        
+    RealTimeLogger.get().info("Scattering {} against {} {} as {} "
+        "chunks".format(sample, graph_name, region, len(chunk_files)))
+        
+    # This holds promises for what each chunk job returns, in order.
+    chunk_results = []
+        
+    for chunk_number, chunk_file in enumerate(chunk_files):
+        # Send each chunk to the file store, and make a job to align it. They
+        # only need the chunk until the gather is done.
+        chunk_size = os.path.getsize(chunk_file)
+        chunk_id = job.fileStore.writeGlobalFile(chunk_file, cleanup=True)
+        os.unlink(chunk_file)
+        
+        chunk_job = job.addChildJobFn(run_alignment_chunk, options,
+            bin_dir_id, "{} chunk {}".format(sample, chunk_number), graph_name,
+            region, index_dir_id, chunk_id, graph_features, chunk_size,
+            **alignment_resources(options, "run_alignment_chunk",
+            graph_features, chunk_size))
+        chunk_results.append(chunk_job.rv())
+        
+    # When they're all done, put the results back together.
+    job.addFollowOnJobFn(gather_alignment, options, sample, chunk_results,
+        alignment_file_key, stats_file_key, cores=1, memory="4G", disk="50G")
+        
+@metered_job
+def run_alignment_chunk(job, options, bin_dir_id, description, graph_name,
+    region, index_dir_id, chunk_id, graph_features, chunk_size):
+    """
+    Align the FASTQ chunk with the given file store ID against the given indexed
+    graph, and compute stats for it. graph_features and chunk_size are reported
+    like in run_alignment.
+    
+    Returns the file store ID of the chunk's GAM, the chunk's StatsEngine shard
+    result, and the time taken to align the chunk in seconds.
+    
+    """
+    
+    RealTimeMetrics.add_tags(graph=graph_name, region=region)
+    record_features(dict(graph_features, fastq_bytes=chunk_size))
+    
+    if bin_dir_id is not None:
+        # Download the binaries
+        bin_dir = "{}/bin".format(job.fileStore.getLocalTempDir())
+        read_global_directory(job.fileStore, bin_dir_id, bin_dir)
+        # We define a string we can just tack onto the binary name and get
+        # either the system or the downloaded version.
+        bin_prefix = bin_dir + "/"
+    else:
+        bin_prefix = ""
+        
+    # Download the indexed graph to a directory we can use
+    graph_dir = "{}/graph".format(job.fileStore.getLocalTempDir())
+    read_global_directory(job.fileStore, index_dir_id, graph_dir,
+        cache=(options.index_mode != "rocksdb"))
+    
+    # Get the reads
+    fastq_file = job.fileStore.readGlobalFile(chunk_id)
+    
+    # We compute stats for the chunk. Since chunks start at read boundaries,
+    # the gather can merge them just like shards of one GAM.
+    engine = StatsEngine(MAPPING_COLLECTORS,
+        load_node_sequences(options, graph_dir, bin_prefix),
+        skip_duplicate_secondaries=True)
+    
+    # Align them
+    output_file = "{}/output.gam".format(job.fileStore.getLocalTempDir())
+    graph_file = "{}/graph.vg".format(graph_dir)
+    chunk_description = "{} against {} {}".format(description, graph_name,
+        region)
+    
+    if options.stream_stats:
+        # Do the stats on the way through
+        run_time, shard_result = align_fastq_with_stats(options, bin_prefix,
+            graph_file, fastq_file, output_file, job.cores, chunk_description,
+            engine)
+    else:
+        run_time = align_fastq(options, bin_prefix, graph_file, fastq_file,
+            output_file, job.cores, chunk_description)
+        shard_result = engine.compute_shard(read_alignments(output_file,
+            fields=engine.fields, vg="{}vg".format(bin_prefix),
+            native=(options.gam_reader == "native")))
+        
+    RealTimeLogger.get().info("Aligned {} in {:.0f} seconds".format(
+        description, run_time))
+        
+    # Keep the GAM for the gather
+    gam_id = job.fileStore.writeGlobalFile(output_file, cleanup=True)
+    
+    return gam_id, shard_result, run_time
+    
+@metered_job
+def gather_alignment(job, options, sample, chunk_results, alignment_file_key,
+    stats_file_key):
+    """
+    Given the list of results from run_alignment_chunk for each chunk of a
+    sample, in order, concatenate the chunk GAMs into the given output key and
+    save the merged stats under the given stats key.
+    
+    The stats "run_time" is the total alignment time over all the chunks, and
+    the individual chunk times go in "chunk_run_times".
+    
+    """
+    
+    RealTimeMetrics.add_tags(sample=sample)
+    
+    out_store = IOStore.get(options.out_store)
+    
+    # Concatenate the GAMs. They are gzipped streams, and concatenated gzip
+    # members are still a valid gzipped stream.
+    output_file = "{}/output.gam".format(job.fileStore.getLocalTempDir())
+    with open(output_file, "w") as output:
+        for gam_id, _, _ in chunk_results:
+            with job.fileStore.readGlobalFileStream(gam_id) as chunk_gam:
+                shutil.copyfileobj(chunk_gam, output)
+                
+    # Upload the alignment
+    out_store.write_output_file(output_file, alignment_file_key)
+    
+    RealTimeLogger.get().info("Gathered {} chunks of {} into {}".format(
+        len(chunk_results), sample, alignment_file_key))
+    
+    # Merge the stats. Merging doesn't need the graph.
+    engine = StatsEngine(MAPPING_COLLECTORS, skip_duplicate_secondaries=True)
+    chunk_run_times = [run_time for _, _, run_time in chunk_results]
+    stats = engine.merge([shard_result for _, shard_result, _ in
+        chunk_results], run_time=sum(chunk_run_times))
+    stats["chunk_run_times"] = chunk_run_times
+    
+    for chunk_number, run_time in enumerate(chunk_run_times):
+        RealTimeLogger.get().info("{} chunk {} aligned in {:.0f} "
+            "seconds".format(sample, chunk_number, run_time))
+    
+    save_stats(job, out_store, stats, stats_file_key)
+    
+@metered_job
 def run_stats(job, options, bin_dir_id, index_dir_id, alignment_file_key,
     stats_file_key, run_time=None):
     """
     If the stats aren't done, or if they need to be re-done, retrieve the
     alignment file from the output store under alignment_file_key and compute the
-    stats file, saving it under stats_file_key.
+    stats file, saving it under stats_file_key. Also saves the histograms in
+    columnar .npz form next to it, for collateStatistics.
     
     Uses index_dir_id to get the graph, and thus the reference sequence that
     each read is aligned against, for the purpose of discounting Ns.
@@ -1046,6 +1907,8 @@ def run_stats(job, options, bin_dir_id, index_dir_id, alignment_file_key,
     data.
     
     """
+    
+    RealTimeMetrics.add_tags(alignment=alignment_file_key)
           
     # Set up the IO stores each time, since we can't unpickle them on Azure for
     # some reason.
@@ -1068,389 +1931,31 @@ def run_stats(job, options, bin_dir_id, index_dir_id, alignment_file_key,
     graph_dir = "{}/graph".format(job.fileStore.getLocalTempDir())
     read_global_directory(job.fileStore, index_dir_id, graph_dir)
     
-    # We know what the vg file in there will be named
-    graph_file = "{}/graph.vg".format(graph_dir)
-    
-    # Load the node sequences into memory. This holds node sequence string by
-    # ID.
-    node_sequences = {}
-    
-    # Read the alignments in in JSON-line format
-    read_graph = subprocess.Popen(["{}vg".format(bin_prefix), "view", "-j",
-        graph_file], stdout=subprocess.PIPE)
-        
-    for line in read_graph.stdout:
-        # Parse the graph chunk JSON
-        graph_chunk = json.loads(line)
-        
-        for node_dict in graph_chunk.get("node", []):
-            # For each node, store its sequence under its id. We want to crash
-            # if a node exists for which one or the other isn't defined.
-            node_sequences[node_dict["id"]] = node_dict["sequence"]
-        
-    if read_graph.wait() != 0:
-        # Complain if vg dies
-        raise RuntimeError("vg died with error {}".format(
-            read_graph.returncode))
+    node_sequences = load_node_sequences(options, graph_dir, bin_prefix)
  
-    # Declare local files for everything
-    stats_file = "{}/stats.json".format(job.fileStore.getLocalTempDir())
+    # Declare a local file for the alignment
     alignment_file = "{}/output.gam".format(job.fileStore.getLocalTempDir())
     
     # Download the alignment
     out_store.read_input_file(alignment_file_key, alignment_file)
            
-    # Read the alignments in in JSON-line format
-    read_alignment = subprocess.Popen(["{}vg".format(bin_prefix), "view", "-aj",
-        alignment_file], stdout=subprocess.PIPE)
-       
-    # Count up the stats
-    stats = {
-        "total_reads": 0,
-        "total_mapped": 0,
-        "total_multimapped": 0,
-        "total_secondary_visible": 0,
-        "total_sufficiently_unique": 0,
-        "mapped_lengths": collections.Counter(),
-        "unmapped_lengths": collections.Counter(),
-        "aligned_lengths": collections.Counter(),
-        "primary_scores": collections.Counter(),
-        "primary_mapqs": collections.Counter(),
-        "primary_identities": collections.Counter(), # Deprecated; doesn't count deletions in this vg
-        "primary_mismatches": collections.Counter(), # Deprecated; doesn't count deletions
-        "primary_matches_per_column": collections.Counter(),
-        "primary_indels": collections.Counter(),
-        "primary_substitutions": collections.Counter(),
-        "secondary_scores": collections.Counter(),
-        "secondary_mapqs": collections.Counter(),
-        "secondary_identities": collections.Counter(), # Deprecated; doesn't count deletions in this vg
-        "secondary_mismatches": collections.Counter(), # Deprecated; doesn't count deletions
-        "secondary_matches_per_column": collections.Counter(),
-        "secondary_indels": collections.Counter(),
-        "secondary_substitutions": collections.Counter(),
-        "primary_advantage": collections.Counter(),
-        "run_time": run_time
-    }
-        
-    # We need to track the last alignment
-    last_alignment = None
-    # And its matches per column, if it's a primary
-    last_matches_per_column = None
-        
-    for line in read_alignment.stdout:
-        # Parse the alignment JSON
-        alignment = json.loads(line)
-        
-        if alignment.get("is_secondary", False):
-            # It's a multimapping.
-            
-            if (last_alignment is None or 
-                last_alignment.get("name") != alignment.get("name") or 
-                last_alignment.get("is_secondary", False)):
+    # Make a stats engine to collect all the mapping stats. Duplicate
+    # secondaries are just there to even things up for the other end of the
+    # read, so skip them.
+    engine = StatsEngine(MAPPING_COLLECTORS, node_sequences,
+        skip_duplicate_secondaries=True)
+    
+    if options.stats_processes > 1:
+        RealTimeLogger.get().info("Computing stats in {} processes".format(
+            options.stats_processes))
+    
+    # Read the alignments, either directly or through vg view, and compute the
+    # stats, in parallel if we can.
+    stats = engine.run(alignment_file, vg="{}vg".format(bin_prefix),
+        native=(options.gam_reader == "native"),
+        processes=options.stats_processes, run_time=run_time)
             
-                # This is a secondary alignment without a corresponding primary
-                # alignment (which would have to be right before it in GAM
-                # format with up to 2 mappings per read)
-                raise RuntimeError("{} secondary alignment comes after "
-                    "alignment of {} instead of corresponding primary "
-                    "alignment\n".format(alignment.get("name"), 
-                    last_alignment.get("name") if last_alignment is not None 
-                    else "nothing"))
-                    
-            if alignment.get("path", {}) == last_alignment.get("path", {}):
-                # This secondary takes the same path as the primary, so we don't
-                # want to consider it as a separate alignment. It's just there
-                # to even things up for the secondary alignment of the other end
-                # of the read.
-                
-                # Save the alignment for checking for wayward secondaries
-                last_alignment = alignment
-                
-                # This was a secondary, so this field is not important
-                last_matches_per_column = None
-                
-                # Don't process it any more, and don't record any score
-                # advantage at all for its primary alignment.
-                continue
-            
-        
-        # How long is this read?
-        length = len(alignment["sequence"])
-        
-        if alignment.has_key("score"):
-            # This alignment is aligned.
-            # Grab its score
-            score = alignment["score"]
-        
-            # Get the mappings
-            mappings = alignment.get("path", {}).get("mapping", [])
-        
-            # Calculate the exact match bases
-            matches = 0
-            
-            # And total up the instances of indels (only counting those where
-            # the reference has no Ns, and which aren't leading or trailing soft
-            # clips)
-            indels = 0
-            
-            # And total up the number of substitutions (mismatching/alternative
-            # bases in edits with equal lengths where the reference has no Ns).
-            substitutions = 0
-            
-            # What should the denominator for substitution rate be for this
-            # read? How many bases are in the read and aligned?
-            aligned_length = 0
-            
-            # How many total columns are there in the alignment?
-            alignment_columns = 0
-            
-            # What's the mapping quality? May not be defined on some reads.
-            mapq = alignment.get("mapping_quality", 0.0)
-            
-            # And the identity?
-            identity = alignment["identity"]
-            
-            for mapping_number, mapping in enumerate(mappings):
-                # Figure out what the reference sequence for this mapping should
-                # be
-                
-                position = mapping.get("position", {})
-                if position.has_key("node_id"):
-                    # We actually are mapped to a reference node
-                    ref_sequence = node_sequences[position["node_id"]]
-                    
-                    # Grab the offset
-                    offset = position.get("offset", 0)
-                    
-                    if mapping.get("is_reverse", False):
-                        # We start at the offset base on the reverse strand.
-                        # This means we count from the end.
-                        # But if offset is 0 we take the whole thing.
-                        ref_sequence = reverse_complement(
-                            ref_sequence[0:-offset] if offset != 0
-                            else ref_sequence)
-                    else:
-                        # Just clip so we start at the specified offset
-                        ref_sequence = ref_sequence[offset:]
-                    
-                else:
-                    # We're aligned against no node, and thus an empty reference
-                    # sequence (and thus must be all insertions)
-                    ref_sequence = "" 
-                    
-                # Start at the beginning of the reference sequence for the
-                # mapping.
-                index_in_ref = 0
-                    
-                # Pull out the edits
-                edits = mapping.get("edit", [])
-                    
-                for edit_number, edit in enumerate(edits):
-                    # An edit may be a soft clip if it's either the first edit
-                    # in the first mapping, or the last edit in the last
-                    # mapping. This flag stores whether that is the case
-                    # (although to actually be a soft clip it also has to be an
-                    # insertion, and not either a substitution or a perfect
-                    # match as spelled by the aligner).
-                    may_be_soft_clip = ((edit_number == 0 and 
-                        mapping_number == 0) or 
-                        (edit_number == len(edits) - 1 and 
-                        mapping_number == len(mappings) - 1))
-                        
-                    # Count up the Ns in the reference sequence for the edit. We
-                    # get the part of the reference string that should belong to
-                    # this edit.
-                    reference_N_count = count_Ns(ref_sequence[
-                        index_in_ref:index_in_ref + edit.get("from_length", 0)])
-                        
-                    # Count up the columns, which is the max of the from and to
-                    # lengths, but discounting any columns where the reference
-                    # has an N.
-                    alignment_columns += max(edit.get("to_length", 0),
-                        edit.get("from_length", 0)) - reference_N_count
-                        
-                    if edit.get("to_length", 0) == edit.get("from_length", 0):
-                        # Add in the length of this edit if it's actually
-                        # aligned (not an indel or softclip).
-                        # Make sure not to count Ns in the reference.
-                        aligned_length += (edit.get("to_length", 0) -
-                            reference_N_count)
-                        
-                    if (not edit.has_key("sequence") and 
-                        edit.get("to_length", 0) == edit.get("from_length", 0)):
-                        # The edit has equal from and to lengths, but no
-                        # sequence provided.
-
-                        # We found a perfect match edit. Grab its length
-                        matches += edit["from_length"]
-
-                        # We don't care about Ns when evaluating perfect
-                        # matches. VG already split out any mismatches into non-
-                        # perfect matches, and we ignore the N-matched-to-N
-                        # case.
-
-                    if not may_be_soft_clip and (edit.get("to_length", 0) !=
-                        edit.get("from_length", 0)):
-                        # This edit is an indel and isn't on the very end of a
-                        # read.
-                        if reference_N_count == 0:
-                            # Only count the indel if it's not against an N in
-                            # the reference
-                            indels += 1
-
-                    if (edit.get("to_length", 0) == 
-                        edit.get("from_length", 0) and 
-                        edit.has_key("sequence")):
-                        # The edit has equal from and to lengths, and a provided
-                        # sequence. This edit is thus a SNP or MNP. It
-                        # represents substitutions.
-
-                        # We take as substituted all the bases except those
-                        # opposite reference Ns. Sequence Ns are ignored.
-                        substitutions += (edit.get("to_length", 0) -
-                            reference_N_count)
-                            
-                    # We still count query Ns as "aligned" when not in indels
-                        
-                    # Advance in the reference sequence
-                    index_in_ref += edit.get("from_length", 0)
-
-            # Calculate mismatches as what's not perfect matches
-            mismatches = length - matches
-            
-            # Calculate matches per alignment column, which is a way better
-            # measure of alignment identity than vg's "identity" which also
-            # ignores deletions.
-            matches_per_column = (float(matches) / alignment_columns
-                if alignment_columns > 0 else 0)
-                    
-            if alignment.get("is_secondary", False):
-                # It's a multimapping. We can have max 1 per read, so it's a
-                # multimapped read.
-                
-                # Log its stats as multimapped
-                stats["total_multimapped"] += 1
-                stats["secondary_scores"][score] += 1
-                stats["secondary_mismatches"][mismatches] += 1
-                stats["secondary_indels"][indels] += 1
-                stats["secondary_substitutions"][substitutions] += 1
-                stats["secondary_mapqs"][mapq] += 1
-                stats["secondary_identities"][identity] += 1
-                stats["secondary_matches_per_column"][matches_per_column] += 1
-                
-                # We know we have a primary in last_alignment, so we can
-                # calculate a score advantage for the primary.
-                score_advantage = (last_alignment.get("score", 0) -
-                    alignment.get("score", 0))
-                stats["primary_advantage"][score_advantage] += 1
-                
-                # We saw a secondary alignment
-                stats["total_secondary_visible"] += 1
-                
-                if (last_matches_per_column >= 0.95 and
-                    matches_per_column < 0.85):
-                    # If the last alignment was sufficiently good, and this
-                    # secondary is sufficiently bad, then the last alignment is
-                    # sufficiently unique.
-                    stats["total_sufficiently_unique"] += 1
-                
-            else:
-                # Log its stats as primary. We'll get exactly one of these per
-                # read with any mappings.
-                stats["total_mapped"] += 1
-                stats["primary_scores"][score] += 1
-                stats["primary_mismatches"][mismatches] += 1
-                stats["primary_indels"][indels] += 1
-                stats["primary_substitutions"][substitutions] += 1
-                stats["primary_mapqs"][mapq] += 1
-                stats["primary_identities"][identity] += 1
-                stats["primary_matches_per_column"][matches_per_column] += 1
-                
-                # Record that a read of this length was mapped
-                stats["mapped_lengths"][length] += 1
-                
-                # And that a read with this many aligned primary bases was found
-                stats["aligned_lengths"][aligned_length] += 1
-                
-                # We won't see an unaligned primary alignment for this read, so
-                # count the read
-                stats["total_reads"] += 1
-                
-                if (last_alignment is not None and
-                    not last_alignment.get("is_secondary", False) and
-                    last_alignment.has_key("score")):
-                    # This is a primary alignment, and it comes after another
-                    # primary alignment. That other primary alignment has no
-                    # secondary at all (not even a duplicate of itself), but it
-                    # was aligned (nonzero score), so we need to pretend it had
-                    # a secondary of score 0, and an advantage over that
-                    # secondary equal to its score.
-                    
-                    stats["primary_advantage"][
-                        last_alignment.get("score", 0)] += 1
-                    
-                    # We could have seen a secondary for that alignment, but we
-                    # didn't.
-                    stats["total_secondary_visible"] += 1
-                    
-                    if last_matches_per_column >= 0.95:
-                        # If the last alignment was sufficiently good, given
-                        # that it had no secondary at all, it is sufficiently
-                        # unique.
-                        stats["total_sufficiently_unique"] += 1
-        
-        elif not alignment.get("is_secondary", False):
-            # We have an unmapped primary "alignment"
-            
-            # Count the read by its primary alignment
-            stats["total_reads"] += 1
-            
-            # Record that an unmapped read has this length
-            stats["unmapped_lengths"][length] += 1
-            
-            matches_per_column = None
-            
-        else:
-            # It has no score and is secondary somehow?
-            matches_per_column = None
-            
-        # Save the alignment for checking for wayward secondaries
-        last_alignment = alignment
-        last_matches_per_column = matches_per_column
-    
-    # Now do the last alignment overall, if it was a primary.
-    if (last_alignment is not None and
-        not last_alignment.get("is_secondary", False) and
-        last_alignment.has_key("score")):
-        # The last alignment is primary. That primary alignment has no secondary
-        # at all (not even a duplicate of itself), but it was aligned (nonzero
-        # score), so we need to pretend it had a secondary of score 0, and an
-        # advantage over that secondary equal to its score.
-        
-        stats["primary_advantage"][
-            last_alignment.get("score", 0)] += 1
-        
-        # We could have seen a secondary for that alignment, but we
-        # didn't.
-        stats["total_secondary_visible"] += 1
-        
-        if last_matches_per_column >= 0.95:
-            # If the last alignment was sufficiently good, given
-            # that it had no secondary at all, it is sufficiently
-            # unique.
-            stats["total_sufficiently_unique"] += 1
-                
-    with open(stats_file, "w") as stats_handle:
-        # Save the stats as JSON
-        json.dump(stats, stats_handle)
-        
-    if read_alignment.wait() != 0:
-        # Complain if vg dies
-        raise RuntimeError("vg died with error {}".format(
-            read_alignment.returncode))
-        
-    # Now send the stats to the output store where they belong.
-    out_store.write_output_file(stats_file, stats_file_key)
+    save_stats(job, out_store, stats, stats_file_key)
     
         
 def main(args):
@@ -1479,6 +1984,10 @@ def main(args):
     
     RealTimeLogger.start_master()
     
+    # Work out what to ask for for the big jobs, from what earlier runs used.
+    # The jobs all get it with the options.
+    options.resource_estimator = make_resource_estimator(options)
+    
     # Pre-read the input file so we don't try to send file handles over the
     # network.
     options.server_list = list(options.server_list)
@@ -1487,16 +1996,21 @@ def main(args):
     root_job = Job.wrapJobFn(run_all_alignments, options,
         cores=1, memory="4G", disk="50G")
     
-    # Run it and see how many jobs fail
-    failed_jobs = Job.Runner.startToil(root_job,  options)
+    try:
+        # Run it and see how many jobs fail
+        failed_jobs = Job.Runner.startToil(root_job,  options)
+    finally:
+        RealTimeLogger.stop_master()
+        
+        if options.metrics_report is not None:
+            # Say how long everything took, even if it didn't all work.
+            RealTimeMetrics.report.write(options.metrics_report)
     
     if failed_jobs > 0:
         raise Exception("{} jobs failed!".format(failed_jobs))
         
     print("All jobs completed successfully")
     
-    RealTimeLogger.stop_master()
-    
 if __name__ == "__main__" :
     sys.exit(main(sys.argv))
         
@@ -0,0 +1,148 @@
+#!/usr/bin/env python2.7
+"""
+queryExperimentResults.py: look at the results database written by
+variantCallingExperiment.py, without running any Toil jobs.
+
+Queries:
+
+  best      rank the conditions by average max F score
+  scores    dump the max F score for every condition and sample
+  roc       dump the stored vcfeval ROC curve for one condition and sample
+  timings   show the average time each stage took
+
+Output is tab-separated, on standard output.
+
+Results from different scopes (runs against different inputs or caches) are
+never compared with each other: best and scores report each scope separately,
+unless --scope picks one, and roc needs --scope if there is more than one.
+
+"""
+
+import argparse, sys, os, os.path, doctest, json
+
+from experimentdb import ResultsDatabase
+
+def parse_args(args):
+    """
+    Takes in the command-line arguments list (args), and returns a nice argparse
+    result with fields for all the options.
+
+    Borrows heavily from the argparse documentation examples:
+    <http://docs.python.org/library/argparse.html>
+    """
+
+    # Construct the parser (which is stored in parser)
+    # Module docstring lives in __doc__
+    # See http://python-forum.com/pythonforum/viewtopic.php?f=3&t=36847
+    # And a formatter class so our examples in the docstring look good. Isn't it
+    # convenient how we already wrapped it to 80 characters?
+    # See http://docs.python.org/library/argparse.html#formatter-class
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    # General options
+    parser.add_argument("results_db",
+        help="SQLite results database from variantCallingExperiment.py")
+    parser.add_argument("query", choices=["best", "scores", "roc", "timings"],
+        help="what to look up")
+    parser.add_argument("--regions", nargs="+", default=None,
+        help="only use results for these regions")
+    parser.add_argument("--graphs", nargs="+", default=None,
+        help="only use results for these graphs")
+    parser.add_argument("--samples", nargs="+", default=None,
+        help="only use results for these samples (GAM file names)")
+    parser.add_argument("--top", type=int, default=10,
+        help="number of conditions to show for best")
+    parser.add_argument("--condition", default=None,
+        help="condition key to get the ROC for")
+    parser.add_argument("--scope", default=None,
+        help="only use results from this results scope (the inputs and cache "
+        "an experiment ran against)")
+
+    # The command line arguments start with the program name, which we don't
+    # want to treat as an argument for argparse. So we remove it.
+    args = args[1:]
+
+    return parser.parse_args(args)
+
+def main(args):
+    """
+    Parses command line arguments and do the work of the program.
+    "args" specifies the program arguments, with args[0] being the executable
+    name. The return value should be used as the program's exit code.
+    """
+
+    if len(args) == 2 and args[1] == "--test":
+        # Run the tests
+        return doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+
+    options = parse_args(args) # This holds the nicely-parsed options object
+
+    if not os.path.exists(options.results_db):
+        # Don't make an empty database by accident
+        sys.stderr.write("No results database at {}\n".format(
+            options.results_db))
+        return 1
+
+    results_db = ResultsDatabase(options.results_db)
+
+    if options.scope is not None:
+        scopes = [options.scope]
+    else:
+        # Look at each scope on its own
+        scopes = results_db.scopes(options.regions, options.graphs,
+            options.samples)
+
+    if options.query == "best":
+        print("scope\tcondition_key\tmean_max_f\tsamples\tname")
+        for scope in scopes:
+            for key, mean_f, samples in results_db.rank_conditions(
+                options.regions, options.graphs, options.samples,
+                scope=scope)[:options.top]:
+
+                name, _ = results_db.get_condition(key)
+                print("{}\t{}\t{}\t{}\t{}".format(scope, key, mean_f, samples,
+                    name))
+
+    elif options.query == "scores":
+        print("scope\tcondition_key\tregion\tgraph\tsample\tmax_f")
+        for scope in scopes:
+            for gam_key, scores in sorted(results_db.f_scores(options.regions,
+                options.graphs, options.samples, scope).iteritems()):
+
+                for key, max_f in sorted(scores.iteritems()):
+                    print("{}\t{}\t{}\t{}".format(scope, key,
+                        "\t".join(gam_key.split("/")), max_f))
+
+    elif options.query == "roc":
+        if (options.condition is None or options.regions is None or
+            options.graphs is None or options.samples is None):
+            sys.stderr.write("roc needs --condition and one each of "
+                "--regions, --graphs, and --samples\n")
+            return 1
+        if len(scopes) > 1:
+            sys.stderr.write("roc needs --scope, since there are results "
+                "from {} scopes\n".format(len(scopes)))
+            return 1
+
+        roc = results_db.get_roc(options.condition, options.regions[0],
+            options.graphs[0], options.samples[0],
+            scopes[0] if len(scopes) > 0 else None)
+        if roc is None:
+            sys.stderr.write("No ROC stored for that condition and sample\n")
+            return 1
+
+        for row in roc:
+            print("\t".join(str(value) for value in row))
+
+    elif options.query == "timings":
+        print("stage\tmean_seconds")
+        for stage, seconds in sorted(results_db.stage_seconds().iteritems()):
+            print("{}\t{}".format(stage, seconds))
+
+    results_db.close()
+
+    return 0
+
+if __name__ == "__main__" :
+    sys.exit(main(sys.argv))
@@ -22,7 +22,7 @@ note: debruin is exception where -k63 tag gets tacked on at end (treated as spec
 """
 
 import argparse, sys, os, os.path, random, subprocess, shutil, itertools, glob
-import doctest, re, json, collections, time, timeit, string
+import doctest, re, json, collections, time, timeit, string, math, tempfile
 import hashlib
 import signal
 from threading import Timer
@@ -31,6 +31,30 @@ import gzip
 import json
 from toil.job import Job
 from toillib import RealTimeLogger, robust_makedirs, IOStore, de_defaultdict
+from toillib import RealTimeMetrics
+from experimentdb import ResultsDatabase
+
+# These are the stages each condition goes through, in order. Each stage's
+# output depends on the options for it and all the stages before it. Read
+# filtering is done as part of the pileup stage.
+STAGE_NAMES = ["pileup", "glennfile", "vcf", "vcfeval"]
+
+# About how long does each stage take, in seconds, if we have no timings from
+# earlier runs?
+DEFAULT_STAGE_SECONDS = {
+    "pileup": 1200,
+    "glennfile": 600,
+    "vcf": 120,
+    "vcfeval": 60
+}
+
+# What resources does running a stage need? Any job that might run stages
+# itself, instead of in child jobs, has to ask for this much.
+STAGE_RESOURCES = {
+    "cores": 1,
+    "memory": "10G",
+    "disk": "10G"
+}
 
 class ExperimentCondition:
     """
@@ -147,6 +171,25 @@ class ExperimentCondition:
         # Depends on the gelnnfile and the glenn2vcf options
         return self.get_vcf_condition_name() + "/" + self.string_to_path(self.get_vcfeval_options())
         
+    def get_key(self):
+        """
+        Return a short string that identifies this condition, and which is the
+        same in every run, for keying stored results.
+        
+        """
+        
+        return hashlib.sha1(self.get_vcfeval_condition_name()).hexdigest()
+        
+    def get_options(self):
+        """
+        Return a list of all the option dicts for this condition, in the order
+        the constructor takes them.
+        
+        """
+        
+        return [self.read_filter_options, self.pileup_options,
+            self.call_options, self.vcf_options, self.vcfeval_options]
+        
     def __hash__(self):
         """
         Get the hash of this object for use in a dict.
@@ -226,6 +269,32 @@ def parse_args(args):
         help="use only these graphs when computing the best condition")
     parser.add_argument("--important_samples", nargs="+", default=None,
         help="use only these GAM basenames when computing the best condition")
+    parser.add_argument("--results_db", default="experiment_results.db",
+        help="local SQLite file to keep all F scores, ROCs, and stage timings "
+        "in, and to reuse F scores from")
+    parser.add_argument("--rescore", action="store_true",
+        help="get F scores from the cache again even if they are in the "
+        "--results_db")
+    parser.add_argument("--search", choices=["grid", "halving"],
+        default="grid",
+        help="run every condition on every sample (grid), or drop the worst "
+        "conditions on a few samples before trying the rest (halving)")
+    parser.add_argument("--halving_samples", type=int, default=2,
+        help="number of samples to score all conditions on in the first "
+        "round of a halving search")
+    parser.add_argument("--halving_keep", type=float, default=1.0/3,
+        help="fraction of conditions to keep after each halving round")
+    parser.add_argument("--halving_seed", type=int, default=0,
+        help="seed for the order in which samples are added to a halving "
+        "search")
+    parser.add_argument("--min_job_seconds", type=float, default=600,
+        help="run stages expected to take less time than this together in "
+        "one job")
+    parser.add_argument("--stage_timings", action="append", default=[],
+        help="estimate stage times from the condition_stage_seconds in this "
+        "--metrics_report JSON from an earlier run")
+    parser.add_argument("--metrics_report", default=None,
+        help="write job timing metrics to this prefix .tsv and .json")
     
     args = args[1:]
         
@@ -498,46 +567,6 @@ def truth_index_key(alignment_key):
     return truth_compressed_key(alignment_key) + ".tbi"
     
     
-def add_optional_followon(job, job_function, *args, **kwargs):
-    """
-    Given a job, and a Toil job function with pre-execution support, create a
-    new follow on of the given job that runs the given job function with the
-    given args and kwargs (which are probably all Toil args like "cores" and
-    "memory").
-    
-    The job function has to support "pre-execution": you can call it with None
-    for the job argument, and it will return True if it thinks it really needs
-    to be scheduled, and False otherwise. This lets us encapsulate the "is the
-    job done?" code with the "what does the job do?" code, which might be a good
-    design.
-    
-    Note that kwargs are discarded in pre-execution mode, because Toil doesn't
-    offer a simple way to strip the ones it is going to consume, and the job
-    functions shouldn't have to deal with extra ones.
-    
-    If the job needs to be scheduled, returns the newly created Toil job.
-    Otherwise, returns the Toil job we were going to add a followon to.
-    """
-    
-    # Run the job with None as a first argument and see what it returns. TODO:
-    # filter out Toil kwargs and enable us to pass the remaining ones to the job
-    # function.
-    need_to_run = job_function(None, *args)
-    
-    if need_to_run != False and need_to_run != True:
-        # It's not speaking the protocol
-        raise RuntimeError("Job function {} does not have pre-execution support!".format(job_function))
-        
-    if need_to_run:
-        # Actually schedule
-        RealTimeLogger.get().debug("Running {}".format(job_function))
-        return job.addFollowOnJobFn(job, job_function, *args, **kwargs)
-    else:
-        # Don't schedule and give back the job we were adding onto instead.
-        RealTimeLogger.get().debug("Skipping {}".format(job_function))
-        return job
-        
-
 def make_pileup(job, gam_key, condition, options):
     """
     Toil job to make a pileup from the given GAM, in the given experimental
@@ -801,7 +830,8 @@ def make_vcfeval_from_vcf(job, gam_key, condition, options):
 def get_max_f_score(job, gam_key, condition, options):
     """
     Given the GAM file key for a sample that has already had vcfeval run under
-    the given conditions, parse the vcfeval roc and return the biggest F score.
+    the given conditions, parse the vcfeval roc and return the biggest F score,
+    and the ROC curve as a list of lists of numbers.
     
     """
     
@@ -819,87 +849,320 @@ def get_max_f_score(job, gam_key, condition, options):
     
     # What's the max F score we found?
     max_f_score = None
+    # And what are all the points on the curve?
+    roc = []
     for parts in reader:
+        roc.append([float(part) for part in parts])
+        
         # Parse all the F scores
-        f_score = float(parts[6])
+        f_score = roc[-1][6]
         
         if max_f_score is None or f_score > max_f_score:
             # And keep the max
             max_f_score = f_score
             
-    # Return the max F score.
-    return max_f_score
+    # Return the max F score and the curve.
+    return max_f_score, roc
     
-def run_conditions(job, gam_key, conditions, options):
+class StageNode(object):
     """
-    Run the pipeline for all the conditions given, and put all the results into
-    the cache.
+    A node in the trie of stages that a set of conditions need to run. Each node
+    is one stage's output, like a particular pileup, shared by all the
+    conditions under it.
     
-    Returns a dict from condition to best F score.
+    """
     
-    Avoids re-doing work in parallel.
+    def __init__(self, stage, name, condition, cost):
+        """
+        Make a node for the given stage (or None for the root), with the given
+        condition name for the stage, a condition that passes through it (to
+        get the options from), and the expected seconds the stage takes.
+        
+        """
+        
+        self.stage = stage
+        self.name = name
+        self.condition = condition
+        self.cost = cost
+        
+        # These are the next stages, by condition name
+        self.children = collections.OrderedDict()
+        # And these are the conditions that end here, if this is a vcfeval node
+        self.conditions = []
+        
+    def subtree_cost(self):
+        """
+        Return the expected seconds to run this stage and everything under it.
+        """
+        
+        return self.cost + sum(child.subtree_cost() for child in
+            self.children.itervalues())
+            
+    def count_stages(self):
+        """
+        Return a dict from stage to the number of nodes at or under this node
+        for that stage.
+        """
+        
+        counts = collections.Counter()
+        if self.stage is not None:
+            counts[self.stage] += 1
+        for child in self.children.itervalues():
+            counts.update(child.count_stages())
+        return counts
+            
+def condition_stage_names(condition):
     """
+    Return the condition names for each stage in STAGE_NAMES, for the given
+    condition.
     
-    # Maps from pileup condition name to pileup job
-    pileup_jobs = {}
-    # And glennfile condition name to glennfile job
-    glennfile_jobs = {}
-    # And vcf condition name to glenn2vcf job
-    vcf_jobs = {}
-    # And vcfeval condition name to vcfeval job
-    vcfeval_jobs = {}
+    """
+    
+    return [condition.get_pileup_condition_name(),
+        condition.get_glennfile_condition_name(),
+        condition.get_vcf_condition_name(),
+        condition.get_vcfeval_condition_name()]
     
-    # This is the dict from condition to best F score.
-    f_scores = {}
+def build_stage_trie(conditions, stage_seconds=DEFAULT_STAGE_SECONDS):
+    """
+    Make a trie of StageNodes for the given conditions, so stages that the
+    conditions share are only run once. Stage costs come from the given dict of
+    expected seconds by stage. Returns the root, which has stage None.
+    
+    >>> grid = [{"-r": [0.9, 0.97]}, {"-q": [10]}, {"-f": [0.05, 0.1, 0.2]},
+    ...     {"--depth": [10]}, {"--all-records": [""]}]
+    >>> conditions = [ExperimentCondition(*point) for point in make_grid(grid)]
+    >>> root = build_stage_trie(conditions)
+    >>> len(conditions), sorted(root.count_stages().items())
+    (6, [('glennfile', 6), ('pileup', 2), ('vcf', 6), ('vcfeval', 6)])
+    >>> root.subtree_cost() == (2 * 1200 + 6 * (600 + 120 + 60))
+    True
+    
+    """
+    
+    root = StageNode(None, "", None, 0)
     
     for condition in conditions:
-        # For each condition, what pileup do we need?
-        pileup = condition.get_pileup_condition_name()
-        if not pileup_jobs.has_key(pileup):
-            # We need to have a job representing having made this pileup
-            pileup_jobs[pileup] = add_optional_followon(job, make_pileup, gam_key,
-                condition, options, cores=1, memory="10G", disk="10G")
-                
-        # And what glennfile do we need?
-        glennfile = condition.get_glennfile_condition_name()
-        if not glennfile_jobs.has_key(glennfile):
-            # We need to have a job representing having made this glennfile
-            glennfile_jobs[glennfile] = add_optional_followon(pileup_jobs[pileup],
-                make_glennfile_from_pileup, gam_key, condition, options,
-                cores=1, memory="10G", disk="10G")
+        node = root
+        for stage, name in zip(STAGE_NAMES, condition_stage_names(condition)):
+            if name not in node.children:
+                # Nobody has needed this stage output yet
+                node.children[name] = StageNode(stage, name, condition,
+                    stage_seconds.get(stage, DEFAULT_STAGE_SECONDS[stage]))
+            node = node.children[name]
+        node.conditions.append(condition)
+        
+    return root
+    
+def pack_subtrees(nodes, capacity):
+    """
+    Pack the given StageNodes into batches to run one after the other in a
+    single job, so no batch is expected to take more than capacity seconds
+    (unless one node alone does). Uses first-fit decreasing.
+    
+    >>> nodes = [StageNode("vcf", str(cost), None, cost)
+    ...     for cost in [100, 500, 300, 700, 200]]
+    >>> [[node.cost for node in batch] for batch in pack_subtrees(nodes, 600)]
+    [[700], [500, 100], [300, 200]]
+    >>> pack_subtrees([], 600)
+    []
+    
+    """
+    
+    # Each batch is a list of nodes and its total cost
+    batches = []
+    
+    for node in sorted(nodes, key=lambda node: -node.subtree_cost()):
+        cost = node.subtree_cost()
+        for batch in batches:
+            if batch[1] + cost <= capacity:
+                # It fits here
+                batch[0].append(node)
+                batch[1] += cost
+                break
+        else:
+            # Start a new batch
+            batches.append([[node], cost])
+            
+    return [batch for batch, _ in batches]
+    
+def load_stage_seconds(report_filenames):
+    """
+    Get the average seconds taken by each stage, from the
+    condition_stage_seconds measurements in the given MetricsReport JSON files.
+    Stages not measured get their defaults.
+    
+    """
+    
+    # This holds total seconds and count by stage
+    totals = collections.defaultdict(lambda: [0.0, 0])
+    
+    for report_filename in report_filenames:
+        with open(report_filename) as report_file:
+            for row in json.load(report_file):
+                if row["name"] != "condition_stage_seconds":
+                    continue
+                tags = dict(part.split("=", 1) for part in
+                    row["tags"].split(",") if part != "")
+                totals[tags.get("stage")][0] += row["total"]
+                totals[tags.get("stage")][1] += row["n"]
                 
-        # And what vcf do we need?
-        vcf = condition.get_vcf_condition_name()
-        if not vcf_jobs.has_key(vcf):
-            # We need to have a job representing having made this vcf
-            vcf_jobs[vcf] = add_optional_followon(glennfile_jobs[glennfile],
-                make_vcf_from_glennfile, gam_key, condition, options,
-                cores=1, memory="10G", disk="10G")
+    stage_seconds = dict(DEFAULT_STAGE_SECONDS)
+    for stage, (total, count) in totals.iteritems():
+        if stage in stage_seconds and count > 0:
+            stage_seconds[stage] = total / count
+            
+    return stage_seconds
+    
+def run_stage_node(job, gam_key, node, options):
+    """
+    Run the stage for the given StageNode, if its output isn't in the cache
+    already, and then everything under it. Stages under it that are expected to
+    be cheap run right here, and others get batched into child jobs. The job
+    must have been given STAGE_RESOURCES.
+    
+    Returns a list of sample results dicts (see run_conditions), or promises
+    for them.
+    
+    """
+    
+    # Map from stage name to the job function that makes it
+    stage_functions = {
+        "pileup": make_pileup,
+        "glennfile": make_glennfile_from_pileup,
+        "vcf": make_vcf_from_glennfile,
+        "vcfeval": make_vcfeval_from_vcf
+    }
+    
+    results = sample_results()
+    
+    if node.stage is not None:
+        stage_function = stage_functions[node.stage]
+        
+        # Use the pre-execution mode to see if we need to run it
+        if stage_function(None, gam_key, node.condition, options):
+            RealTimeLogger.get().debug("Running {} for {}".format(node.stage,
+                node.name))
+            start_time = timeit.default_timer()
+            with RealTimeMetrics.timer("condition_stage_seconds",
+                stage=node.stage):
+                stage_function(job, gam_key, node.condition, options)
+            results["stage_seconds"].append((node.stage, node.name,
+                timeit.default_timer() - start_time))
+        else:
+            RealTimeLogger.get().debug("Skipping {} for {}".format(node.stage,
+                node.name))
                 
-        # And what vcfeval do we need?
-        vcfeval = condition.get_vcfeval_condition_name()
-        if not vcfeval_jobs.has_key(vcfeval):
-            # We need to have a job representing having made this vcfeval result
-            vcfeval_jobs[vcfeval] = add_optional_followon(vcf_jobs[vcf],
-                make_vcfeval_from_vcf, gam_key, condition, options,
-                cores=1, memory="10G", disk="10G")
+    # Get the F scores and ROCs for conditions that end here
+    for condition in node.conditions:
+        results["f_scores"][condition], results["rocs"][condition] = \
+            get_max_f_score(job, gam_key, condition, options)
+    parts = [results]
+    
+    batches = pack_subtrees(node.children.values(), options.min_job_seconds)
+    
+    if len(batches) == 1:
+        # Just do it all here
+        for child in batches[0]:
+            parts += run_stage_node(job, gam_key, child, options)
+    else:
+        for batch in batches:
+            # Run each batch in its own job
+            parts.append(job.addChildJobFn(run_stage_nodes, gam_key, batch,
+                options, **STAGE_RESOURCES).rv())
                 
-        # We always need to go get the F score.
-        if vcfeval_jobs[vcfeval] == job:
-            # We can do it right now! There's nothing to wait on!
-            # Run that job as if it is this job.
-            f_scores[condition] = get_max_f_score(job, gam_key, condition, options)
+    return parts
+    
+def sample_results():
+    """
+    Make an empty sample results dict (see run_conditions).
+    """
+    
+    return {"f_scores": {}, "rocs": {}, "stage_seconds": []}
+    
+def merge_sample_results(job, parts):
+    """
+    Toil job to combine the given list of sample results dicts into one.
+    
+    """
+    
+    results = sample_results()
+    for part in parts:
+        results["f_scores"].update(part["f_scores"])
+        results["rocs"].update(part["rocs"])
+        results["stage_seconds"] += part["stage_seconds"]
+    return results
+    
+def run_stage_nodes(job, gam_key, nodes, options):
+    """
+    Toil job to run the stages in the given StageNodes, one after the other,
+    and everything under them.
+    
+    Returns a sample results dict (see run_conditions), or a promise for one.
+    
+    """
+    
+    parts = []
+    for node in nodes:
+        parts += run_stage_node(job, gam_key, node, options)
+        
+    return merge_when_ready(job, parts)
+    
+def merge_when_ready(job, parts):
+    """
+    Merge the given list of sample results dicts and promises for them into
+    one sample results dict, or a promise for one if any child jobs still have
+    to finish.
+    
+    """
+    
+    if all(isinstance(part, dict) for part in parts):
+        # Everything is done already
+        return merge_sample_results(job, parts)
+        
+    # Otherwise, wait for the child jobs
+    return job.addFollowOnJobFn(merge_sample_results, parts, cores=1,
+        memory="2G", disk="2G").rv()
+    
+def run_conditions(job, gam_key, conditions, known_scores, options):
+    """
+    Run the pipeline for all the conditions given, and put all the results into
+    the cache. known_scores is a dict from condition key to F score, for
+    conditions that already have their F score for this sample in the results
+    database; those aren't run again.
+    
+    Returns a sample results dict, with "f_scores" holding a dict from
+    condition to best F score, "rocs" holding a dict from condition to ROC
+    curve for conditions whose scores weren't known already, and
+    "stage_seconds" holding a list of (stage, stage condition name, seconds)
+    tuples for the stages that were run.
+    
+    Plans the stages as a trie, so stages that conditions share are only run
+    once, and runs cheap stages together instead of as separate jobs.
+    """
+    
+    known = sample_results()
+    to_run = []
+    for condition in conditions:
+        if condition.get_key() in known_scores:
+            # We already know how this one does
+            known["f_scores"][condition] = known_scores[condition.get_key()]
         else:
-            # We need to wait until the results are ready.
-            f_score_job = vcfeval_jobs[vcfeval].addFollowOnJobFn(
-                get_max_f_score, gam_key, condition, options,
-                cores=1, memory="2G", disk="2G")
-                
-            # And save the result in our return dict for this condition
-            f_scores[condition] = f_score_job.rv()
+            to_run.append(condition)
             
-    # Send back f scores by condition.
-    return f_scores
+    if len(to_run) == 0:
+        # Nothing to do
+        return known
+    
+    root = build_stage_trie(to_run, options.stage_seconds)
+    
+    RealTimeLogger.get().info("Running {} for {} conditions ({:.0f} seconds of "
+        "work expected)".format(", ".join("{} {}s".format(count, stage)
+        for stage, count in sorted(root.count_stages().iteritems())), gam_key,
+        len(to_run), root.subtree_cost()))
+    
+    return merge_when_ready(job, [known] + run_stage_node(job, gam_key, root,
+        options))
    
 def make_grid(description):
     """
@@ -927,21 +1190,11 @@ def make_single_grid(description):
         # Zip item values with their keys and make a dict.
         yield dict(zip(keys, value_combo))
                 
-def run_experiment(job, options):
+def experiment_conditions():
     """
-    Toil job to run an experiment on a variety of conditions and compare the
-    results.
+    Return the list of ExperimentConditions to try.
     """
     
-    # Make the IOStore we can search for GAMs
-    gam_store = IOStore.get(options.in_gams)
-    # And one so we can check if truth files exist
-    truth_store = IOStore.get(options.truth)
-    
-    # This will hold best F score by region, graph, sample, and then condition.
-    # We stick in dicts by condition.
-    results = collections.defaultdict(lambda: collections.defaultdict(dict))
-    
     # Make some experimental conditions with filter, pileup, call,
     # and glenn2vcf options. 
     
@@ -1010,8 +1263,34 @@ def run_experiment(job, options):
         })
     )
     
+    return conditions
+    
+def run_experiment(job, known_scores, options):
+    """
+    Toil job to run an experiment on a variety of conditions and compare the
+    results. known_scores is a dict from GAM key to dict from condition key to
+    F score, for results we already have in the results database.
+    
+    Returns a dict by region, then graph, then sample, of sample results dicts
+    (see run_conditions).
+    """
+    
+    # Make the IOStore we can search for GAMs
+    gam_store = IOStore.get(options.in_gams)
+    # And one so we can check if truth files exist
+    truth_store = IOStore.get(options.truth)
+    
+    # This will hold sample results by region, graph, and sample.
+    results = collections.defaultdict(lambda: collections.defaultdict(dict))
+    
+    # Make all the conditions to try
+    conditions = experiment_conditions()
+    
     RealTimeLogger.get().info("Running {} conditions...".format(len(conditions)))
     
+    # This holds the keys for all the GAMs we want to try the conditions on
+    gam_keys = []
+    
     for region_dir in gam_store.list_input_directory(""):
         # Within every region we have samples for, look through all the
         # different graphs.
@@ -1060,113 +1339,400 @@ def run_experiment(job, options):
                     RealTimeLogger.get().warning("Skipping missing truth for {}".format(gam_key))
                     continue
                 
-                # Kick off a pipeline to make the variant calls.
-                # TODO: assumes all the extra directories we need to read stuff from are set
-                exp_job = job.addChildJobFn(run_conditions, gam_key, conditions, options,
-                    cores=1, memory="2G", disk="10G")
-                    
-                # Save the best F score by condition under this region, graph, and sample filename
-                results[region_dir][graph_dir][filename] = exp_job.rv()
+                gam_keys.append(gam_key)
+                
+    if options.search == "halving":
+        # Score everything on a few samples, and only go on with the best
+        # conditions.
+        gam_keys = order_for_halving(gam_keys, options.halving_seed)
+        
+        RealTimeLogger.get().info("Planned halving search: {}".format(
+            ", ".join("{} conditions on {} samples".format(*step) for step in
+            halving_schedule(len(conditions), len(gam_keys),
+            options.halving_samples, options.halving_keep))))
+        
+        return job.addChildJobFn(run_halving_round, gam_keys, conditions, 0,
+            min(max(options.halving_samples, 1), len(gam_keys)), {},
+            known_scores, options, cores=1, memory="2G", disk="2G").rv()
+                
+    for gam_key in gam_keys:
+        region_dir, graph_dir, filename = gam_key.split("/")
+        
+        # Kick off a pipeline to make the variant calls.
+        # TODO: assumes all the extra directories we need to read stuff from are set
+        # It may run stages itself, so it needs the resources for them.
+        exp_job = job.addChildJobFn(run_conditions, gam_key, conditions,
+            known_scores.get(gam_key, {}), options, **STAGE_RESOURCES)
+            
+        # Save the results under this region, graph, and sample filename
+        results[region_dir][graph_dir][filename] = exp_job.rv()
                 
     # Give back the results
     # TODO: we run it through JSON to fix the pickle-ability.
     return de_defaultdict(results)
     
-def pick_best(job, results, options):
+def order_for_halving(gam_keys, seed=0):
     """
-    Given the return value of run_experiment, which is a dict from region, then
-    graph, then sample, then condition to f score, pick the best condition for
-    each region, graph, and sample.
+    Put the given GAM keys in the order a halving search should add them in:
+    shuffled with the given seed, but taking a sample from each region in turn,
+    so even the first few samples cover as many regions as they can.
+    
+    >>> keys = ["brca1/cactus/NA1.gam", "brca1/cactus/NA2.gam",
+    ...     "brca1/refonly/NA1.gam", "lrc_kir/cactus/NA1.gam",
+    ...     "mhc/cactus/NA1.gam"]
+    >>> ordered = order_for_halving(keys)
+    >>> sorted(key.split("/")[0] for key in ordered[:3])
+    ['brca1', 'lrc_kir', 'mhc']
+    >>> sorted(ordered) == sorted(keys)
+    True
+    >>> ordered == order_for_halving(list(reversed(keys)))
+    True
     
-    Returns (best condition, f score, next best f score).
     """
     
-    # Strategy
+    # Shuffle the same way no matter what order they came in
+    shuffled = sorted(gam_keys)
+    random.Random(seed).shuffle(shuffled)
+    
+    # Bucket them by region
+    by_region = collections.OrderedDict()
+    for gam_key in shuffled:
+        by_region.setdefault(gam_key.split("/")[0], []).append(gam_key)
+        
+    # Deal them out round-robin
+    ordered = []
+    for round_keys in itertools.izip_longest(*by_region.values()):
+        ordered += [gam_key for gam_key in round_keys if gam_key is not None]
+        
+    return ordered
+    
+def halving_schedule(num_conditions, num_samples, first_samples, keep):
+    """
+    Work out the rounds of a halving search with the given number of conditions
+    and samples, starting with the given number of samples and keeping the
+    given fraction of conditions each round. The number of samples grows by the
+    same factor as the number of conditions shrinks, so each round costs about
+    the same.
+    
+    Returns a list of (conditions, samples) pairs, one per round.
+    
+    >>> halving_schedule(100, 20, 2, 1.0/3)
+    [(100, 2), (34, 6), (12, 18), (4, 20)]
+    >>> halving_schedule(5, 1, 2, 0.5)
+    [(5, 1)]
+    >>> halving_schedule(0, 10, 2, 0.5)
+    []
+    
+    """
+    
+    schedule = []
+    samples = min(max(first_samples, 1), num_samples)
+    conditions = num_conditions
+    
+    while conditions > 0 and samples > 0:
+        schedule.append((conditions, samples))
+        if samples == num_samples:
+            # Everything left has been run on every sample
+            break
+        conditions = halving_survivor_count(conditions, keep)
+        samples = halving_sample_count(samples, num_samples, keep)
+        
+    return schedule
+    
+def halving_survivor_count(num_conditions, keep):
+    """
+    Return how many of the given number of conditions survive a halving round
+    that keeps the given fraction. At least one always survives.
+    
+    """
+    
+    return max(1, int(math.ceil(num_conditions * keep)))
+    
+def halving_sample_count(num_samples, max_samples, keep):
+    """
+    Return how many samples the next halving round should use, after a round
+    on the given number of samples that kept the given fraction of conditions.
+    
+    """
+    
+    return min(max_samples, max(num_samples + 1,
+        int(math.ceil(num_samples / keep))))
+    
+def pick_halving_survivors(scores, gam_keys, conditions, keep):
+    """
+    Given a dict from GAM key to dict from condition to F score, return the
+    best of the given conditions by average F score on the given GAM keys,
+    keeping the given fraction of them. Ties go to the condition listed first.
+    
+    >>> scores = {"a": {"x": 0.5, "y": 0.9, "z": 0.7},
+    ...     "b": {"x": 0.6, "y": 0.8, "z": 0.9}}
+    >>> pick_halving_survivors(scores, ["a", "b"], ["x", "y", "z"], 0.5)
+    ['y', 'z']
+    >>> pick_halving_survivors(scores, ["a"], ["x", "y", "z"], 0.1)
+    ['y']
+    
+    """
+    
+    # Work out the average score for each condition
+    averages = {}
+    for condition in conditions:
+        condition_scores = [scores[gam_key][condition] for gam_key in gam_keys]
+        averages[condition] = sum(condition_scores) / len(condition_scores)
+        
+    # Sort best first, keeping the original order for ties
+    ranked = sorted(enumerate(conditions),
+        key=lambda (index, condition): (-averages[condition], index))
+        
+    return [condition for _, condition in
+        ranked[:halving_survivor_count(len(conditions), keep)]]
+        
+def run_halving_round(job, gam_keys, conditions, done_samples, round_samples,
+    scores, known_scores, options):
+    """
+    Toil job to run one round of a halving search. Runs the given conditions
+    on the GAM keys from done_samples up to round_samples (they have already
+    been run on the ones before that), and then picks the survivors and starts
+    the next round in a follow-on.
     
-    # We have a collection of regions, graphs, and samples that we care about
-    # (or None for "all of them"). We'll loop through these parts of the dict
-    # and sum up all the f scores for each condition, then average. Then the
-    # condition with the highest average f score will win.
+    scores is a dict from GAM key to sample results dict (see run_conditions),
+    for all the samples done so far. known_scores is the same as for
+    run_experiment.
     
-    # This holds F score lists (and later averages) by condition
-    condition_scores = collections.defaultdict(list)
+    Returns the results in the same format as run_experiment, with every F
+    score computed in any round.
+    
+    """
+    
+    RealTimeLogger.get().info("Halving round: {} conditions on samples {} to "
+        "{} of {}".format(len(conditions), done_samples, round_samples,
+        len(gam_keys)))
+    
+    # Make a copy of the scores we can add promises to
+    scores = dict(scores)
+    
+    for gam_key in gam_keys[done_samples:round_samples]:
+        # Run all the surviving conditions on the new samples. All the results
+        # go into the cache as usual.
+        scores[gam_key] = job.addChildJobFn(run_conditions, gam_key,
+            conditions, known_scores.get(gam_key, {}), options,
+            **STAGE_RESOURCES).rv()
+            
+    # Then decide what survives
+    return job.addFollowOnJobFn(finish_halving_round, gam_keys, conditions,
+        round_samples, scores, known_scores, options, cores=1, memory="2G",
+        disk="2G").rv()
+        
+def finish_halving_round(job, gam_keys, conditions, round_samples, scores,
+    known_scores, options):
+    """
+    Toil job to look at the F scores from a halving round on the first
+    round_samples GAM keys, and either start the next round with the best
+    conditions or, if all the samples have been used, return the results in the
+    same format as run_experiment.
+    
+    """
+    
+    if round_samples >= len(gam_keys) or len(conditions) == 0:
+        # Everything that survived has been run on every sample. Give back all
+        # the F scores we got by region, graph, and sample.
+        results = collections.defaultdict(lambda: collections.defaultdict(dict))
+        for gam_key, gam_scores in scores.iteritems():
+            region_dir, graph_dir, filename = gam_key.split("/")
+            results[region_dir][graph_dir][filename] = gam_scores
+        return de_defaultdict(results)
+        
+    survivors = pick_halving_survivors(dict((gam_key, results["f_scores"])
+        for gam_key, results in scores.iteritems()), gam_keys[:round_samples],
+        conditions, options.halving_keep)
+        
+    RealTimeLogger.get().info("Keeping {} of {} conditions after {} "
+        "samples".format(len(survivors), len(conditions), round_samples))
+        
+    return job.addChildJobFn(run_halving_round, gam_keys, survivors,
+        round_samples, halving_sample_count(round_samples, len(gam_keys),
+        options.halving_keep), scores, known_scores, options, cores=1,
+        memory="2G", disk="2G").rv()
+    
+def results_scope(options):
+    """
+    Return a string identifying the inputs and cache an experiment with the
+    given options reads from. F scores are only reused within a scope, since
+    scores computed against other alignments, graphs, truth sets, or a cache
+    that has since been replaced don't belong to this experiment.
+    
+    >>> options = argparse.Namespace(in_gams="gams", in_graphs="graphs",
+    ...     cache="cache", truth="truth", regions="bed", sdf="sdf")
+    >>> scope = results_scope(options)
+    >>> len(scope)
+    40
+    >>> options.cache = "cache2"
+    >>> results_scope(options) == scope
+    False
+    
+    """
+    
+    return hashlib.sha1(json.dumps([options.in_gams, options.in_graphs,
+        options.cache, options.truth, options.regions,
+        options.sdf])).hexdigest()
+    
+def save_results(results_db, scope, results):
+    """
+    Save the return value of run_experiment to the given ResultsDatabase, under
+    the given results scope, in one transaction per table.
+    
+    """
+    
+    # These hold tuples to bulk insert
+    conditions = {}
+    scores = []
+    timings = []
     
     for region, region_results in results.iteritems():
-        # For every region
         for graph, graph_results in region_results.iteritems():
-            # For every graph
             for sample, sample_results in graph_results.iteritems():
-                # For every sample
-                for condition, f_score in sample_results.iteritems():
-                    # Put the f score in the list for the condition
-                    condition_scores[condition].append(f_score)
+                for condition, f_score in sample_results["f_scores"].iteritems():
+                    if condition not in sample_results["rocs"]:
+                        # This came from the database, so it's there already
+                        continue
                     
-    for condition in condition_scores.iterkeys():
-        # Replace each list with an average.
-        condition_scores[condition] = sum(condition_scores[condition]) / len(condition_scores[condition])
-                
-                
-    # We track the best condition and its score
-    best_condition = None
-    best_f_score = None
-    
-    # Also the second best condition and its score so we can get an
-    # idea of if it's better.
-    second_best_condition = None
-    second_best_f_score = None
-                
-    for condition, f_score in condition_scores.iteritems():
-        if best_condition is None or f_score > best_f_score:
-            # This is the best for this sample
-            
-            # Demote the old best
-            second_best_condition = best_condition
-            second_best_f_score = best_f_score
-            
-            # Promothe the new one
-            best_condition = condition
-            best_f_score = f_score
-        elif second_best_condition is None or f_score > second_best_f_score:
-            # This isn't the best bus is a new second best
-            second_best_condition = condition
-            second_best_f_score = f_score
-    
-    # Return the best overall condition and its f score average, as compared to
-    # the second best.
-    return (best_condition, best_f_score, second_best_f_score)
+                    conditions[condition.get_key()] = (condition.get_key(),
+                        condition.get_vcfeval_condition_name(),
+                        condition.get_options())
+                    scores.append((scope, condition.get_key(), region, graph,
+                        sample, f_score, sample_results["rocs"][condition]))
+                        
+                for stage, stage_name, seconds in \
+                    sample_results["stage_seconds"]:
+                    
+                    timings.append((region, graph, sample, stage, stage_name,
+                        seconds))
+                        
+    results_db.add_conditions(conditions.itervalues())
+    results_db.add_results(scores)
+    results_db.add_stage_timings(timings)
     
+    RealTimeLogger.get().info("Saved {} F scores and {} stage timings".format(
+        len(scores), len(timings)))
     
-def run_and_evaluate(job, options):
-    """
-    Run the experiment, then evaluate its results and return a summary.
+def pick_best(results_db, scope, conditions, options):
     """
+    Pick the best of the given conditions by average F score over the important
+    regions, graphs, and samples (or all of them) in the given ResultsDatabase.
+    Results for other conditions, or from other results scopes, are ignored.
     
-    # Run the experiment
-    exp_job = job.addChildJobFn(run_experiment, options, cores=1, memory="2G", disk="2G")
+    Only conditions run on the most samples are compared, so in a halving
+    search, conditions dropped early don't win by doing well on just the first
+    few samples.
     
-    # Then evaluate the results and come to a conclusion
-    eval_job = exp_job.addFollowOnJobFn(pick_best, exp_job.rv(), options, cores=1, memory="2G", disk="2G")
+    Returns (best condition, f score, next best f score).
+    
+    >>> db = ResultsDatabase(":memory:")
+    >>> loose = ExperimentCondition({"-r": 0}, {}, {}, {}, {})
+    >>> strict = ExperimentCondition({"-r": 0.97}, {}, {}, {}, {})
+    >>> db.add_conditions([(c.get_key(), c.get_vcfeval_condition_name(),
+    ...     c.get_options()) for c in [loose, strict]])
+    >>> db.add_results([("s1", loose.get_key(), "brca1", "cactus", "NA1.gam",
+    ...     0.9, None), ("s1", strict.get_key(), "brca1", "cactus", "NA1.gam",
+    ...     0.95, None), ("s2", loose.get_key(), "brca1", "cactus", "NA1.gam",
+    ...     0.99, None)])
+    >>> options = argparse.Namespace(important_regions=None,
+    ...     important_graphs=None, important_samples=None)
+    >>> best, f_score, next_f_score = pick_best(db, "s1", [loose, strict],
+    ...     options)
+    >>> best == strict, f_score, next_f_score
+    (True, 0.95, 0.9)
+    >>> best, f_score, next_f_score = pick_best(db, "s1", [loose], options)
+    >>> best == loose, f_score, next_f_score
+    (True, 0.9, None)
     
-    # Return the evaluation
-    return eval_job.rv()
+    """
+    
+    ranked = results_db.rank_conditions(regions=options.important_regions,
+        graphs=options.important_graphs, samples=options.important_samples,
+        condition_keys=[condition.get_key() for condition in conditions],
+        scope=scope)
+        
+    if len(ranked) == 0:
+        # Nothing was run
+        return (None, None, None)
+        
+    # Rebuild the best condition from its stored options
+    _, condition_options = results_db.get_condition(ranked[0][0])
+    best_condition = ExperimentCondition(*[dict((str(option), value)
+        for option, value in option_dict.iteritems())
+        for option_dict in condition_options])
+    
+    # Return the best overall condition and its f score average, as compared to
+    # the second best.
+    return (best_condition, ranked[0][1],
+        ranked[1][1] if len(ranked) > 1 else None)
     
 def main(args):
     
+    if len(args) == 2 and args[1] == "--test":
+        # Run the tests
+        return doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+    
     options = parse_args(args) 
     
+    # Open up the database of results we already have
+    results_db = ResultsDatabase(options.results_db)
+    
+    # Work out how long each stage should take, so we know what's worth its
+    # own job. Use the timings from earlier runs in the database, unless we
+    # were given some.
+    options.stage_seconds = dict(DEFAULT_STAGE_SECONDS)
+    options.stage_seconds.update(results_db.stage_seconds())
+    if len(options.stage_timings) > 0:
+        options.stage_seconds = load_stage_seconds(options.stage_timings)
+        
+    # Don't redo F scores we already have from these same inputs and cache
+    scope = results_scope(options)
+    known_scores = {} if options.rescore else results_db.f_scores(scope=scope)
+    
     RealTimeLogger.start_master()
 
     # Make a root job
-    root_job = Job.wrapJobFn(run_and_evaluate, options,
+    root_job = Job.wrapJobFn(run_experiment, known_scores, options,
                              cores=1, memory="2G", disk="2G")
     
-    # Run it and get the return value
-    answer = Job.Runner.startToil(root_job,  options)
-
-    RealTimeLogger.stop_master()
+    try:
+        # Run it and get the return value
+        answer = Job.Runner.startToil(root_job,  options)
+    finally:
+        RealTimeLogger.stop_master()
+        
+        if options.metrics_report is not None:
+            # Say how long the stages took, for planning the next run
+            RealTimeMetrics.report.write(options.metrics_report)
     
-    print("Root return value:")
-    print(answer)
+    # Keep everything we computed
+    save_results(results_db, scope, answer)
+    
+    # Save the results for this experiment's conditions with the other
+    # experimental results
+    conditions = experiment_conditions()
+    export_dir = tempfile.mkdtemp()
+    try:
+        export_filename = os.path.join(export_dir, "results.db")
+        results_db.export(export_filename, [condition.get_key() for condition
+            in conditions], scope)
+        IOStore.get(options.out_dir).write_output_file(export_filename,
+            "results.db")
+    finally:
+        shutil.rmtree(export_dir)
+    
+    # Then come to a conclusion
+    best_condition, best_f_score, next_f_score = pick_best(results_db, scope,
+        conditions, options)
+    results_db.close()
+    
+    print("Results scope (for queryExperimentResults.py --scope): {}".format(
+        scope))
+    print("Best condition (F = {}, next best F = {}):".format(best_f_score,
+        next_f_score))
+    if best_condition is not None:
+        print(best_condition.report())
     
 if __name__ == "__main__" :
     sys.exit(main(sys.argv))
@@ -8,6 +8,7 @@
 
 
 import argparse, sys, os, os.path, random, subprocess, shutil, bisect, math
+import doctest, gzip, collections
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description=__doc__, 
@@ -30,30 +31,107 @@ def get_qual_from_line(line, options):
     # quality 
     return float(line.split("\t")[5])
 
-def vcf_qual_stats(vcf_path, bed_path = None, ignore_keywords = []):
-    """ count up snps indels and others for each quality value, and return 
-a table with the cumulative results.  note quality is expected to be a number
-in 5th column of vcf """
-
-    cmd = "bcftools view {}".format(vcf_path)
-    if bed_path is not None:
-        assert vcf_path[-3:] == ".gz" # gotta be indexed
-        cmd += " -R {}".format(bed_path)
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                         stderr=sys.stderr, bufsize=-1)
-    output, _ = p.communicate()
-    assert p.wait() == 0
-    vcf_file = [line + "\n" for line in output.split("\n")]
+def open_maybe_gzipped(path):
+    """ open a plain or gzipped (including bgzipped) file for reading, or stdin
+    for "-" """
+
+    if path == "-":
+        return sys.stdin
+    with open(path, "rb") as f:
+        magic = f.read(2)
+    if magic == "\x1f\x8b":
+        # gzip reads all the bgzf blocks as one stream
+        return gzip.open(path, "rb")
+    return open(path)
+
+class BedIndex(object):
+    """ sorted, merged intervals from a BED file, for looking up whether a
+    record overlaps any of them without going through bcftools -R
+
+    >>> index = BedIndex(["chr1\\t10\\t20", "chr1\\t15\\t30", "chr1\\t50\\t60",
+    ...     "track name=x", "chr2\\t0\\t5"])
+    >>> index.intervals["chr1"]
+    ([10, 50], [30, 60])
+    >>> [index.overlaps("chr1", pos, 1) for pos in [10, 11, 30, 31, 50, 51]]
+    [False, True, True, False, False, True]
+    >>> index.overlaps("chr1", 8, 4), index.overlaps("chr3", 1, 1)
+    (True, False)
+    """
+
+    def __init__(self, lines):
+        """ build the index from an iterable of BED lines """
+
+        by_contig = collections.defaultdict(list)
+        for line in lines:
+            toks = line.rstrip("\n").split("\t")
+            if len(toks) < 3 or line.startswith(("#", "track", "browser")):
+                continue
+            by_contig[toks[0]].append((int(toks[1]), int(toks[2])))
+
+        # map contig -> (sorted starts, ends) of disjoint half-open intervals
+        self.intervals = dict()
+        for contig, intervals in by_contig.iteritems():
+            starts = []
+            ends = []
+            for start, end in sorted(intervals):
+                if len(ends) > 0 and start <= ends[-1]:
+                    # merge with the last one
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.intervals[contig] = (starts, ends)
+
+    @staticmethod
+    def load(bed_path):
+        """ read the index from a (possibly gzipped) BED file """
+        bed_file = open_maybe_gzipped(bed_path)
+        try:
+            return BedIndex(bed_file)
+        finally:
+            bed_file.close()
+
+    def overlaps(self, contig, pos, length):
+        """ does a VCF record at 1-based pos, with a reference allele of the
+        given length, overlap any interval? (like the default for bcftools -R)
+        """
+        if contig not in self.intervals:
+            return False
+        starts, ends = self.intervals[contig]
+        start = pos - 1
+        end = start + max(length, 1)
+        # last interval starting before the record ends
+        i = bisect.bisect_left(starts, end) - 1
+        return i >= 0 and ends[i] > start
+
+def qual_stats_from_lines(lines, bed_index = None, ignore_keywords = []):
+    """ count up snps indels and others for each quality value in the given
+    VCF lines, only for records overlapping the bed_index if given, and return
+    a table with the cumulative results (highest quality first).  only keeps
+    one count per distinct quality, so memory doesn't grow with the file.
+
+    >>> lines = ["##fileformat=VCFv4.2", "#CHROM\\tPOS\\tID\\tREF\\tALT\\tQUAL",
+    ...     "chr1\\t11\\t.\\tA\\tG\\t30", "chr1\\t12\\t.\\tA\\tAT\\t30",
+    ...     "chr1\\t13\\t.\\tAC\\tGT,A\\t10", "chr1\\t90\\t.\\tA\\tG\\t50",
+    ...     "chr1\\t14\\t.\\tA\\tG\\t20\\t.\\tOverlapConflict"]
+    >>> qual_stats_from_lines(lines)
+    [[50.0, 1, 0, 0], [30.0, 2, 1, 0], [20.0, 3, 1, 0], [10.0, 3, 2, 0]]
+    >>> qual_stats_from_lines(lines, BedIndex(["chr1\\t0\\t20"]),
+    ...     ["OverlapConflict"])
+    [[30.0, 1, 1, 0], [10.0, 1, 2, 0]]
+    """
 
     # map quality score --> (snp count, indel count, other count)
     counts = dict()
-    
-    for line in vcf_file:
+
+    for line in lines:
         if len(line) > 1 and line[0] != "#" and all(x not in line for x in ignore_keywords):
-            toks = line.split("\t")
+            toks = line.split("\t", 6)
             ref = toks[3]
+            if bed_index is not None and not bed_index.overlaps(toks[0], int(toks[1]), len(ref)):
+                continue
             alts = toks[4].split(",")
-            qual = get_qual_from_line(line, None)
+            qual = float(toks[5])
             if qual not in counts:
                 counts[qual] = [0, 0, 0]
             # count any site where no length change as snp
@@ -66,7 +144,7 @@ in 5th column of vcf """
             # deprecated for now
             else:
                 counts[qual][2] += 1
-                    
+
     # make cumulative table qual, snps, indels, others
     qvals = sorted(counts.keys())
     qvals.reverse()
@@ -78,8 +156,51 @@ in 5th column of vcf """
 
     return table
 
+def vcf_qual_stats(vcf_path, bed_path = None, ignore_keywords = [], bed_index = None):
+    """ count up snps indels and others for each quality value, and return 
+a table with the cumulative results.  note quality is expected to be a number
+in 5th column of vcf.  the vcf (plain or bgzipped, no index needed) is streamed
+in one pass, and clipped to the bed (or an already-loaded BedIndex) """
+
+    if bed_index is None and bed_path is not None:
+        bed_index = BedIndex.load(bed_path)
+
+    vcf_file = open_maybe_gzipped(vcf_path)
+    try:
+        return qual_stats_from_lines(vcf_file, bed_index, ignore_keywords)
+    finally:
+        if vcf_file is not sys.stdin:
+            vcf_file.close()
+
+def vcfeval_qual_stats(fn_path, fp_path, tp_path, bed_path = None, fp_bed_path = None):
+    """ make the fn, fp and tp tables for a vcfeval output directory, reading
+    each clipping bed only once.  OverlapConflict false negatives are skipped.
+    returns (fn_table, fp_table, tp_table) """
+
+    bed_index = BedIndex.load(bed_path) if bed_path is not None else None
+    fp_bed_index = bed_index
+    if fp_bed_path is not None and fp_bed_path != bed_path:
+        fp_bed_index = BedIndex.load(fp_bed_path)
+
+    fn_table = vcf_qual_stats(fn_path, ignore_keywords = ["OverlapConflict"], bed_index = bed_index)
+    fp_table = vcf_qual_stats(fp_path, bed_index = fp_bed_index)
+    tp_table = vcf_qual_stats(tp_path, bed_index = bed_index)
+    return fn_table, fp_table, tp_table
+
 def balance_tables(fn_table, fp_table, tp_table):
-    """ need to make one table """
+    """ need to make one table
+
+    >>> fn = [[5.0, 2, 0, 0]]
+    >>> fp = [[30.0, 1, 0, 0], [10.0, 2, 1, 0]]
+    >>> tp = [[20.0, 3, 0, 0], [10.0, 4, 1, 0]]
+    >>> balance_tables(fn, fp, tp)
+    >>> fp
+    [[30.0, 1, 0, 0], [20.0, 1, 0, 0], [10.0, 2, 1, 0]]
+    >>> tp
+    [[30.0, 0, 0, 0], [20.0, 3, 0, 0], [10.0, 4, 1, 0]]
+    >>> fn
+    [[30.0, 6, 1, 0], [20.0, 3, 1, 0], [10.0, 2, 0, 0]]
+    """
 
     # total truth (for inferring false negatives)
     # take sum of last lines of tp and fn
@@ -87,25 +208,28 @@ def balance_tables(fn_table, fp_table, tp_table):
     if len(fn_table) > 0:
         total = [x + y for x,y in zip(total, fn_table[-1][1:])]
 
-    # all quality values
-    quals = set(x[0] for x in fp_table + tp_table)
+    # all quality values, highest first like the tables
+    quals = sorted(set(x[0] for x in fp_table + tp_table), reverse=True)
 
-    # make sure we have entry for every quality, grabbing next value
-    # if not
+    # make sure we have entry for every quality, grabbing the row for the
+    # next highest quality if not.  walks the table and the qualities
+    # together, so it's linear instead of inserting into the middle of a list
     def extend_table(table):
-        table.reverse() # make bisect easier to write if increasing
+        extended = []
+        # index of the last row with quality >= the current qual
+        pos = -1
         for qual in quals:
-            pos = bisect.bisect_left(table, [qual, 0, 0, 0])
-            if len(table) == 0:
-                table.append([qual, 0, 0, 0])
-            elif pos == len(table):
-                table.append([qual, 0, 0, 0])
-            elif qual != table[pos][0]:
-                other_row = table[pos]
-                table.insert(pos, [qual, other_row[1], other_row[2], other_row[3]])
-        assert table == sorted(table)
-        assert len(table) == len(quals)
-        table.reverse()
+            while pos + 1 < len(table) and table[pos + 1][0] >= qual:
+                pos += 1
+            if pos >= 0 and table[pos][0] == qual:
+                extended.append(table[pos])
+            elif pos >= 0:
+                extended.append([qual] + table[pos][1:])
+            else:
+                # nothing is that good
+                extended.append([qual, 0, 0, 0])
+        assert len(extended) == len(quals)
+        table[:] = extended
 
     extend_table(fp_table)
     extend_table(tp_table)
@@ -122,6 +246,10 @@ def balance_tables(fn_table, fp_table, tp_table):
         assert all(x >= 0 for x in fn_table[-1][1:])
 
 def main(args):
+    if len(args) == 2 and args[1] == "--test":
+        # Run the tests
+        return doctest.testmod(optionflags=doctest.NORMALIZE_WHITESPACE)
+
     options = parse_args(args)
 
     if options.balance is not None:
@@ -0,0 +1,1056 @@
+"""
+vglib.py: useful extras for reading vg's binary formats from Python.
+
+Includes a streaming reader for GAM files (and other vg protobuf streams) that
+decodes the length-prefixed, gzipped protobuf records directly into lightweight
+alignment records, without shelling out to "vg view" and parsing JSON. A JSON
+fallback that produces the same records is also provided.
+
+Also includes a compact, memory-mappable store of graph node sequences.
+
+"""
+
+import sys, os, os.path, json, collections, struct, subprocess, gzip
+import mmap
+import zlib
+
+import numpy
+
+# vg stream files are gzipped. This is what they start with.
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Protobuf field numbers for the parts of vg.proto that we decode. Anything not
+# listed here is skipped over without being decoded.
+ALIGNMENT_SEQUENCE = 1
+ALIGNMENT_PATH = 2
+ALIGNMENT_NAME = 3
+ALIGNMENT_MAPPING_QUALITY = 5
+ALIGNMENT_SCORE = 6
+ALIGNMENT_IS_SECONDARY = 15
+ALIGNMENT_IDENTITY = 16
+
+PATH_MAPPING = 2
+
+MAPPING_POSITION = 1
+MAPPING_EDIT = 2
+MAPPING_IS_REVERSE = 4
+
+POSITION_NODE_ID = 1
+POSITION_OFFSET = 2
+POSITION_IS_REVERSE = 4
+
+EDIT_FROM_LENGTH = 1
+EDIT_TO_LENGTH = 2
+EDIT_SEQUENCE = 3
+
+GRAPH_NODE = 1
+GRAPH_EDGE = 2
+
+NODE_SEQUENCE = 1
+NODE_ID = 3
+
+# These are the Alignment fields that a reader can be asked for, by name.
+ALIGNMENT_FIELDS = {
+    "sequence": ALIGNMENT_SEQUENCE,
+    "path": ALIGNMENT_PATH,
+    "name": ALIGNMENT_NAME,
+    "mapping_quality": ALIGNMENT_MAPPING_QUALITY,
+    "score": ALIGNMENT_SCORE,
+    "is_secondary": ALIGNMENT_IS_SECONDARY,
+    "identity": ALIGNMENT_IDENTITY
+}
+
+# An Edit is a from length, a to length, and a replacement sequence (or None if
+# the edit is a perfect match or a deletion).
+Edit = collections.namedtuple("Edit", ["from_length", "to_length", "sequence"])
+
+# A GraphSize counts the nodes, edges, and total node sequence length in a
+# graph.
+GraphSize = collections.namedtuple("GraphSize", ["nodes", "edges",
+    "sequence_length"])
+
+# A Mapping is a node ID (or None if the mapping isn't on a node), an offset on
+# that node, an orientation flag, and a list of Edits.
+Mapping = collections.namedtuple("Mapping", ["node_id", "offset", "is_reverse",
+    "edits"])
+
+class Alignment(object):
+    """
+    A lightweight record for a single read alignment, holding only the fields
+    that the stats code needs.
+
+    Follows the JSON conventions the stats code was originally written against:
+    score is None on unaligned reads (where "vg view -aj" leaves it out), and
+    mapping_quality is 0.0 when it isn't set.
+
+    """
+
+    __slots__ = ["name", "sequence", "score", "mapping_quality", "identity",
+        "is_secondary", "mappings"]
+
+    def __init__(self, name=None, sequence="", score=None,
+        mapping_quality=0.0, identity=0.0, is_secondary=False, mappings=None):
+        """
+        Make a new Alignment record.
+        """
+
+        self.name = name
+        self.sequence = sequence
+        self.score = score
+        self.mapping_quality = mapping_quality
+        self.identity = identity
+        self.is_secondary = is_secondary
+        self.mappings = mappings if mappings is not None else []
+
+    def __repr__(self):
+        """
+        Represent the alignment for debugging.
+        """
+
+        return "Alignment({!r}, score={!r}, secondary={!r}, {} mappings)".format(
+            self.name, self.score, self.is_secondary, len(self.mappings))
+
+def read_varint(data, position):
+    """
+    Decode a protobuf varint from the given bytearray, starting at the given
+    position. Returns the value and the position just after it.
+
+    >>> read_varint(bytearray(b"\\x96\\x01"), 0)
+    (150, 2)
+
+    """
+
+    byte = data[position]
+    if byte < 0x80:
+        # Most of our varints are tiny, so handle that fast
+        return byte, position + 1
+
+    result = byte & 0x7f
+    shift = 7
+    position += 1
+    while True:
+        byte = data[position]
+        result |= (byte & 0x7f) << shift
+        position += 1
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+def signed_varint(value):
+    """
+    Reinterpret a decoded varint as a two's complement int64, the way protobuf
+    encodes negative int32 and int64 values.
+
+    """
+
+    if value >= (1 << 63):
+        return value - (1 << 64)
+    return value
+
+def iterate_fields(data, start=0, end=None):
+    """
+    Yield (field number, wire type, value) triples for all the fields in the
+    protobuf message stored in the given bytearray between start and end.
+
+    Varint values are decoded to integers. 64-bit values are decoded as
+    doubles, and 32-bit values as floats. Length-delimited values are given as
+    (start, end) pairs of positions in data, so that the caller can decide
+    whether to decode them or skip them.
+
+    """
+
+    if end is None:
+        end = len(data)
+
+    position = start
+    while position < end:
+        key, position = read_varint(data, position)
+        field_number = key >> 3
+        wire_type = key & 0x7
+
+        if wire_type == 0:
+            # Varint
+            value, position = read_varint(data, position)
+        elif wire_type == 2:
+            # Length-delimited
+            length, position = read_varint(data, position)
+            value = (position, position + length)
+            position += length
+        elif wire_type == 1:
+            # 64-bit. The only one of these we have is a double.
+            value = struct.unpack_from("<d", data, position)[0]
+            position += 8
+        elif wire_type == 5:
+            # 32-bit
+            value = struct.unpack_from("<f", data, position)[0]
+            position += 4
+        else:
+            raise RuntimeError("Unsupported protobuf wire type {}".format(
+                wire_type))
+
+        yield field_number, wire_type, value
+
+def skip_field(data, position, wire_type):
+    """
+    Skip over the value of a protobuf field of the given wire type, starting at
+    the given position in the given bytearray. Returns the position just after
+    the value.
+    """
+
+    if wire_type == 0:
+        return read_varint(data, position)[1]
+    elif wire_type == 2:
+        length, position = read_varint(data, position)
+        return position + length
+    elif wire_type == 1:
+        return position + 8
+    elif wire_type == 5:
+        return position + 4
+    else:
+        raise RuntimeError("Unsupported protobuf wire type {}".format(
+            wire_type))
+
+# The parse functions below are the hot path when reading a GAM, so they walk
+# the fields inline instead of going through iterate_fields.
+
+def parse_edit(data, start, end):
+    """
+    Parse an Edit message from the given part of the given bytearray.
+    """
+
+    from_length = 0
+    to_length = 0
+    sequence = None
+
+    position = start
+    while position < end:
+        key, position = read_varint(data, position)
+        field_number = key >> 3
+
+        if field_number == EDIT_FROM_LENGTH:
+            from_length, position = read_varint(data, position)
+        elif field_number == EDIT_TO_LENGTH:
+            to_length, position = read_varint(data, position)
+        elif field_number == EDIT_SEQUENCE:
+            length, position = read_varint(data, position)
+            if length > 0:
+                # Empty sequences don't count as sequences, just like in JSON
+                sequence = bytes(data[position:position + length])
+            position += length
+        else:
+            position = skip_field(data, position, key & 0x7)
+
+    return Edit(from_length, to_length, sequence)
+
+def parse_mapping(data, start, end):
+    """
+    Parse a Mapping message (including its Position) from the given part of the
+    given bytearray.
+    """
+
+    node_id = None
+    offset = 0
+    is_reverse = False
+    edits = []
+
+    position = start
+    while position < end:
+        key, position = read_varint(data, position)
+        field_number = key >> 3
+
+        if field_number == MAPPING_EDIT:
+            length, position = read_varint(data, position)
+            edits.append(parse_edit(data, position, position + length))
+            position += length
+        elif field_number == MAPPING_POSITION:
+            length, position = read_varint(data, position)
+            for position_field, _, position_value in iterate_fields(data,
+                position, position + length):
+
+                if position_field == POSITION_NODE_ID:
+                    # Node 0 doesn't exist, so only real IDs get set.
+                    node_id = position_value if position_value != 0 else None
+                elif position_field == POSITION_OFFSET:
+                    offset = position_value
+                elif position_field == POSITION_IS_REVERSE:
+                    # Newer vg keeps orientation on the position
+                    is_reverse = bool(position_value)
+            position += length
+        elif field_number == MAPPING_IS_REVERSE:
+            # Older vg keeps orientation on the mapping
+            value, position = read_varint(data, position)
+            is_reverse = bool(value)
+        else:
+            position = skip_field(data, position, key & 0x7)
+
+    return Mapping(node_id, offset, is_reverse, edits)
+
+def parse_alignment(data, fields=None):
+    """
+    Parse an Alignment message from the given bytearray into an Alignment
+    record.
+
+    If fields is specified, it is a set of field names from ALIGNMENT_FIELDS,
+    and only those fields are decoded. Everything else is skipped and left at
+    its default value.
+
+    """
+
+    # Work out the field numbers we want
+    if fields is None:
+        wanted = None
+    else:
+        wanted = set(ALIGNMENT_FIELDS[name] for name in fields)
+
+    alignment = Alignment()
+
+    position = 0
+    end = len(data)
+    while position < end:
+        key, position = read_varint(data, position)
+        field_number = key >> 3
+
+        if wanted is not None and field_number not in wanted:
+            position = skip_field(data, position, key & 0x7)
+        elif field_number == ALIGNMENT_PATH:
+            length, position = read_varint(data, position)
+            path_end = position + length
+            while position < path_end:
+                path_key, position = read_varint(data, position)
+                if path_key >> 3 == PATH_MAPPING:
+                    length, position = read_varint(data, position)
+                    alignment.mappings.append(parse_mapping(data, position,
+                        position + length))
+                    position += length
+                else:
+                    position = skip_field(data, position, path_key & 0x7)
+        elif field_number == ALIGNMENT_SEQUENCE:
+            length, position = read_varint(data, position)
+            alignment.sequence = bytes(data[position:position + length])
+            position += length
+        elif field_number == ALIGNMENT_NAME:
+            length, position = read_varint(data, position)
+            alignment.name = bytes(data[position:position + length])
+            position += length
+        elif field_number == ALIGNMENT_SCORE:
+            # A score of 0 is never sent, so this alignment is aligned.
+            value, position = read_varint(data, position)
+            alignment.score = signed_varint(value)
+        elif field_number == ALIGNMENT_MAPPING_QUALITY:
+            value, position = read_varint(data, position)
+            alignment.mapping_quality = signed_varint(value)
+        elif field_number == ALIGNMENT_IS_SECONDARY:
+            value, position = read_varint(data, position)
+            alignment.is_secondary = bool(value)
+        elif field_number == ALIGNMENT_IDENTITY:
+            alignment.identity = struct.unpack_from("<d", data, position)[0]
+            position += 8
+        else:
+            position = skip_field(data, position, key & 0x7)
+
+    return alignment
+
+def alignment_from_json(alignment_dict):
+    """
+    Convert an alignment as parsed from "vg view -aj" JSON into an Alignment
+    record.
+    """
+
+    mappings = []
+    for mapping_dict in alignment_dict.get("path", {}).get("mapping", []):
+        position = mapping_dict.get("position", {})
+
+        edits = [Edit(edit.get("from_length", 0), edit.get("to_length", 0),
+            edit.get("sequence", None) or None)
+            for edit in mapping_dict.get("edit", [])]
+
+        node_id = position.get("node_id", None)
+        if node_id is not None:
+            # int64s may come through as strings
+            node_id = int(node_id)
+
+        mappings.append(Mapping(node_id, int(position.get("offset", 0)),
+            mapping_dict.get("is_reverse", False) or
+            position.get("is_reverse", False), edits))
+
+    return Alignment(name=alignment_dict.get("name", None),
+        sequence=alignment_dict.get("sequence", ""),
+        score=alignment_dict.get("score", None),
+        mapping_quality=alignment_dict.get("mapping_quality", 0.0),
+        identity=alignment_dict.get("identity", 0.0),
+        is_secondary=alignment_dict.get("is_secondary", False),
+        mappings=mappings)
+
+class StreamReader(object):
+    """
+    Reads the serialized messages out of an uncompressed vg stream: a series of
+    groups, each a varint count of messages followed by that many
+    varint-length-prefixed messages.
+
+    """
+
+    def __init__(self, stream, chunk_size=1024 * 1024):
+        """
+        Make a new StreamReader reading from the given file-like object, which
+        must already be decompressed.
+        """
+
+        self.stream = stream
+        self.chunk_size = chunk_size
+
+        # This holds the data we have read but not consumed yet, starting at
+        # self.position.
+        self.buffer = bytearray()
+        self.position = 0
+
+    def fill(self, needed):
+        """
+        Make sure at least the given number of unconsumed bytes are buffered.
+        Returns False if the stream ran out first.
+        """
+
+        while len(self.buffer) - self.position < needed:
+            chunk = self.stream.read(max(self.chunk_size, needed))
+            if not chunk:
+                return False
+
+            # Throw away what we already consumed, and add the new data
+            del self.buffer[:self.position]
+            self.position = 0
+            self.buffer.extend(chunk)
+
+        return True
+
+    def read_varint(self):
+        """
+        Read a varint from the stream. Returns None if the stream is at its end.
+        """
+
+        result = 0
+        shift = 0
+        while True:
+            if not self.fill(1):
+                if shift == 0:
+                    # We ended cleanly between varints
+                    return None
+                raise RuntimeError("vg stream ends in the middle of a varint")
+            byte = self.buffer[self.position]
+            self.position += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def __iter__(self):
+        """
+        Yield each message in the stream, as a bytearray.
+        """
+
+        while True:
+            # How many messages are in this group?
+            count = self.read_varint()
+            if count is None:
+                break
+
+            for _ in range(count):
+                length = self.read_varint()
+                if length is None or not self.fill(length):
+                    raise RuntimeError("vg stream is truncated")
+
+                yield self.buffer[self.position:self.position + length]
+                self.position += length
+
+def is_gzipped(filename):
+    """
+    Return True if the given file looks like a gzipped vg stream, and False
+    otherwise.
+    """
+
+    with open(filename, "rb") as handle:
+        return handle.read(2) == GZIP_MAGIC
+
+def read_messages(filename):
+    """
+    Yield each serialized message (as a bytearray) from the given gzipped vg
+    stream file.
+    """
+
+    with gzip.open(filename, "rb") as stream:
+        for message in StreamReader(stream):
+            yield message
+
+class GunzipReader(object):
+    """
+    File-like object that decompresses gzipped data read from another file-like
+    object, which doesn't have to be able to seek (so it can be a pipe). Handles
+    several gzip members one after another.
+
+    >>> import StringIO
+    >>> def gzip_member(data):
+    ...     compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    ...     return compressor.compress(data) + compressor.flush()
+    >>> stream = StringIO.StringIO(gzip_member(b"\\x01\\x03ab") +
+    ...     gzip_member(b"c\\x01\\x02de"))
+    >>> [str(message) for message in StreamReader(GunzipReader(stream,
+    ...     chunk_size=4))]
+    ['abc', 'de']
+
+    """
+
+    def __init__(self, stream, chunk_size=1024 * 1024):
+        """
+        Make a new GunzipReader reading compressed data from the given stream.
+        """
+
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # This holds decompressed data not yet read
+        self.pending = b""
+
+    def read(self, size):
+        """
+        Read up to the given number of decompressed bytes. Returns an empty
+        string at the end of the data.
+        """
+
+        while len(self.pending) == 0:
+            compressed = self.stream.read(self.chunk_size)
+            if not compressed:
+                # Out of input
+                self.pending = self.decompressor.flush()
+                break
+
+            self.pending = self.decompressor.decompress(compressed)
+
+            while self.decompressor.unused_data:
+                # We hit the end of a gzip member, and the next one started.
+                unused = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self.pending += self.decompressor.decompress(unused)
+
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        return data
+
+def read_alignments_stream(stream, fields=None):
+    """
+    Yield an Alignment record for each alignment in the given file-like object
+    of gzipped GAM data, like a pipe from "vg map", only decoding the given set
+    of fields if fields is specified.
+
+    """
+
+    for message in StreamReader(GunzipReader(stream)):
+        yield parse_alignment(message, fields)
+
+def read_alignments_json(stream):
+    """
+    Yield an Alignment record for each line of "vg view -aj" style JSON in the
+    given stream.
+    """
+
+    for line in stream:
+        yield alignment_from_json(json.loads(line))
+
+def read_alignments(gam_filename, fields=None, vg="vg", native=True):
+    """
+    Yield an Alignment record for each alignment in the given GAM file.
+
+    If native is True and the file looks like a gzipped vg stream, decodes it
+    directly, only decoding the given set of fields if fields is specified.
+    Otherwise, falls back on running the given vg binary to convert the GAM to
+    JSON, and parsing that.
+
+    """
+
+    if native and is_gzipped(gam_filename):
+        for message in read_messages(gam_filename):
+            yield parse_alignment(message, fields)
+    else:
+        # Read the alignments in in JSON-line format
+        read_alignment = subprocess.Popen([vg, "view", "-aj", gam_filename],
+            stdout=subprocess.PIPE)
+
+        for alignment in read_alignments_json(read_alignment.stdout):
+            yield alignment
+
+        if read_alignment.wait() != 0:
+            # Complain if vg dies
+            raise RuntimeError("vg died with error {}".format(
+                read_alignment.returncode))
+
+def parse_graph_nodes(data):
+    """
+    Yield (node ID, sequence) pairs for all the nodes in the given serialized
+    Graph message. Edges and paths are skipped.
+    """
+
+    position = 0
+    end = len(data)
+    while position < end:
+        key, position = read_varint(data, position)
+
+        if key >> 3 == GRAPH_NODE:
+            length, position = read_varint(data, position)
+            node_end = position + length
+
+            node_id = None
+            sequence = b""
+            while position < node_end:
+                node_key, position = read_varint(data, position)
+                node_field = node_key >> 3
+
+                if node_field == NODE_SEQUENCE:
+                    length, position = read_varint(data, position)
+                    sequence = bytes(data[position:position + length])
+                    position += length
+                elif node_field == NODE_ID:
+                    node_id, position = read_varint(data, position)
+                else:
+                    position = skip_field(data, position, node_key & 0x7)
+
+            yield node_id, sequence
+        else:
+            position = skip_field(data, position, key & 0x7)
+
+def read_graph_nodes(graph_filename, vg="vg", native=True):
+    """
+    Yield (node ID, sequence) pairs for all the nodes in the given vg graph
+    file.
+
+    If native is True and the file looks like a gzipped vg stream, decodes it
+    directly. Otherwise, falls back on running the given vg binary to convert
+    the graph to JSON, and parsing that.
+
+    """
+
+    if native and is_gzipped(graph_filename):
+        for message in read_messages(graph_filename):
+            for node in parse_graph_nodes(message):
+                yield node
+    else:
+        # Read the graph in in JSON-line format
+        read_graph = subprocess.Popen([vg, "view", "-j", graph_filename],
+            stdout=subprocess.PIPE)
+
+        for line in read_graph.stdout:
+            # Parse the graph chunk JSON
+            graph_chunk = json.loads(line)
+
+            for node_dict in graph_chunk.get("node", []):
+                # We want to crash if a node exists for which one or the other
+                # isn't defined. IDs may come through as strings.
+                yield (int(node_dict["id"]),
+                    node_dict["sequence"].encode("ascii", "replace"))
+
+        if read_graph.wait() != 0:
+            # Complain if vg dies
+            raise RuntimeError("vg died with error {}".format(
+                read_graph.returncode))
+
+def count_graph_elements(data):
+    """
+    Return a GraphSize for the given serialized Graph message.
+    
+    >>> count_graph_elements(bytearray(b"\\x0a\\x05\\x0a\\x03ACG\\x12\\x00"))
+    GraphSize(nodes=1, edges=1, sequence_length=3)
+
+    """
+
+    nodes = 0
+    edges = 0
+    sequence_length = 0
+
+    position = 0
+    end = len(data)
+    while position < end:
+        key, position = read_varint(data, position)
+
+        if key >> 3 == GRAPH_NODE:
+            length, position = read_varint(data, position)
+            node_end = position + length
+            nodes += 1
+
+            while position < node_end:
+                node_key, position = read_varint(data, position)
+
+                if node_key >> 3 == NODE_SEQUENCE:
+                    length, position = read_varint(data, position)
+                    sequence_length += length
+                    position += length
+                else:
+                    position = skip_field(data, position, node_key & 0x7)
+        else:
+            if key >> 3 == GRAPH_EDGE:
+                edges += 1
+            position = skip_field(data, position, key & 0x7)
+
+    return GraphSize(nodes, edges, sequence_length)
+
+def graph_size(graph_filename, vg="vg", native=True):
+    """
+    Return a GraphSize for the given vg graph file.
+
+    If native is True and the file looks like a gzipped vg stream, decodes it
+    directly. Otherwise, falls back on running the given vg binary to convert
+    the graph to JSON, and parsing that.
+
+    """
+
+    nodes = 0
+    edges = 0
+    sequence_length = 0
+
+    if native and is_gzipped(graph_filename):
+        for message in read_messages(graph_filename):
+            chunk_size = count_graph_elements(message)
+            nodes += chunk_size.nodes
+            edges += chunk_size.edges
+            sequence_length += chunk_size.sequence_length
+    else:
+        # Read the graph in in JSON-line format
+        read_graph = subprocess.Popen([vg, "view", "-j", graph_filename],
+            stdout=subprocess.PIPE)
+
+        for line in read_graph.stdout:
+            graph_chunk = json.loads(line)
+
+            for node_dict in graph_chunk.get("node", []):
+                nodes += 1
+                sequence_length += len(node_dict.get("sequence", ""))
+            edges += len(graph_chunk.get("edge", []))
+
+        if read_graph.wait() != 0:
+            # Complain if vg dies
+            raise RuntimeError("vg died with error {}".format(
+                read_graph.returncode))
+
+    return GraphSize(nodes, edges, sequence_length)
+
+class NodeSequenceStore(object):
+    """
+    A compact, read-only store of node sequences by node ID, for looking up
+    reference bases.
+
+    Keeps all the sequences in ID order in one contiguous buffer, with a NumPy
+    array of offsets into it indexed by node ID, instead of a dict of strings.
+    Can be saved to a directory and loaded back memory-mapped.
+
+    >>> store = NodeSequenceStore.from_nodes([(3, b"GATT"), (1, b"ACA")])
+    >>> store[3]
+    'GATT'
+    >>> store[1]
+    'ACA'
+    >>> 2 in store
+    False
+
+    """
+
+    # These are the files that a saved store lives in
+    SEQUENCE_FILE = "node_sequences.seq"
+    OFFSET_FILE = "node_sequences.idx.npy"
+
+    def __init__(self, sequences, offsets):
+        """
+        Make a new NodeSequenceStore from a buffer of concatenated sequences,
+        and an array of offsets into it, where the sequence of node i runs from
+        offsets[i] to offsets[i + 1].
+
+        Node IDs with empty sequences are treated as not present, since vg
+        doesn't have empty nodes.
+
+        """
+
+        self.sequences = sequences
+        self.offsets = offsets
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        """
+        Make a new NodeSequenceStore from an iterable of (node ID, sequence)
+        pairs, in any order.
+        """
+
+        node_ids = []
+        sequences = []
+        for node_id, sequence in nodes:
+            node_ids.append(node_id)
+            sequences.append(sequence)
+
+        node_ids = numpy.array(node_ids, dtype=numpy.int64)
+        max_id = int(node_ids.max()) if len(node_ids) > 0 else 0
+
+        # Lay out the sequences in ID order
+        order = numpy.argsort(node_ids, kind="mergesort")
+        packed = b"".join([sequences[i] for i in order])
+
+        # Put each node's length in the slot after its ID, and sum them up to
+        # get the offsets.
+        offsets = numpy.zeros(max_id + 2, dtype=numpy.int64)
+        offsets[node_ids + 1] = [len(sequence) for sequence in sequences]
+        numpy.cumsum(offsets, out=offsets)
+
+        return cls(packed, offsets)
+
+    @classmethod
+    def from_graph(cls, graph_filename, vg="vg", native=True):
+        """
+        Make a new NodeSequenceStore holding all the nodes in the given vg graph
+        file. See read_graph_nodes.
+        """
+
+        return cls.from_nodes(read_graph_nodes(graph_filename, vg=vg,
+            native=native))
+
+    def save(self, directory):
+        """
+        Save the store as a sidecar in the given directory, where it can be
+        memory-mapped by load.
+        """
+
+        with open(os.path.join(directory, self.SEQUENCE_FILE), "wb") as handle:
+            handle.write(self.sequences)
+
+        numpy.save(os.path.join(directory, self.OFFSET_FILE), self.offsets)
+
+    @classmethod
+    def exists(cls, directory):
+        """
+        Return True if a store has been saved in the given directory, and False
+        otherwise.
+        """
+
+        return (os.path.exists(os.path.join(directory, cls.SEQUENCE_FILE)) and
+            os.path.exists(os.path.join(directory, cls.OFFSET_FILE)))
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Load a store saved in the given directory by save, memory-mapping it
+        instead of reading it into memory.
+        """
+
+        offsets = numpy.load(os.path.join(directory, cls.OFFSET_FILE),
+            mmap_mode="r")
+
+        sequence_filename = os.path.join(directory, cls.SEQUENCE_FILE)
+        if os.path.getsize(sequence_filename) == 0:
+            # Can't map an empty file
+            sequences = b""
+        else:
+            with open(sequence_filename, "rb") as handle:
+                sequences = mmap.mmap(handle.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+
+        return cls(sequences, offsets)
+
+    def __getitem__(self, node_id):
+        """
+        Get the sequence for the given node ID. Raises KeyError if the node
+        isn't in the store.
+        """
+
+        if node_id < 0 or node_id + 1 >= len(self.offsets):
+            raise KeyError(node_id)
+
+        start = int(self.offsets[node_id])
+        end = int(self.offsets[node_id + 1])
+
+        if start == end:
+            raise KeyError(node_id)
+
+        return self.sequences[start:end]
+
+    def __contains__(self, node_id):
+        """
+        Return True if the given node ID is in the store.
+        """
+
+        try:
+            self[node_id]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        """
+        Return the number of nodes in the store.
+        """
+
+        return int(numpy.count_nonzero(numpy.diff(self.offsets)))
+
+    def n_prefix_sums(self):
+        """
+        Get an array where entry i is the number of N bases in the packed
+        sequence buffer before position i. Computed on first use.
+        """
+
+        if getattr(self, "_n_prefix_sums", None) is None:
+            is_n = numpy.frombuffer(self.sequences, dtype=numpy.uint8) == ord("N")
+            self._n_prefix_sums = numpy.zeros(len(is_n) + 1, dtype=numpy.int64)
+            numpy.cumsum(is_n, out=self._n_prefix_sums[1:])
+
+        return self._n_prefix_sums
+
+# This holds the edits of a batch of alignments as flat parallel arrays, one
+# entry per edit, in alignment, mapping, and edit order. alignment_count and
+# mapping_count are per-alignment; everything else is per-edit. Mappings not on
+# a node have a node_id of -1.
+EditArrays = collections.namedtuple("EditArrays", ["alignment_count",
+    "mapping_count", "alignment_index", "mapping_index", "mapping_number",
+    "node_id", "offset", "is_reverse", "from_length", "to_length",
+    "has_sequence"])
+
+def flatten_edits(alignments):
+    """
+    Flatten the edits of the given list of Alignment records into EditArrays
+    for edit_stats_kernel. Unaligned alignments (with no score) contribute no
+    edits.
+    """
+
+    mapping_count = []
+    alignment_index = []
+    mapping_index = []
+    mapping_number = []
+    node_id = []
+    offset = []
+    is_reverse = []
+    from_length = []
+    to_length = []
+    has_sequence = []
+
+    # Number all the mappings in the batch
+    next_mapping_index = 0
+
+    for i, alignment in enumerate(alignments):
+        if alignment.score is None:
+            mapping_count.append(0)
+            continue
+
+        mapping_count.append(len(alignment.mappings))
+
+        for j, mapping in enumerate(alignment.mappings):
+            count = len(mapping.edits)
+            if count == 0:
+                next_mapping_index += 1
+                continue
+
+            # Transpose the edits into columns
+            froms, tos, sequences = zip(*mapping.edits)
+
+            alignment_index += [i] * count
+            mapping_index += [next_mapping_index] * count
+            mapping_number += [j] * count
+            node_id += [mapping.node_id if mapping.node_id is not None
+                else -1] * count
+            offset += [mapping.offset] * count
+            is_reverse += [mapping.is_reverse] * count
+            from_length += froms
+            to_length += tos
+            has_sequence += [sequence is not None for sequence in sequences]
+
+            next_mapping_index += 1
+
+    return EditArrays(len(mapping_count),
+        numpy.array(mapping_count, dtype=numpy.int64),
+        numpy.array(alignment_index, dtype=numpy.int64),
+        numpy.array(mapping_index, dtype=numpy.int64),
+        numpy.array(mapping_number, dtype=numpy.int64),
+        numpy.array(node_id, dtype=numpy.int64),
+        numpy.array(offset, dtype=numpy.int64),
+        numpy.array(is_reverse, dtype=bool),
+        numpy.array(from_length, dtype=numpy.int64),
+        numpy.array(to_length, dtype=numpy.int64),
+        numpy.array(has_sequence, dtype=bool))
+
+def edit_stats_kernel(edits, store):
+    """
+    Compute edit-level alignment stats for a batch of alignments, given as
+    EditArrays, against the reference sequences in the given
+    NodeSequenceStore, all in one vectorized pass.
+
+    Returns a list with a (matches, indels, substitutions, aligned length,
+    alignment columns) tuple for each alignment. These match what walking the
+    edits one at a time, slicing (and reverse-complementing) the reference
+    sequence and counting Ns, would produce. Instead of slicing, N bases are
+    counted with the store's prefix sums.
+
+    """
+
+    alignment_count = edits.alignment_count
+
+    if len(edits.from_length) == 0:
+        # Nothing aligned at all
+        return [(0, 0, 0, 0, 0)] * alignment_count
+
+    offsets = store.offsets
+    from_length = edits.from_length
+    to_length = edits.to_length
+    edit_count = len(from_length)
+
+    # Where does each edit start in its mapping's reference sequence? That's
+    # the total from length of the edits before it in the mapping.
+    cumulative = numpy.cumsum(from_length)
+    before = cumulative - from_length
+    mapping_starts = numpy.searchsorted(edits.mapping_index,
+        edits.mapping_index, side="left")
+    index_in_ref = before - before[mapping_starts]
+
+    # Work out where each edit's node is in the store, and how long it is.
+    on_node = edits.node_id >= 0
+    node_id = numpy.where(on_node, edits.node_id, 0)
+    if numpy.any(node_id + 1 >= len(offsets)):
+        raise KeyError(int(node_id[node_id + 1 >= len(offsets)][0]))
+    node_start = offsets[node_id]
+    node_length = numpy.where(on_node, offsets[node_id + 1] - node_start, 0)
+    if numpy.any(on_node & (node_length == 0)):
+        raise KeyError(int(edits.node_id[on_node & (node_length == 0)][0]))
+
+    # How much reference sequence is there after the offset on the mapping's
+    # strand? Slices past the end of the reference are clipped to it.
+    clipped_offset = numpy.minimum(edits.offset, node_length)
+    available = node_length - clipped_offset
+    low = numpy.minimum(index_in_ref, available)
+    high = numpy.minimum(index_in_ref + from_length, available)
+
+    # Find the edit's bases on the forward strand of the node. On the reverse
+    # strand, the mapping's reference runs backward from the offset from the
+    # end.
+    range_start = numpy.where(edits.is_reverse, available - high,
+        clipped_offset + low) + node_start
+    range_end = range_start + (high - low)
+
+    n_prefix_sums = store.n_prefix_sums()
+    reference_n_count = n_prefix_sums[range_end] - n_prefix_sums[range_start]
+
+    # Work out which edits may be soft clips: the first edit of the first
+    # mapping, and the last edit of the last mapping.
+    first_in_mapping = mapping_starts == numpy.arange(edit_count)
+    last_in_mapping = numpy.append(edits.mapping_index[1:] !=
+        edits.mapping_index[:-1], True)
+    may_be_soft_clip = ((first_in_mapping & (edits.mapping_number == 0)) |
+        (last_in_mapping & (edits.mapping_number ==
+        edits.mapping_count[edits.alignment_index] - 1)))
+
+    same_length = to_length == from_length
+
+    columns = numpy.maximum(to_length, from_length) - reference_n_count
+    aligned = numpy.where(same_length, to_length - reference_n_count, 0)
+    matches = numpy.where(same_length & ~edits.has_sequence, from_length, 0)
+    indels = (~may_be_soft_clip & ~same_length &
+        (reference_n_count == 0)).astype(numpy.int64)
+    substitutions = numpy.where(same_length & edits.has_sequence,
+        to_length - reference_n_count, 0)
+
+    def per_alignment(values):
+        """
+        Total up the given per-edit values for each alignment.
+        """
+
+        return numpy.bincount(edits.alignment_index, weights=values,
+            minlength=alignment_count).astype(numpy.int64).tolist()
+
+    return list(zip(per_alignment(matches), per_alignment(indels),
+        per_alignment(substitutions), per_alignment(aligned),
+        per_alignment(columns)))